@@ -0,0 +1,277 @@
+"""
+Bounded queries behind the admin AI data tools.
+
+query_users, query_appointments, query_referrals and query_prescriptions
+used to run an unbounded .all() with LIKE '%term%' and return every matching
+row as indented JSON. With a real patient base, that put megabytes into the
+model's prompt. The tools now build their answer from these helpers:
+
+- page(): keyset pagination, newest first, on (sort column, id). It returns
+  at most `limit` rows plus an opaque cursor for the next page.
+- project(): only the requested fields of each row. The default is a short
+  summary.
+- group_counts(): a GROUP BY count that runs in the database, for
+  "how many ... per ..." questions, instead of a row dump.
+- NameSearch: name/email substring search backed by an index. On SQLite
+  this is an FTS5 table with the trigram tokenizer, kept in sync by
+  triggers. On Postgres it is a pg_trgm GIN index that ILIKE can use.
+  Without either, or for terms shorter than three characters, the search
+  falls back to LIKE.
+
+TimedSnapshot holds get_system_statistics' counts. They are loaded with
+one grouped query per table and reused for a short TTL, by the tool, the
+admin assistant's system instruction and the analytics page.
+"""
+import json
+import threading
+import time
+from datetime import date, datetime
+
+from sqlalchemy import column, func, or_, select, table, text
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def clamp_limit(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_LIMIT
+    return max(1, min(MAX_LIMIT, limit))
+
+
+# ===================== Keyset pagination =====================
+
+def encode_cursor(value, row_id):
+    """'<iso value>_<id>' ('_<id>' when the sort value is NULL)."""
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    return f"{value if value is not None else ''}_{row_id}"
+
+
+def decode_cursor(cursor, sort_col):
+    """(sort value or None, id) from encode_cursor(), or None if malformed."""
+    if not cursor or "_" not in cursor:
+        return None
+    raw, _, id_str = str(cursor).rpartition("_")
+    try:
+        row_id = int(id_str)
+        if not raw:
+            return None, row_id
+        python_type = sort_col.type.python_type
+        if python_type is datetime:
+            return datetime.fromisoformat(raw), row_id
+        if python_type is date:
+            return date.fromisoformat(raw), row_id
+        return python_type(raw), row_id
+    except (ValueError, NotImplementedError):
+        return None
+
+
+def page(query, sort_col, id_col, limit=DEFAULT_LIMIT, cursor=None):
+    """
+    (rows, next_cursor) for one page ordered by sort_col DESC (NULLs last),
+    id DESC. `cursor` is the next_cursor of the previous page.
+    """
+    limit = clamp_limit(limit)
+    after = decode_cursor(cursor, sort_col)
+    if after:
+        value, last_id = after
+        if value is None:
+            query = query.filter(sort_col.is_(None), id_col < last_id)
+        else:
+            query = query.filter(
+                (sort_col < value)
+                | ((sort_col == value) & (id_col < last_id))
+                | sort_col.is_(None)
+            )
+    rows = query.order_by(sort_col.desc().nulls_last(), id_col.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, sort_col.key), getattr(last, id_col.key))
+    return rows, next_cursor
+
+
+# ===================== Projection and aggregation =====================
+
+def parse_fields(fields, available, default):
+    """Field names from a comma-separated `fields` ('all' for every field); unknown names are ignored."""
+    if not fields:
+        return list(default)
+    wanted = [f.strip().lower() for f in str(fields).split(",") if f.strip()]
+    if "all" in wanted:
+        return list(available)
+    chosen = [name for name in available if name.lower() in wanted]
+    return chosen or list(default)
+
+
+def project(row, fields, getters):
+    """{field: value} of the chosen fields; getters maps field name -> f(row)."""
+    out = {}
+    for name in fields:
+        value = getters[name](row)
+        if isinstance(value, datetime):
+            value = value.strftime("%Y-%m-%d %H:%M:%S")
+        elif isinstance(value, date):
+            value = value.isoformat()
+        out[name] = value
+    return out
+
+
+def group_counts(query, group_col, limit=MAX_LIMIT):
+    """[(value, count)] per distinct group_col value, largest first."""
+    n = func.count().label("n")
+    rows = (query.order_by(None).with_entities(group_col, n)
+            .group_by(group_col).order_by(n.desc()).limit(clamp_limit(limit)).all())
+    return [(value.isoformat() if isinstance(value, (date, datetime)) else value, count)
+            for value, count in rows]
+
+
+def to_json(payload):
+    """Compact JSON for a tool result; it is read by the model, not a person."""
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def rows_result(rows, fields, getters, next_cursor, total=None):
+    payload = {"returned": len(rows), "results": [project(r, fields, getters) for r in rows]}
+    if total is not None:
+        payload["total"] = total
+    payload["next_cursor"] = next_cursor
+    return to_json(payload)
+
+
+def groups_result(group_by, groups):
+    return to_json({
+        "group_by": group_by,
+        "total": sum(count for _, count in groups),
+        "counts": [{"value": value, "count": count} for value, count in groups]
+    })
+
+
+# ===================== Indexed name search =====================
+
+class NameSearch:
+    """
+    Substring search on name/email columns, backed by an index.
+
+    `indexes` maps table name -> searchable columns. ensure() runs once at
+    startup inside the migration block and picks the backend. On SQLite it
+    creates a '<table>_search' FTS5 trigram table and its triggers; on
+    Postgres, pg_trgm GIN indexes. match() then builds the filter clause.
+    """
+
+    MIN_TERM = 3    # the trigram tokenizer and pg_trgm only use the index from 3 characters
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self.mode = None    # "fts5", "trgm" or None (LIKE)
+
+    def ensure(self, db):
+        dialect = db.engine.dialect.name
+        try:
+            if dialect == "sqlite":
+                self._ensure_fts5(db)
+                self.mode = "fts5"
+            elif dialect == "postgresql":
+                self._ensure_trgm(db)
+                self.mode = "trgm"
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self.mode = None
+            print(f"[Name Search] Index unavailable, falling back to LIKE: {e}")
+
+    def _ensure_fts5(self, db):
+        for tbl, cols in self.indexes.items():
+            fts = f"{tbl}_search"
+            exists = db.session.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :n"), {"n": fts}
+            ).first()
+            col_list = ", ".join(cols)
+            new_vals = ", ".join(f"new.{c}" for c in cols)
+            old_vals = ", ".join(f"old.{c}" for c in cols)
+            db.session.execute(text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+                f"{col_list}, content='{tbl}', content_rowid='id', tokenize='trigram')"
+            ))
+            db.session.execute(text(
+                f'CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON "{tbl}" BEGIN '
+                f"INSERT INTO {fts}(rowid, {col_list}) VALUES (new.id, {new_vals}); END"
+            ))
+            db.session.execute(text(
+                f'CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON "{tbl}" BEGIN '
+                f"INSERT INTO {fts}({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals}); END"
+            ))
+            db.session.execute(text(
+                f'CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {col_list} ON "{tbl}" BEGIN '
+                f"INSERT INTO {fts}({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals}); "
+                f"INSERT INTO {fts}(rowid, {col_list}) VALUES (new.id, {new_vals}); END"
+            ))
+            if not exists:
+                db.session.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+                print(f"[Name Search] Built {fts}")
+
+    def _ensure_trgm(self, db):
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        for tbl, cols in self.indexes.items():
+            for col in cols:
+                db.session.execute(text(
+                    f'CREATE INDEX IF NOT EXISTS ix_{tbl}_{col}_trgm ON "{tbl}" USING gin ({col} gin_trgm_ops)'
+                ))
+
+    def match(self, model, term, columns=None):
+        """Filter clause: any of `columns` (default: all indexed ones) contains `term`."""
+        tbl = model.__table__.name
+        columns = columns or self.indexes[tbl]
+        term = (term or "").strip()
+        if self.mode == "fts5" and len(term) >= self.MIN_TERM:
+            fts = f"{tbl}_search"
+            phrase = '"' + term.replace('"', '""') + '"'
+            if columns != self.indexes[tbl]:
+                phrase = "{" + " ".join(columns) + "} : " + phrase
+            rowids = select(column("rowid")).select_from(table(fts)).where(
+                text(f"{fts} MATCH :{fts}_q").bindparams(**{f"{fts}_q": phrase}))
+            return model.id.in_(rowids)
+        pattern = f"%{term}%"
+        if self.mode == "trgm":
+            return or_(*(getattr(model, c).ilike(pattern) for c in columns))
+        return or_(*(getattr(model, c).like(pattern) for c in columns))
+
+
+# ===================== Cached statistics =====================
+
+class TimedSnapshot:
+    """
+    Result of load() reused for `ttl` seconds. One caller reloads an
+    expired value while the others wait for it instead of running the same
+    queries in parallel.
+    """
+
+    def __init__(self, load, ttl=30.0, clock=time.monotonic):
+        self._load = load
+        self.ttl = ttl
+        self._clock = clock
+        self._value = None
+        self._ts = 0.0
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def get(self):
+        with self._lock:
+            if self._value is None or self._clock() - self._ts >= self.ttl:
+                self._value = self._load()
+                self._ts = self._clock()
+                self.loads += 1
+            return self._value
+
+    def age(self):
+        """Seconds since the current value was loaded, or None."""
+        with self._lock:
+            return None if self._value is None else self._clock() - self._ts
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
@@ -0,0 +1,391 @@
+"""
+Prompt assembly and a shared Gemini client for the patient AI assistant.
+
+/ai_triage used to do the following on every message:
+- create a new genai.Client;
+- walk the whole doctor roster to write the directory text;
+- format it into GEMINI_SYSTEM_PROMPT.
+
+The roster only changes when the doctor directory cache is refreshed.
+
+GeminiAssistant keeps one client per process. It renders the system
+prompt, including the directory, once per DoctorDirectory.version. When
+the SDK and model allow it, it also stores that prompt as an explicit
+context cache (client.caches), so the stable prefix is not re-sent and
+re-processed per message. A message then only adds the per-user part:
+the current time and the user's upcoming bookings, as a leading context
+turn.
+
+The client comes from `client_factory`, so tests can pass a stub with
+`models.generate_content`/`generate_content_stream` and
+`caches.create`/`caches.delete`.
+
+ReplyCache answers repeated one-shot questions ("timings of Dr X", "where
+is the clinic", "which doctor for fever") without a model call. Entries
+are keyed by the normalized question, the directory version and the day.
+They are only written from conversations that carry no personal booking
+data.
+
+RequestGovernor replaces the time.sleep() retries that used to run on
+HTTP 429 inside the request thread. Every Gemini call takes a token from
+one shared bucket. When the bucket and its short wait queue are full, the
+route answers "busy" immediately.
+"""
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+
+from doctor_directory import DAY_NAMES
+
+CLINIC_CONTACT_LINES = [
+    "--- Clinic Contact Details ---",
+    "  Phone / WhatsApp: +91 8592031725",
+    "  Location: [Koorachundu](https://www.google.com/maps/place/7J3QGRQW%2B96J/@11.5384625,75.8429407,17z/data=!3m1!4b1!4m4!3m3!8m2!3d11.5384625!4d75.8455156?entry=ttu)",
+]
+
+
+def directory_context(doctors):
+    """Static clinic section of the system prompt: departments, doctors, weekly schedule, contact."""
+    lines = []
+    if not doctors:
+        lines.append("No doctor data is currently available.")
+    else:
+        dept_counts = defaultdict(int)
+        for d in doctors:
+            dept_counts[d.get("Specialization", "Unknown")] += 1
+
+        lines.append("=== CLINIC DOCTOR DIRECTORY ===")
+        lines.append(f"Total doctors: {len(doctors)}")
+        lines.append("")
+        lines.append("--- Departments & doctor counts ---")
+        for dept, cnt in sorted(dept_counts.items()):
+            lines.append(f"  {dept}: {cnt} doctor(s)")
+
+        lines.append("")
+        lines.append("--- Individual doctor details ---")
+        for d in doctors:
+            days = d.get("Days", [])
+            day_times = d.get("DayTimes", {})
+            schedule_parts = [f"{day}: {day_times.get(day, 'time not set')}" for day in DAY_NAMES if day in days]
+            schedule_str = "; ".join(schedule_parts) if schedule_parts else "No schedule set"
+            lines.append(f"  Doctor: {d.get('Name', 'Unknown')} | Specialization: {d.get('Specialization', 'Unknown')}")
+            lines.append(f"    Working days & times: {schedule_str}")
+
+        # Day-wise summary (who works on each day)
+        lines.append("")
+        lines.append("--- Doctors working on each day ---")
+        for day in DAY_NAMES:
+            working = [d["Name"] for d in doctors if day in d.get("Days", [])]
+            if working:
+                lines.append(f"  {day}: {', '.join(working)} ({len(working)} doctor(s))")
+
+    lines.append("")
+    lines.extend(CLINIC_CONTACT_LINES)
+    return "\n".join(lines)
+
+
+def user_context(now_ist, upcoming=None):
+    """
+    Per-message section: current time and, for a logged-in user, their
+    upcoming bookings (sorted, soonest first). upcoming=None means no user.
+    """
+    lines = [
+        "--- SYSTEM TIME & STATUS ---",
+        f"Current Time: {now_ist.strftime('%A, %B %d, %Y, %H:%M:%S')} IST",
+        "Clinic Status: Open for inquiries",
+    ]
+    if upcoming is not None:
+        lines.append("")
+        lines.append("=== USER'S PERSONAL BOOKINGS ===")
+        if not upcoming:
+            lines.append("  You have no upcoming bookings.")
+        else:
+            lines.append(f"  Total upcoming bookings: {len(upcoming)}")
+            for i, b in enumerate(upcoming):
+                status = "NEXT UPCOMING" if i == 0 else f"Booking {i+1}"
+                lines.append(f"  - {status}: Doctor {b.doctor_name} on {b.date} at {b.time} (Token {b.token})")
+    return "\n".join(lines)
+
+
+class GeminiAssistant:
+    def __init__(self, api_key, system_template, model="gemini-2.5-flash",
+                 client_factory=None, context_cache=True, cache_ttl=3600, cache_retry=600):
+        self.api_key = api_key
+        self.system_template = system_template
+        self.model = model
+        self.context_cache = context_cache
+        self.cache_ttl = cache_ttl
+        self.cache_retry = cache_retry      # seconds before retrying a failed caches.create
+        self._client_factory = client_factory
+        self._client = None
+        self._lock = threading.Lock()
+        self._prompt = (None, None)         # (directory version, rendered system prompt)
+        self._cache = None                  # {"version", "name", "expires"}
+
+    @property
+    def enabled(self):
+        return bool(self.api_key)
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    if self._client_factory is not None:
+                        self._client = self._client_factory()
+                    else:
+                        from google import genai
+                        self._client = genai.Client(api_key=self.api_key)
+        return self._client
+
+    # ─── Stable prefix ───
+
+    def system_prompt(self, directory):
+        """GEMINI_SYSTEM_PROMPT with the directory filled in, rendered once per directory version."""
+        version, prompt = self._prompt
+        if version != directory.version or prompt is None:
+            prompt = self.system_template.format(clinic_context=directory_context(directory.doctors))
+            self._prompt = (directory.version, prompt)
+        return prompt
+
+    def cached_content(self, directory):
+        """Name of the context cache holding the system prompt, or None to send it inline."""
+        if not self.context_cache:
+            return None
+        now = time.time()
+        cache = self._cache
+        if cache and cache["version"] == directory.version and now < cache["expires"]:
+            return cache["name"]
+
+        client = self.client
+        with self._lock:
+            cache = self._cache
+            if cache and cache["version"] == directory.version and now < cache["expires"]:
+                return cache["name"]
+            from google.genai import types as genai_types
+            try:
+                created = client.caches.create(
+                    model=self.model,
+                    config=genai_types.CreateCachedContentConfig(
+                        display_name=f"primecare-clinic-v{directory.version}",
+                        system_instruction=self.system_prompt(directory),
+                        ttl=f"{self.cache_ttl}s",
+                    )
+                )
+                # Renew a minute before the server drops it
+                self._cache = {"version": directory.version, "name": created.name,
+                               "expires": now + max(60, self.cache_ttl - 60)}
+            except Exception as e:
+                # Prompt below the model's minimum cache size, caching unsupported, quota...
+                print(f"[AI Assistant] Context cache unavailable, sending prompt inline: {e}")
+                self._cache = {"version": directory.version, "name": None, "expires": now + self.cache_retry}
+
+            if cache and cache.get("name") and cache["name"] != self._cache["name"]:
+                try:
+                    client.caches.delete(name=cache["name"])
+                except Exception:
+                    pass
+            return self._cache["name"]
+
+    # ─── Per message ───
+
+    def _request(self, directory, contents, turn_context, temperature, max_output_tokens):
+        """
+        (contents, config, cache name) for one call. `turn_context`
+        (user_context()) goes in front of the chat history as a user turn,
+        so only that part is new on each message.
+        """
+        from google.genai import types as genai_types
+
+        contents = [genai_types.Content(role="user", parts=[genai_types.Part.from_text(text=turn_context)])] + list(contents)
+        cache_name = self.cached_content(directory)
+        if cache_name:
+            config = genai_types.GenerateContentConfig(
+                cached_content=cache_name, temperature=temperature, max_output_tokens=max_output_tokens)
+        else:
+            config = genai_types.GenerateContentConfig(
+                system_instruction=self.system_prompt(directory),
+                temperature=temperature, max_output_tokens=max_output_tokens)
+        return contents, config, cache_name
+
+    def _forget_cache_on(self, error, cache_name):
+        if cache_name and getattr(error, "code", None) in (403, 404):
+            # Cache expired or was deleted server-side; rebuild it on the next message
+            self._cache = None
+
+    def generate(self, directory, contents, turn_context, temperature=0.7, max_output_tokens=600):
+        """One generate_content call; returns the full response."""
+        contents, config, cache_name = self._request(directory, contents, turn_context, temperature, max_output_tokens)
+        try:
+            return self.client.models.generate_content(model=self.model, contents=contents, config=config)
+        except Exception as e:
+            self._forget_cache_on(e, cache_name)
+            raise
+
+    def generate_stream(self, directory, contents, turn_context, temperature=0.7, max_output_tokens=600):
+        """Like generate(), but yields the text of each chunk as the model produces it."""
+        contents, config, cache_name = self._request(directory, contents, turn_context, temperature, max_output_tokens)
+        try:
+            for chunk in self.client.models.generate_content_stream(model=self.model, contents=contents, config=config):
+                text = getattr(chunk, "text", None)
+                if text:
+                    yield text
+        except Exception as e:
+            self._forget_cache_on(e, cache_name)
+            raise
+
+
+# ===================== Reply cache =====================
+
+# Questions whose answer depends on who is asking or on the current time
+_UNCACHEABLE = re.compile(
+    r"\b(my|mine|booked|booking|bookings|appointment|appointments|token|reach|arrive|"
+    r"now|today|tonight|tomorrow|currently|right now|open|live)\b"
+)
+
+
+def normalize_question(text):
+    """Lowercase, strip punctuation and collapse whitespace: 'Timings of Dr. X?' -> 'timings of dr x'."""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = re.sub(r"[^\w\s']", " ", text)
+    return " ".join(text.split())
+
+
+def cacheable_question(history):
+    """
+    Normalized question if `history` is a single user question whose
+    answer is the same for everyone, else None.
+    """
+    user_turns = [m.get("text", "") for m in history if m.get("role") == "user" and m.get("text")]
+    if len(user_turns) != 1 or history[-1].get("role") != "user":
+        return None
+    question = normalize_question(user_turns[0])
+    if not question or len(question) > 300 or _UNCACHEABLE.search(question):
+        return None
+    return question
+
+
+class ReplyCache:
+    """Thread-safe LRU of model replies with a TTL."""
+
+    def __init__(self, max_entries=512, ttl=1800):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (reply, stored_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[1] >= self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, reply):
+        with self._lock:
+            self._entries[key] = (reply, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# ===================== Request governor =====================
+
+class RequestGovernor:
+    """
+    Token bucket in front of Gemini calls, shared by every request thread.
+
+    `rate_per_minute` should match the project quota (divided by the number
+    of worker processes, since each process has its own bucket). A call
+    takes a token. If none is left, it waits in a bounded queue for at
+    most `max_wait` seconds. When the queue is full, or the next token
+    cannot arrive before the deadline, acquire() returns False at once and
+    the caller answers "busy" instead of holding the worker.
+
+    penalize() is called on an HTTP 429 from the API. It empties the bucket
+    for `backoff` seconds, so the requests that follow fail fast instead of
+    sleeping through a retry.
+    """
+
+    def __init__(self, rate_per_minute=60, burst=10, max_waiters=8, max_wait=2.0,
+                 backoff=5.0, clock=time.monotonic):
+        self.rate = max(rate_per_minute, 1) / 60.0   # tokens per second
+        self.burst = max(burst, 1)
+        self.max_waiters = max_waiters
+        self.max_wait = max_wait
+        self.backoff = backoff
+        self._clock = clock
+        self._tokens = float(self.burst)
+        self._updated = clock()
+        self._waiters = 0
+        self._cond = threading.Condition()
+        self.granted = 0
+        self.rejected = 0
+        self.throttled = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, max_wait=None):
+        """Take one token, waiting up to max_wait seconds. Returns False if the caller should answer busy."""
+        max_wait = self.max_wait if max_wait is None else max_wait
+        with self._cond:
+            now = self._clock()
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.granted += 1
+                return True
+            if self._waiters >= self.max_waiters or max_wait <= 0:
+                self.rejected += 1
+                return False
+
+            deadline = now + max_wait
+            self._waiters += 1
+            try:
+                while True:
+                    now = self._clock()
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self.granted += 1
+                        return True
+                    needed = (1 - self._tokens) / self.rate
+                    if now + needed > deadline:
+                        self.rejected += 1
+                        return False
+                    self._cond.wait(needed)
+            finally:
+                self._waiters -= 1
+
+    def penalize(self, backoff=None):
+        """The API answered 429: no tokens for `backoff` seconds."""
+        backoff = self.backoff if backoff is None else backoff
+        with self._cond:
+            self._refill(self._clock())
+            self._tokens = min(self._tokens, 0.0) - backoff * self.rate
+            self.throttled += 1
+
+    def stats(self):
+        with self._cond:
+            self._refill(self._clock())
+            return {"tokens": round(self._tokens, 2), "waiting": self._waiters, "granted": self.granted,
+                    "rejected": self.rejected, "throttled": self.throttled}
@@ -0,0 +1,143 @@
+"""
+Per-doctor, per-day booking aggregates for the admin analytics page.
+
+Each PatientBooking contributes to at most two BookingDailyRollup rows:
+
+- the IST day it was created: bookings +1, and cancellations +1 while its
+  status is 'cancelled';
+- the IST day its consultation ended: completions +1 and the consultation
+  length in seconds, once both consultation times are set and the booking
+  is not cancelled.
+
+app.py keeps the table current from ORM flush events. Each change applies
+contribution(new) - contribution(old) with an upsert on the flush's own
+connection, so the rollup commits or rolls back with the booking itself.
+scripts/backfill_rollups.py rebuilds it from scratch.
+"""
+from collections import defaultdict
+
+import pytz
+from sqlalchemy.dialects import postgresql, sqlite
+
+IST = pytz.timezone('Asia/Kolkata')
+ROLLUP_FIELDS = ("bookings", "cancellations", "completions", "consult_seconds")
+
+
+def ist_day(dt):
+    """Naive UTC datetime -> IST calendar date."""
+    if dt is None:
+        return None
+    return pytz.utc.localize(dt).astimezone(IST).date()
+
+
+def contribution(doctor_name, status, created_at, start_time, end_time):
+    """{(day, doctor_key): {field: amount}} for one booking in the given state."""
+    out = defaultdict(lambda: defaultdict(float))
+    doctor_key = (doctor_name or "").strip().lower()
+    if not doctor_key:
+        return out
+
+    created_day = ist_day(created_at)
+    if created_day:
+        out[(created_day, doctor_key)]["bookings"] += 1
+        if status == 'cancelled':
+            out[(created_day, doctor_key)]["cancellations"] += 1
+
+    if start_time and end_time and status != 'cancelled':
+        end_day = ist_day(end_time)
+        out[(end_day, doctor_key)]["completions"] += 1
+        out[(end_day, doctor_key)]["consult_seconds"] += (end_time - start_time).total_seconds()
+    return out
+
+
+def subtract(new, old):
+    """new - old, dropping zero entries."""
+    delta = defaultdict(lambda: defaultdict(float))
+    for key, fields in new.items():
+        for field, amount in fields.items():
+            delta[key][field] += amount
+    for key, fields in old.items():
+        for field, amount in fields.items():
+            delta[key][field] -= amount
+    return {key: {f: v for f, v in fields.items() if v}
+            for key, fields in delta.items() if any(fields.values())}
+
+
+def _row_values(fields):
+    return {field: (float(fields.get(field, 0)) if field == "consult_seconds" else int(fields.get(field, 0)))
+            for field in ROLLUP_FIELDS}
+
+
+def apply_delta(connection, table, delta, names=None):
+    """
+    Add `delta` to the rollup rows with one upsert per (day, doctor).
+    `names` maps doctor_key -> display name for rows created here.
+    """
+    if not delta:
+        return
+    dialect = connection.dialect.name
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    for (day, doctor_key), fields in delta.items():
+        values = _row_values(fields)
+        stmt = insert(table).values(
+            day=day, doctor_key=doctor_key,
+            doctor_name=(names or {}).get(doctor_key, doctor_key),
+            **values
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.day, table.c.doctor_key],
+            set_={field: table.c[field] + stmt.excluded[field] for field in ROLLUP_FIELDS}
+        )
+        connection.execute(stmt)
+
+
+def compute(db, PatientBooking, chunk_size=2000):
+    """({(day, doctor_key): {field: amount}}, {doctor_key: doctor_name}, bookings read) from PatientBooking."""
+    totals = defaultdict(lambda: defaultdict(float))
+    names = {}
+    seen = 0
+    q = db.session.query(
+        PatientBooking.id, PatientBooking.doctor_name, PatientBooking.status,
+        PatientBooking.created_at, PatientBooking.consultation_start_time,
+        PatientBooking.consultation_end_time
+    ).order_by(PatientBooking.id.asc())
+    for row in q.yield_per(chunk_size):
+        seen += 1
+        for key, fields in contribution(row.doctor_name, row.status, row.created_at,
+                                        row.consultation_start_time, row.consultation_end_time).items():
+            names.setdefault(key[1], (row.doctor_name or "").strip())
+            for field, amount in fields.items():
+                totals[key][field] += amount
+    return totals, names, seen
+
+
+def rebuild(db, PatientBooking, BookingDailyRollup, chunk_size=2000):
+    """Recompute every rollup row from PatientBooking. Returns the number of bookings read."""
+    totals, names, seen = compute(db, PatientBooking, chunk_size)
+    db.session.query(BookingDailyRollup).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(BookingDailyRollup, [
+        dict(day=day, doctor_key=doctor_key, doctor_name=names.get(doctor_key, doctor_key),
+             **_row_values(fields))
+        for (day, doctor_key), fields in totals.items()
+    ])
+    db.session.commit()
+    return seen
+
+
+def verify(db, PatientBooking, BookingDailyRollup):
+    """
+    Differences between the live rollup table and compute(), as
+    {(day, doctor_key): (live, expected)}. Empty when they agree.
+    """
+    totals, _, _ = compute(db, PatientBooking)
+    expected = {key: _row_values(fields) for key, fields in totals.items()}
+    live = {(row.day, row.doctor_key): {field: getattr(row, field) for field in ROLLUP_FIELDS}
+            for row in BookingDailyRollup.query.all()}
+    empty = _row_values({})
+    mismatches = {}
+    for key in set(expected) | set(live):
+        want = expected.get(key, empty)
+        have = live.get(key, empty)
+        if any(abs(float(have[f]) - float(want[f])) > 1e-6 for f in ROLLUP_FIELDS):
+            mismatches[key] = (have, want)
+    return mismatches
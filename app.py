@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, session, jsonify, url_for, send_from_directory, make_response
+from flask import Flask, render_template, request, redirect, session, jsonify, url_for, send_from_directory, make_response, Response, stream_with_context
 import gspread
 from datetime import datetime, timedelta
 import pytz
@@ -9,6 +9,9 @@ from io import BytesIO
 import requests
 import json
 import random
+import hashlib
+import threading
+from types import SimpleNamespace
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -18,9 +21,28 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from werkzeug.security import generate_password_hash, check_password_hash
-from google import genai
 from google.genai import types as genai_types
+from sheet_sync import SheetReplicator
+from sheets_pool import SheetsPool
+from sheet_batch import SheetBatch
+from sheet_maintenance import SheetMaintenance
+from doctor_directory import DoctorDirectory, normalize_key
+from live_events import broker as live_event_broker, format_sse
+from live_sessions import LiveSessionMap
+import session_state
+from session_state import SessionScheduler
+from token_queue import TokenQueue
+from push_services import init_dispatcher as init_push_dispatcher
+import analytics_rollup
+import admin_queries
+from admin_queries import NameSearch
+from booking_history import load_user_bookings
+from ai_assistant import GeminiAssistant, ReplyCache, RequestGovernor, cacheable_question, user_context
 
 load_dotenv()  # Load .env file when running locally
 
@@ -116,6 +138,18 @@ class DoctorSession(db.Model):
     end_time = db.Column(db.String(20), nullable=True)
     skipped_tokens = db.Column(db.Text, default="") # Stored as comma-separated string
     broadcast_message = db.Column(db.String(500), nullable=True)
+    # normalize_key(doctor_name) / normalize_key(specialization), kept in sync by sync_lookup_keys
+    doctor_key = db.Column(db.String(100))
+    spec_key = db.Column(db.String(100))
+
+    __table_args__ = (
+        db.Index('ix_doctor_session_key', 'doctor_key', 'spec_key'),
+    )
+
+    @property
+    def queue(self):
+        """TokenQueue for status/current_token/skipped_tokens, parsed once per change."""
+        return TokenQueue.of(self)
 
 class OTP(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -124,9 +158,12 @@ class OTP(db.Model):
     expiry = db.Column(db.DateTime, nullable=False)
 
 class PatientBooking(db.Model):
+    # active_history on the BookingDailyRollup inputs (doctor_name, created_at, status, consultation
+    # times): assigning one on an expired instance loads the stored value first, so
+    # record_booking_rollup always sees the old value it has to subtract
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    doctor_name = db.Column(db.String(100))
+    doctor_name = db.column_property(db.Column(db.String(100)), active_history=True)
     specialization = db.Column(db.String(100))
     date = db.Column(db.String(20))
     time = db.Column(db.String(50))
@@ -134,13 +171,166 @@ class PatientBooking(db.Model):
     sheet_url = db.Column(db.String(255))
     patient_name = db.Column(db.String(100))
     age = db.Column(db.String(10))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    status = db.Column(db.String(50), default="confirmed")
+    created_at = db.column_property(db.Column(db.DateTime, default=datetime.utcnow), active_history=True)
+    status = db.column_property(db.Column(db.String(50), default="confirmed"), active_history=True)
     cancelled_by = db.Column(db.String(50), nullable=True)
     cancellation_reason = db.Column(db.String(255), nullable=True)
     cancelled_at = db.Column(db.String(50), nullable=True)
-    consultation_start_time = db.Column(db.DateTime, nullable=True)
-    consultation_end_time = db.Column(db.DateTime, nullable=True)
+    consultation_start_time = db.column_property(db.Column(db.DateTime, nullable=True), active_history=True)
+    consultation_end_time = db.column_property(db.Column(db.DateTime, nullable=True), active_history=True)
+    gender = db.Column(db.String(20), nullable=True)
+    phone_number = db.Column(db.String(20), nullable=True)
+    # Google Sheets replication state: 'pending' rows are pushed by sheet_sync.SheetReplicator
+    sync_state = db.Column(db.String(20), default="pending")
+    sync_attempts = db.Column(db.Integer, default=0)
+    synced_at = db.Column(db.DateTime, nullable=True)
+    # Indexed lookup columns derived from doctor_name/specialization/date by sync_lookup_keys
+    doctor_key = db.Column(db.String(100))
+    spec_key = db.Column(db.String(100))
+    booking_date = db.Column(db.Date)
+    # Set while the booking is confirmed; a repeated submission with the same key returns this booking
+    idempotency_key = db.Column(db.String(64), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_patient_booking_doctor_day', 'doctor_key', 'spec_key', 'booking_date', 'token'),
+        db.Index('ix_patient_booking_user_day', 'user_id', 'booking_date'),
+        db.Index('ix_patient_booking_created_at', 'created_at'),
+        db.Index('uq_patient_booking_idempotency_key', 'idempotency_key', unique=True),
+    )
+
+class TokenCounter(db.Model):
+    # Last token handed out per doctor/specialization/day; allocate_booking_token locks this row
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_key = db.Column(db.String(100), nullable=False)
+    spec_key = db.Column(db.String(100), nullable=False)
+    booking_date = db.Column(db.Date, nullable=False)
+    last_token = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('doctor_key', 'spec_key', 'booking_date', name='uq_token_counter_day'),
+    )
+
+class BookingDailyRollup(db.Model):
+    # Per-doctor, per-IST-day counters for /admin/analytics, kept in step by record_booking_rollup
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    doctor_key = db.Column(db.String(100), nullable=False)
+    doctor_name = db.Column(db.String(100))
+    bookings = db.Column(db.Integer, default=0, nullable=False)        # by created_at day
+    cancellations = db.Column(db.Integer, default=0, nullable=False)   # by created_at day
+    completions = db.Column(db.Integer, default=0, nullable=False)     # by consultation_end_time day
+    consult_seconds = db.Column(db.Float, default=0.0, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'doctor_key', name='uq_booking_rollup_day_doctor'),
+    )
+
+def as_date(value):
+    """'YYYY-MM-DD' or legacy 'DD-MM-YYYY' string (or a date) -> date, or None."""
+    if not value:
+        return None
+    if hasattr(value, "year"):
+        return value
+    for fmt in ("%Y-%m-%d", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(value.strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+def booking_idempotency_key(specialization, date_str, name, age, gender, phone_number, client_key=None,
+                            doctor_name=None):
+    """
+    Key identifying one booking submission.
+
+    Clients may send an Idempotency-Key header (one per form submission).
+    Otherwise the key is derived from the patient details, so the same
+    patient (name, age, gender, phone) booking the same doctor on the same
+    day twice, e.g. a double click or a retried request, maps to the booking
+    that already exists. Booking a different doctor is a new booking.
+    Department bookings pick a doctor on the server and pass no doctor_name,
+    so their key covers the whole specialization.
+    """
+    if client_key:
+        raw = f"client|{normalize_key(specialization)}|{client_key.strip()}"
+    else:
+        day = as_date(date_str)
+        raw = "|".join([
+            normalize_key(specialization),
+            *([normalize_key(doctor_name)] if doctor_name else []),
+            day.isoformat() if day else str(date_str or ""),
+            normalize_key(name),
+            str(age or "-").strip(),
+            normalize_key(gender),
+            str(phone_number or "").strip(),
+        ])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+@event.listens_for(DoctorSession, "before_insert")
+@event.listens_for(DoctorSession, "before_update")
+@event.listens_for(PatientBooking, "before_insert")
+@event.listens_for(PatientBooking, "before_update")
+def sync_lookup_keys(mapper, connection, target):
+    """Keep the normalized key columns (and booking_date) in step with the display fields."""
+    target.doctor_key = normalize_key(target.doctor_name)
+    target.spec_key = normalize_key(target.specialization)
+    if isinstance(target, PatientBooking):
+        day = as_date(target.date)
+        target.booking_date = day
+        if day:
+            target.date = day.strftime("%Y-%m-%d")
+        if target.status not in (None, 'confirmed'):
+            # Cancelled/consulted bookings release their key so the patient can book again
+            target.idempotency_key = None
+
+ROLLUP_ATTRS = ("doctor_name", "status", "created_at", "consultation_start_time", "consultation_end_time")
+
+def _booking_rollup_state(booking, previous=False):
+    """
+    Rollup inputs for a booking as it is now, or as last stored when
+    previous=True. ROLLUP_ATTRS are active_history columns, so a changed
+    attribute always carries its stored value in history.deleted (empty when
+    that value was NULL).
+    """
+    state = db.inspect(booking)
+    values = []
+    for attr in ROLLUP_ATTRS:
+        history = state.attrs[attr].history
+        if previous and history.has_changes():
+            values.append(history.deleted[0] if history.deleted else None)
+        else:
+            values.append(getattr(booking, attr))
+    return values
+
+@event.listens_for(db.session, "before_flush")
+def record_booking_rollup(db_session, flush_context, instances):
+    """Fold booking inserts/changes/deletes into BookingDailyRollup in the same transaction."""
+    delta = {}
+    names = {}
+    def add(new, old):
+        for key, fields in analytics_rollup.subtract(new, old).items():
+            for field, amount in fields.items():
+                delta.setdefault(key, {}).setdefault(field, 0)
+                delta[key][field] += amount
+
+    for obj in db_session.new:
+        if isinstance(obj, PatientBooking):
+            if obj.created_at is None:
+                obj.created_at = datetime.utcnow()
+            names[normalize_key(obj.doctor_name)] = (obj.doctor_name or "").strip()
+            add(analytics_rollup.contribution(*_booking_rollup_state(obj)), {})
+    for obj in db_session.dirty:
+        if isinstance(obj, PatientBooking) and db_session.is_modified(obj):
+            names[normalize_key(obj.doctor_name)] = (obj.doctor_name or "").strip()
+            add(analytics_rollup.contribution(*_booking_rollup_state(obj)),
+                analytics_rollup.contribution(*_booking_rollup_state(obj, previous=True)))
+    for obj in db_session.deleted:
+        if isinstance(obj, PatientBooking):
+            add({}, analytics_rollup.contribution(*_booking_rollup_state(obj, previous=True)))
+
+    delta = {key: fields for key, fields in delta.items() if any(fields.values())}
+    if delta:
+        analytics_rollup.apply_delta(db_session.connection(), BookingDailyRollup.__table__, delta, names)
 
 class Prescription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -176,6 +366,24 @@ class PushSubscription(db.Model):
     auth = db.Column(db.String(255), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class PushDelivery(db.Model):
+    # One queued web push per (message, subscription); drained by push_services.PushDispatcher
+    id = db.Column(db.Integer, primary_key=True)
+    subscription_id = db.Column(db.Integer, index=True, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    state = db.Column(db.String(20), default="pending") # pending | sending | sent | failed | gone
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(40), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_push_delivery_due', 'state', 'next_attempt_at'),
+    )
+
 class DoctorReferral(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -196,6 +404,13 @@ class SavedPatient(db.Model):
     phone_number = db.Column(db.String(20), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+# Indexed substring search for the admin AI tools (FTS5 on SQLite, pg_trgm on Postgres)
+name_search = NameSearch({
+    "user": ("name", "email"),
+    "patient_booking": ("patient_name",),
+    "prescription": ("patient_name",),
+})
+
 with app.app_context():
     db.create_all()
     # Create default guest user if it doesn't exist to satisfy the PatientBooking user_id constraint
@@ -233,6 +448,31 @@ with app.app_context():
             db.session.execute(text("ALTER TABLE patient_booking ADD COLUMN consultation_start_time TIMESTAMP"))
         if 'consultation_end_time' not in columns:
             db.session.execute(text("ALTER TABLE patient_booking ADD COLUMN consultation_end_time TIMESTAMP"))
+        if 'gender' not in columns:
+            db.session.execute(text("ALTER TABLE patient_booking ADD COLUMN gender VARCHAR(20)"))
+        if 'phone_number' not in columns:
+            db.session.execute(text("ALTER TABLE patient_booking ADD COLUMN phone_number VARCHAR(20)"))
+        if 'sync_state' not in columns:
+            # Existing bookings were written straight to the sheets, so they start out synced
+            db.session.execute(text("ALTER TABLE patient_booking ADD COLUMN sync_state VARCHAR(20) DEFAULT 'synced'"))
+        if 'sync_attempts' not in columns:
+            db.session.execute(text("ALTER TABLE patient_booking ADD COLUMN sync_attempts INTEGER DEFAULT 0"))
+        if 'synced_at' not in columns:
+            db.session.execute(text("ALTER TABLE patient_booking ADD COLUMN synced_at TIMESTAMP"))
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_patient_booking_sync_state ON patient_booking (sync_state)"))
+        if 'doctor_key' not in columns:
+            db.session.execute(text("ALTER TABLE patient_booking ADD COLUMN doctor_key VARCHAR(100)"))
+        if 'spec_key' not in columns:
+            db.session.execute(text("ALTER TABLE patient_booking ADD COLUMN spec_key VARCHAR(100)"))
+        if 'booking_date' not in columns:
+            db.session.execute(text("ALTER TABLE patient_booking ADD COLUMN booking_date DATE"))
+        db.session.execute(text("UPDATE patient_booking SET doctor_key = lower(trim(doctor_name)), spec_key = lower(trim(specialization)) WHERE doctor_key IS NULL"))
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_patient_booking_doctor_day ON patient_booking (doctor_key, spec_key, booking_date, token)"))
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_patient_booking_user_day ON patient_booking (user_id, booking_date)"))
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_patient_booking_created_at ON patient_booking (created_at)"))
+        if 'idempotency_key' not in columns:
+            db.session.execute(text("ALTER TABLE patient_booking ADD COLUMN idempotency_key VARCHAR(64)"))
+        db.session.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_patient_booking_idempotency_key ON patient_booking (idempotency_key)"))
         
         # Safely alter doctor_referral table
         columns_ref = [c['name'] for c in inspector.get_columns('doctor_referral')]
@@ -245,6 +485,12 @@ with app.app_context():
         columns_session = [c['name'] for c in inspector.get_columns('doctor_session')]
         if 'broadcast_message' not in columns_session:
             db.session.execute(text("ALTER TABLE doctor_session ADD COLUMN broadcast_message VARCHAR(500)"))
+        if 'doctor_key' not in columns_session:
+            db.session.execute(text("ALTER TABLE doctor_session ADD COLUMN doctor_key VARCHAR(100)"))
+        if 'spec_key' not in columns_session:
+            db.session.execute(text("ALTER TABLE doctor_session ADD COLUMN spec_key VARCHAR(100)"))
+        db.session.execute(text("UPDATE doctor_session SET doctor_key = lower(trim(doctor_name)), spec_key = lower(trim(specialization)) WHERE doctor_key IS NULL"))
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_doctor_session_key ON doctor_session (doctor_key, spec_key)"))
 
         # Safely alter ticker_message table
         columns_ticker = [c['name'] for c in inspector.get_columns('ticker_message')]
@@ -257,6 +503,41 @@ with app.app_context():
             
         db.session.commit()
         
+        # One-time backfill of booking_date; legacy DD-MM-YYYY dates are rewritten as YYYY-MM-DD
+        legacy_bookings = PatientBooking.query.filter(PatientBooking.booking_date.is_(None), PatientBooking.date.isnot(None)).all()
+        for b in legacy_bookings:
+            day = as_date(b.date)
+            if day:
+                b.booking_date = day
+                b.date = day.strftime("%Y-%m-%d")
+        if legacy_bookings:
+            db.session.commit()
+            print(f"[Migration] Backfilled booking_date on {len(legacy_bookings)} bookings")
+
+        # Idempotency keys for upcoming confirmed bookings made before the column existed
+        unkeyed = PatientBooking.query.filter(
+            PatientBooking.idempotency_key.is_(None),
+            PatientBooking.status == 'confirmed',
+            PatientBooking.booking_date >= datetime.now(pytz.timezone('Asia/Kolkata')).date()
+        ).order_by(PatientBooking.id.asc()).all()
+        if unkeyed:
+            taken = set()
+            for b in unkeyed:
+                key = booking_idempotency_key(b.specialization, b.date, b.patient_name, b.age, b.gender, b.phone_number,
+                                              doctor_name=b.doctor_name)
+                if key not in taken and not PatientBooking.query.filter_by(idempotency_key=key).first():
+                    b.idempotency_key = key
+                    taken.add(key)
+            db.session.commit()
+            print(f"[Migration] Backfilled idempotency keys on {len(taken)} bookings")
+
+        name_search.ensure(db)
+
+        # First run with the analytics rollup table: build it from the booking history
+        if BookingDailyRollup.query.first() is None and PatientBooking.query.first() is not None:
+            rebuilt = analytics_rollup.rebuild(db, PatientBooking, BookingDailyRollup)
+            print(f"[Migration] Built analytics rollups from {rebuilt} bookings")
+
         # Backfill existing ticker messages with default values if null
         legacy_tickers = TickerMessage.query.all()
         for t in legacy_tickers:
@@ -281,13 +562,13 @@ with app.app_context():
             if not ref.booking_id or not ref.patient_name:
                 b = PatientBooking.query.filter(
                     PatientBooking.user_id == ref.user_id,
-                    db.func.lower(db.func.trim(PatientBooking.doctor_name)) == ref.from_doctor.lower().strip()
+                    PatientBooking.doctor_key == normalize_key(ref.from_doctor)
                 ).filter(PatientBooking.created_at <= ref.created_at).order_by(PatientBooking.created_at.desc()).first()
                 
                 if not b:
                     b = PatientBooking.query.filter(
                         PatientBooking.user_id == ref.user_id,
-                        db.func.lower(db.func.trim(PatientBooking.doctor_name)) == ref.from_doctor.lower().strip()
+                        PatientBooking.doctor_key == normalize_key(ref.from_doctor)
                     ).order_by(PatientBooking.created_at.desc()).first()
                 
                 if b:
@@ -337,41 +618,72 @@ DEFAULT_SETTINGS = {
     'promo_facility_image': '/static/image/hero_premium.png'
 }
 
+SETTINGS_CACHE = {
+    "values": None,  # {key: value} for every AppSettings row
+    "ts": 0.0,       # timestamp of last load
+    "ttl": 60.0      # other workers pick up admin changes within this window
+}
+
+def invalidate_settings_cache():
+    SETTINGS_CACHE["values"] = None
+
+def get_setting_values():
+    """All AppSettings rows as a dict, loaded once per TTL instead of on every render."""
+    global SETTINGS_CACHE
+    now = time.time()
+    if SETTINGS_CACHE["values"] is not None and (now - SETTINGS_CACHE["ts"]) < SETTINGS_CACHE["ttl"]:
+        return SETTINGS_CACHE["values"]
+    values = {s.key: s.value for s in AppSettings.query.all()}
+    SETTINGS_CACHE = {"values": values, "ts": now, "ttl": SETTINGS_CACHE["ttl"]}
+    return values
+
+def get_setting_value(key, default=None):
+    try:
+        return get_setting_values().get(key, default)
+    except Exception as e:
+        print(f"[ERROR] Failed to fetch AppSettings: {e}")
+        return default
+
 def get_all_settings():
     settings = dict(DEFAULT_SETTINGS)
     try:
-        db_settings = AppSettings.query.all()
-        for s in db_settings:
-            if s.key in settings:
-                settings[s.key] = s.value
+        for key, value in get_setting_values().items():
+            if key in settings:
+                settings[key] = value
     except Exception as e:
         print(f"[ERROR] Failed to fetch AppSettings: {e}")
     
-    # Calculate unique departments count dynamically from the doctors list
+    # Unique departments come from the cached doctor directory
     try:
-        doctors = get_all_doctors()
-        specs = set()
-        for doc in doctors:
-            spec = doc.get("Specialization", "").strip()
-            if spec:
-                specs.add(spec)
-        settings['departments_count'] = len(specs) if specs else 10
+        settings['departments_count'] = len(get_doctor_directory().specializations) or 10
     except Exception as e:
         print(f"[ERROR] Failed to calculate departments count: {e}")
         settings['departments_count'] = 10
         
     return settings
 
+def user_can_switch(refresh=False):
+    """
+    Whether the logged-in user also has a doctor profile.
+    Cached in the session as [email, flag] so renders skip the lookup;
+    keyed by email so a different login on the same browser recomputes it.
+    """
+    user_email = session.get('user_email')
+    if not user_email:
+        return False
+    cached = session.get('can_switch')
+    if not refresh and cached and cached[0] == user_email:
+        return cached[1]
+    try:
+        can_switch = DoctorSession.query.filter_by(email=user_email).first() is not None
+    except Exception:
+        return False
+    session['can_switch'] = [user_email, can_switch]
+    return can_switch
+
 @app.context_processor
 def inject_settings():
-    user_email = session.get('user_email')
-    can_switch = False
-    if user_email:
-        try:
-            can_switch = DoctorSession.query.filter_by(email=user_email).first() is not None
-        except Exception:
-            pass
-    return dict(settings=get_all_settings(), can_switch=can_switch)
+    return dict(settings=get_all_settings(), can_switch=user_can_switch())
 
 
 # Email / admin config
@@ -418,33 +730,141 @@ client = None
 main_sheet = None
 doctors_ws = None
 
+# One authorized client per worker, plus cached spreadsheet and worksheet handles
+sheets_pool = SheetsPool(
+    lambda: gspread.authorize(creds),
+    max_spreadsheets=int(os.environ.get("SHEETS_POOL_SIZE", "128"))
+)
+
 try:
     creds = get_credentials()
-    client = gspread.authorize(creds)
+    client = sheets_pool.client
     # Main spreadsheet to store doctor list
     MAIN_SHEET_NAME = "DoctorBookingData"
-    main_sheet = client.open(MAIN_SHEET_NAME)
+    main_sheet = sheets_pool.open(MAIN_SHEET_NAME)
     doctors_ws = main_sheet.worksheet("Doctors")
 except Exception as e:
     print(f"[WARNING] Failed to connect to Google Sheets at startup: {e}")
     print("The app will still run, but doctor-related data might be unavailable.")
 
-def get_leave_worksheet():
-    """Return 'Leave' worksheet, create if missing, ensure headers."""
+LEAVE_HEADERS = ["DoctorName", "Specialization", "Date", "Reason"]
+HOLIDAY_HEADERS = ["Date", "Reason"]
+
+# Worksheet handles for the Leave / ClinicHolidays tabs, resolved once per process
+CALENDAR_WORKSHEETS = {}
+
+def _calendar_worksheet(title, headers, cols):
+    """Return a cached worksheet handle; tab creation and header check happen on first lookup only."""
+    ws = CALENDAR_WORKSHEETS.get(title)
+    if ws is not None:
+        return ws
     try:
-        ws = main_sheet.worksheet("Leave")
+        ws = main_sheet.worksheet(title)
         # Ensure headers if sheet is empty
-        if not ws.get_all_values():
-            ws.append_row(["DoctorName", "Specialization", "Date", "Reason"])
-        return ws
+        if not ws.row_values(1):
+            ws.append_row(headers)
     except gspread.exceptions.WorksheetNotFound:
-        ws = main_sheet.add_worksheet(title="Leave", rows="100", cols="4")
-        ws.append_row(["DoctorName", "Specialization", "Date", "Reason"])
-        return ws
+        ws = main_sheet.add_worksheet(title=title, rows="100", cols=str(cols))
+        ws.append_row(headers)
+    CALENDAR_WORKSHEETS[title] = ws
+    return ws
+
+def get_leave_worksheet():
+    """Return 'Leave' worksheet, create if missing, ensure headers."""
+    try:
+        return _calendar_worksheet("Leave", LEAVE_HEADERS, 4)
     except Exception as e:
         print(f"[ERROR] get_leave_worksheet failed: {e}")
         return None
 
+def get_holiday_worksheet():
+    """Return 'ClinicHolidays' worksheet, create if missing, ensure headers."""
+    try:
+        return _calendar_worksheet("ClinicHolidays", HOLIDAY_HEADERS, 2)
+    except Exception as e:
+        print(f"[ERROR] get_holiday_worksheet failed: {e}")
+        return None
+
+# ===================== Calendar cache =====================
+
+CALENDAR_CACHE = {
+    "holidays": None,     # {"YYYY-MM-DD": reason}
+    "leaves": None,       # {(doctor_lower, spec_lower, "YYYY-MM-DD"): reason}
+    "holiday_rows": [],   # raw sheet values (header row first)
+    "leave_rows": [],
+    "ts": 0.0,            # timestamp of last fetch
+    "ttl": 60.0           # seconds to keep cache
+}
+
+def _read_calendar_rows(get_ws, label):
+    try:
+        ws = get_ws()
+        return ws.get_all_values() if ws else None
+    except Exception as e:
+        print(f"[ERROR] Failed to read {label} sheet: {e}")
+        return None
+
+def get_calendar(force_refresh=False):
+    """
+    Holidays and doctor leaves, indexed for O(1) lookups.
+
+    - Both sheets are read together at most once per TTL.
+    - admin_add/delete_leave and admin_add/delete_holiday call
+      invalidate_calendar_cache() so their changes show up at once.
+    - If a read fails, the previous rows are kept until the next refresh.
+    """
+    global CALENDAR_CACHE
+
+    now = time.time()
+    if (
+        not force_refresh
+        and CALENDAR_CACHE["holidays"] is not None
+        and (now - CALENDAR_CACHE["ts"]) < CALENDAR_CACHE["ttl"]
+    ):
+        return CALENDAR_CACHE
+
+    holiday_rows = _read_calendar_rows(get_holiday_worksheet, "ClinicHolidays")
+    if holiday_rows is None:
+        holiday_rows = CALENDAR_CACHE["holiday_rows"]
+    leave_rows = _read_calendar_rows(get_leave_worksheet, "Leave")
+    if leave_rows is None:
+        leave_rows = CALENDAR_CACHE["leave_rows"]
+
+    holidays = {}
+    for row in holiday_rows[1:]:
+        if not row: continue
+        r_date = str(row[0]).strip()
+        if r_date and r_date not in holidays:
+            holidays[r_date] = str(row[1]).strip() if len(row) > 1 else "General Holiday"
+
+    leaves = {}
+    if leave_rows:
+        headers = leave_rows[0]
+        for row in leave_rows[1:]:
+            if not row or len(row) < 3: continue
+            row_dict = dict(zip(headers, row))
+            key = (
+                str(row_dict.get("DoctorName", "")).strip().lower(),
+                str(row_dict.get("Specialization", "")).strip().lower(),
+                str(row_dict.get("Date", "")).strip()
+            )
+            if key not in leaves:
+                leaves[key] = row_dict.get("Reason", "Temporary Leave")
+
+    CALENDAR_CACHE = {
+        "holidays": holidays,
+        "leaves": leaves,
+        "holiday_rows": holiday_rows,
+        "leave_rows": leave_rows,
+        "ts": now,
+        "ttl": CALENDAR_CACHE["ttl"]
+    }
+    return CALENDAR_CACHE
+
+def invalidate_calendar_cache():
+    CALENDAR_CACHE["ts"] = 0.0
+    invalidate_live_snapshot()
+
 # ===================== Leave helpers =====================
 
 def is_clinic_holiday(date_str):
@@ -452,39 +872,11 @@ def is_clinic_holiday(date_str):
     Check if the specific date exists in ClinicHolidays sheet.
     Returns (True, Reason) or (False, None)
     """
-    try:
-        ws = get_holiday_worksheet()
-        all_vals = ws.get_all_values()
-        if not all_vals or len(all_vals) <= 1:
-            return False, None
-        
-        for row in all_vals[1:]:
-            if not row: continue
-            r_date = str(row[0]).strip()
-            if r_date == date_str:
-                reason = "General Holiday"
-                if len(row) > 1: reason = str(row[1]).strip()
-                return True, reason
-    except Exception as e:
-        print(f"[ERROR] is_clinic_holiday check failed: {e}")
+    reason = get_calendar()["holidays"].get((date_str or "").strip())
+    if reason is not None:
+        return True, reason
     return False, None
 
-def get_holiday_worksheet():
-    """Return 'ClinicHolidays' worksheet, create if missing, ensure headers."""
-    try:
-        ws = main_sheet.worksheet("ClinicHolidays")
-        # Ensure headers if sheet is empty
-        if not ws.get_all_values():
-            ws.append_row(["Date", "Reason"])
-        return ws
-    except gspread.exceptions.WorksheetNotFound:
-        ws = main_sheet.add_worksheet(title="ClinicHolidays", rows="100", cols="2")
-        ws.append_row(["Date", "Reason"])
-        return ws
-    except Exception as e:
-        print(f"[ERROR] get_holiday_worksheet failed: {e}")
-        return None
-
 def get_holiday_display_message(date_str, reason):
     """
     Returns a dynamic message like 'Clinic is on leave Today - Reason'
@@ -501,6 +893,15 @@ def get_holiday_display_message(date_str, reason):
     
     return f"{prefix} - {reason}"
 
+def get_doctor_leave_reason(doctor_name, specialization, date_str):
+    """Reason for a doctor's leave on this date, or None."""
+    key = (
+        (doctor_name or "").strip().lower(),
+        (specialization or "").strip().lower(),
+        (date_str or "").strip()
+    )
+    return get_calendar()["leaves"].get(key)
+
 def is_doctor_on_leave(doctor_name, specialization, date_str):
     """
     Check Leave sheet for this doctor + specialization + YYYY-MM-DD date.
@@ -513,29 +914,9 @@ def is_doctor_on_leave(doctor_name, specialization, date_str):
         return True, get_holiday_display_message(date_str, reason)
 
     # 2. Check Doctor-specific leave
-    try:
-        ws = get_leave_worksheet()
-        all_vals = ws.get_all_values()
-        if not all_vals or len(all_vals) <= 1:
-            return False, None
-
-        dn = (doctor_name or "").strip().lower()
-        sp = (specialization or "").strip().lower()
-        
-        headers = all_vals[0]
-        for row in all_vals[1:]:
-            if not row or len(row) < 3: continue
-            row_dict = dict(zip(headers, row))
-            
-            r_name = str(row_dict.get("DoctorName", "")).strip().lower()
-            r_spec = str(row_dict.get("Specialization", "")).strip().lower()
-            r_date = str(row_dict.get("Date", "")).strip()
-            
-            if r_name == dn and r_spec == sp and r_date == date_str:
-                reason = row_dict.get("Reason", "Temporary Leave")
-                return True, f"{doctor_name} is on leave on {date_str} ({reason})."
-    except Exception as e:
-        print(f"[ERROR] is_doctor_on_leave check failed: {e}")
+    reason = get_doctor_leave_reason(doctor_name, specialization, date_str)
+    if reason is not None:
+        return True, f"{doctor_name} is on leave on {date_str} ({reason})."
 
     return False, None
 
@@ -655,30 +1036,28 @@ def get_otp_html(otp):
 # ===================== Misc helpers =====================
 
 def setup_doctor(creds, main_sheet_id, doctor_name, specialization):
-    client_local = gspread.authorize(creds)
-    main_sheet_local = client_local.open_by_key(main_sheet_id)
+    main_sheet_local = sheets_pool.open_by_key(main_sheet_id)
     main_worksheet = main_sheet_local.sheet1
 
     doctor_sheet_title = f"{doctor_name} - {specialization}"
-    new_sheet = client_local.create(doctor_sheet_title)
+    new_sheet = sheets_pool.adopt(sheets_pool.client.create(doctor_sheet_title))
     new_sheet.share(ADMIN_EMAIL, perm_type='user', role='writer')
     doctor_link = f"https://docs.google.com/spreadsheets/d/{new_sheet.id}/edit"
 
     main_worksheet.append_row([doctor_name, specialization, doctor_link])
 
     ws = new_sheet.sheet1
-    ws.update('A1', 'Doctor Name')
-    ws.update('B1', doctor_name)
-    ws.update('A2', 'Specialization')
-    ws.update('B2', specialization)
+    SheetBatch(ws).set_rows(1, [
+        ['Doctor Name', doctor_name],
+        ['Specialization', specialization],
+    ]).commit()
 
     print(f"[SUCCESS] Created sheet for {doctor_name} - link: {doctor_link}")
     return new_sheet
 
 
 def add_booking(creds, doctor_sheet_id, patient_name, date_str, time, reason):
-    client_local = gspread.authorize(creds)
-    doctor_sheet = client_local.open_by_key(doctor_sheet_id)
+    doctor_sheet = sheets_pool.open_by_key(doctor_sheet_id)
 
     tab_name = date_str
     try:
@@ -696,22 +1075,33 @@ import time
 from gspread.exceptions import APIError
 
 DOCTOR_CACHE = {
-    "data": None,
+    "data": None,  # DoctorDirectory
     "ts": 0.0,   # timestamp of last fetch
     "ttl": 30.0  # seconds to keep cache
 }
 
-def get_all_doctors(force_refresh=False):
+EMPTY_DIRECTORY = DoctorDirectory([], version=0)
+
+def _store_directory(doctors, now):
+    """Cache a new DoctorDirectory; the version only moves when the roster changed."""
+    global DOCTOR_CACHE
+    current = DOCTOR_CACHE["data"]
+    if current is not None and current.doctors == doctors:
+        directory = current
+    else:
+        directory = DoctorDirectory(doctors, version=(current.version + 1) if current else 1)
+    DOCTOR_CACHE = {"data": directory, "ts": now, "ttl": DOCTOR_CACHE["ttl"]}
+    return directory
+
+def get_doctor_directory(force_refresh=False):
     """
-    Fetch all doctors from the Google Sheet.
+    Fetch all doctors from the Google Sheet as an indexed DoctorDirectory.
 
     - Uses in-memory cache for ~30 seconds to avoid hitting
       Sheets quota too often.
     - Uses only ONE get_all_values() call instead of
       get_all_values + get_all_records().
     """
-    global DOCTOR_CACHE
-
     now = time.time()
     # Return cached data if still fresh
     if (
@@ -723,22 +1113,21 @@ def get_all_doctors(force_refresh=False):
 
     try:
         if not doctors_ws:
-            return []
+            return EMPTY_DIRECTORY
         rows = doctors_ws.get_all_values()  # single read
     except APIError as e:
         app.logger.error(f"Error reading Doctors sheet: {e}")
         # On error, do NOT crash; just return empty list
-        return []
+        return EMPTY_DIRECTORY
 
     if not rows or len(rows) < 2:
-        DOCTOR_CACHE = {"data": [], "ts": now, "ttl": DOCTOR_CACHE["ttl"]}
-        return []
+        return _store_directory([], now)
 
     headers = rows[0]
     data_rows = rows[1:]
 
     # Build records from headers + rows (replacement for get_all_records)
-    raw_records = [dict(zip(headers, row)) for row in data_rows]
+    raw_records = [dict(zip(headers, row)) for row in data_rows if any(str(v).strip() for v in row)]
 
     doctors = []
     day_names = ["Monday", "Tuesday", "Wednesday", "Thursday",
@@ -780,8 +1169,11 @@ def get_all_doctors(force_refresh=False):
             "Email": (rec.get("Email", "") or "").strip()
         })
 
-    DOCTOR_CACHE = {"data": doctors, "ts": now, "ttl": DOCTOR_CACHE["ttl"]}
-    return doctors
+    return _store_directory(doctors, now)
+
+def get_all_doctors(force_refresh=False):
+    """Flat list of doctor dicts (see get_doctor_directory for indexed lookups)."""
+    return get_doctor_directory(force_refresh).doctors
 
 
 
@@ -799,16 +1191,7 @@ def get_weekday(date_str):
 
 def doctors_available_on(date_str, specialization=None):
     weekday = get_weekday(date_str)
-    all_docs = get_all_doctors()
-    result = []
-    for doc in all_docs:
-        if weekday in doc["Days"]:
-            if specialization:
-                if doc["Specialization"] == specialization:
-                    result.append(doc)
-            else:
-                result.append(doc)
-    return result
+    return get_doctor_directory().working_on(weekday, specialization)
 
 
 def token_for_date(sheet, date_str):
@@ -920,7 +1303,7 @@ def home():
         # Check if any booking exists for today or future
         upcoming = PatientBooking.query.filter(
             PatientBooking.user_id == user_id,
-            PatientBooking.date >= today_str
+            PatientBooking.booking_date >= as_date(today_str)
         ).first()
         has_upcoming = upcoming is not None
         
@@ -934,93 +1317,19 @@ def booking():
     
     upcoming_bookings = []
     past_bookings = []
+    past_total = 0
+    past_next_cursor = None
     
     if user_id:
         try:
-            # Get local bookings
-            bookings = PatientBooking.query.filter_by(user_id=user_id).order_by(PatientBooking.date.desc()).all()
-            
-            # Split into upcoming and past
-            # Fetch all doctors to check schedules
-            all_docs = get_all_doctors()
-            docs_map = { d.get("Name","").lower().strip(): d for d in all_docs }
-            
-            ist = pytz.timezone('Asia/Kolkata')
-            now_ist = datetime.now(ist)
-            today_str = now_ist.strftime("%Y-%m-%d")
-            weekday = now_ist.strftime("%A")
-            current_time_str = now_ist.strftime("%H:%M")
-            
-            for b in bookings:
-                b.is_skipped = False
-                b_date = b.date or ""
-                is_past = False
-                
-                if b_date < today_str:
-                    is_past = True
-                elif b_date == today_str:
-                    # Check Session Status
-                    doc_session = DoctorSession.query.filter(
-                        db.func.lower(db.func.trim(DoctorSession.doctor_name)) == b.doctor_name.lower().strip(),
-                        db.func.lower(db.func.trim(DoctorSession.specialization)) == b.specialization.lower().strip()
-                    ).first()
-                    
-                    is_skipped = False
-                    if doc_session and doc_session.session_date == today_str:
-                        # Attach dynamic data for live sync on the dashboard
-                        b.live_token = doc_session.current_token
-                        b.live_status = doc_session.status
-                        
-                        # Time-aware logic: Get scheduled start
-                        doc_data = docs_map.get(b.doctor_name.lower().strip())
-                        b.sched_start = "00:00"
-                        if doc_data:
-                            day_times = doc_data.get("DayTimes", {})
-                            time_range = day_times.get(weekday, "")
-                            if "-" in time_range:
-                                b.sched_start = time_range.replace(" ", "").split("-")[0].strip()
-                        
-                        # Flag if schedule has begun
-                        b.is_start_time_passed = (current_time_str >= b.sched_start)
-                        
-                        # Determine if skipped
-                        skipped_tokens = doc_session.skipped_tokens.strip().split(',') if doc_session.skipped_tokens else []
-                        if str(b.token) in skipped_tokens:
-                            is_skipped = True
-                            b.is_skipped = True
-                        
-                        if is_skipped:
-                            if doc_session.status == 'completed':
-                                is_past = True
-                        else:
-                            if doc_session.status == 'completed':
-                                is_past = True
-                            elif doc_session.current_token > b.token:
-                                is_past = True
-                    
-                    # Check End Time
-                    doc_data = docs_map.get(b.doctor_name.lower().strip())
-                    if not is_past and doc_data:
-                        day_times = doc_data.get("DayTimes", {})
-                        time_range = day_times.get(weekday, "")
-                        if "-" in time_range:
-                            try:
-                                end_time_str = time_range.replace(" ", "").split("-")[1].strip()
-                                # Compare HH:MM strings directly
-                                if current_time_str > end_time_str:
-                                    is_past = True
-                            except: pass
-                
-                if is_past:
-                    past_bookings.append(b)
-                else:
-                    upcoming_bookings.append(b)
-
-            # Note: bookings are already ordered by date DESC from the query
-            # but we want upcoming to be soonest first (and they are already sorted by date desc)
-            # Sort: Upcoming (First coming first), Past (Most recent first)
-            upcoming_bookings.sort(key=lambda x: (1 if x.status == 'cancelled' else 0, x.date or "", x.token or 0))
-            past_bookings.sort(key=lambda x: (x.date or "", x.token or 0), reverse=True)
+            # Skipped tokens stay in "Upcoming" here until the session ends
+            page = load_user_bookings(
+                PatientBooking, DoctorSession, user_id, get_doctor_directory(),
+                datetime.now(pytz.timezone('Asia/Kolkata')),
+                past_before=request.args.get('past_before'), skipped_stays_upcoming=True
+            )
+            upcoming_bookings, past_bookings = page.upcoming, page.past
+            past_total, past_next_cursor = page.past_total, page.past_next
         except Exception as e:
             print(f"[ERROR] Failed to fetch user bookings: {e}")
 
@@ -1032,6 +1341,8 @@ def booking():
                            user_id=user_id,
                            upcoming_bookings=upcoming_bookings,
                            past_bookings=past_bookings,
+                           past_total=past_total,
+                           past_next_cursor=past_next_cursor,
                            active_upcoming_count=active_upcoming_count)
 
 
@@ -1189,21 +1500,18 @@ def patient_login():
         # If not in local DB, check mapping directly from Google Sheets
         if not doc_session:
             try:
-                all_docs = get_all_doctors()
-                for sheet_doc in all_docs:
-                    sheet_email = sheet_doc.get("Email", "").strip().lower()
-                    if sheet_email == email:
-                        # Re-sync doctor automatically
-                        doc_session = DoctorSession(
-                            doctor_name=sheet_doc.get("Name", "").strip(),
-                            specialization=sheet_doc.get("Specialization", "").strip(),
-                            email=email
-                        )
-                        db.session.add(doc_session)
-                        if user.role != "doctor":
-                            user.role = "doctor"
-                        db.session.commit()
-                        break
+                sheet_doc = get_doctor_directory().find_by_email(email)
+                if sheet_doc:
+                    # Re-sync doctor automatically
+                    doc_session = DoctorSession(
+                        doctor_name=sheet_doc.get("Name", "").strip(),
+                        specialization=sheet_doc.get("Specialization", "").strip(),
+                        email=email
+                    )
+                    db.session.add(doc_session)
+                    if user.role != "doctor":
+                        user.role = "doctor"
+                    db.session.commit()
             except Exception as e:
                 pass
 
@@ -1379,135 +1687,27 @@ def patient_dashboard():
     if not user_id:
         return redirect(url_for('home'))
 
-    # Get local bookings
-    bookings = PatientBooking.query.filter_by(user_id=user_id).order_by(PatientBooking.date.desc()).all()
-    # Split into upcoming and past using Intelligent Logic
-    all_doctors = []
-    try: all_doctors = get_all_doctors()
-    except: pass
-    docs_map = { d.get("Name","").lower().strip(): d for d in all_doctors }
-    
-    ist = pytz.timezone('Asia/Kolkata')
-    now_ist = datetime.now(ist)
-    today_str = now_ist.strftime("%Y-%m-%d")
-    weekday = now_ist.strftime("%A")
-    current_time_str = now_ist.strftime("%H:%M")
-    
-    upcoming_bookings = []
-    past_bookings = []
-    
-    for b in bookings:
-        b.is_skipped = False
-        b.is_missed = False
-        b_date = b.date or ""
-        # Normalize b_date to YYYY-MM-DD format for reliable comparison
-        b_date_norm = b_date
-        try:
-            b_date_norm = datetime.strptime(b_date, "%d-%m-%Y").strftime("%Y-%m-%d")
-        except ValueError:
-            pass
-            
-        is_past = False
-        
-        if b_date_norm < today_str:
-            is_past = True
-        elif b_date_norm == today_str:
-            # Check Session Status
-            b_doc_name = (b.doctor_name or "").strip()
-            b_spec = (b.specialization or "").strip()
-            
-            doc_session = None
-            if b_doc_name and b_spec:
-                doc_session = DoctorSession.query.filter(
-                    db.func.lower(db.func.trim(DoctorSession.doctor_name)) == b_doc_name.lower(),
-                    db.func.lower(db.func.trim(DoctorSession.specialization)) == b_spec.lower(),
-                    DoctorSession.session_date == today_str
-                ).first()
-            
-            is_skipped = False
-            if doc_session and doc_session.session_date == today_str:
-                # Attach for Live Sync
-                b.live_token = doc_session.current_token
-                b.live_status = doc_session.status
-                
-                # Sched Start logic
-                doc_data = docs_map.get(b_doc_name.lower())
-                b.sched_start = "00:00"
-                if doc_data:
-                    tr = doc_data.get("DayTimes",{}).get(weekday,"")
-                    if "-" in tr: b.sched_start = tr.replace(" ", "").split("-")[0].strip()
-                b.is_start_time_passed = (current_time_str >= b.sched_start)
-
-                # Determine if skipped (by doctor) or missed (doctor silently passed without skip)
-                skipped_tokens = doc_session.skipped_tokens.strip().split(',') if doc_session.skipped_tokens else []
-                b.is_missed = False
-                if str(b.token) in skipped_tokens:
-                    is_skipped = True
-                    b.is_skipped = True
-                elif doc_session.current_token > b.token and b.status != 'cancelled':
-                    # Token was silently bypassed — treat as missed/unconsulted
-                    b.is_missed = True
-
-                if is_skipped or b.is_missed:
-                    if doc_session.status == 'completed' or doc_session.current_token > b.token:
-                        is_past = True
-                else:
-                    if doc_session.status == 'completed':
-                        is_past = True
-                    elif doc_session.current_token > b.token:
-                        is_past = True
-            
-            # Check End Time
-            doc_data = docs_map.get(b_doc_name.lower())
-            if not is_past and doc_data:
-                day_times = doc_data.get("DayTimes", {})
-                time_range = day_times.get(weekday, "")
-                if "-" in time_range:
-                    try:
-                        end_time_str = time_range.replace(" ", "").split("-")[1].strip()
-                        if current_time_str > end_time_str: is_past = True
-                    except: pass
-        
-        if is_past: past_bookings.append(b)
-        else: upcoming_bookings.append(b)
+    try: directory = get_doctor_directory()
+    except: directory = EMPTY_DIRECTORY
 
-    # Sort
-    upcoming_bookings.sort(key=lambda x: (1 if x.status == 'cancelled' else 0, x.date or "", x.token or 0))
-    past_bookings.sort(key=lambda x: (x.date or "", x.token or 0), reverse=True)
+    page = load_user_bookings(
+        PatientBooking, DoctorSession, user_id, directory,
+        datetime.now(pytz.timezone('Asia/Kolkata')),
+        past_before=request.args.get('past_before')
+    )
+    upcoming_bookings, past_bookings = page.upcoming, page.past
     
-    # Enrichment: Holidays (Keeping existing logic for holidays)
+    # Enrichment: Holidays and Doctor Leaves (served from the calendar cache)
     try:
-        holiday_ws = get_holiday_worksheet()
-        h_data = holiday_ws.get_all_records()
+        holidays = get_calendar()["holidays"]
         for b in upcoming_bookings:
-            reason = None
-            for h in h_data:
-                if (h.get("Date") or "").strip() == b.date:
-                    reason = (h.get("Reason") or "General Holiday").strip()
-                    break
+            reason = holidays.get((b.date or "").strip())
             b.is_holiday = reason is not None
-            b.holiday_reason = reason
-    except: pass
+            b.holiday_reason = (reason or "General Holiday") if b.is_holiday else None
 
-    # Enrichment: Doctor Leaves
-    try:
-        leave_ws = get_leave_worksheet()
-        l_data = leave_ws.get_all_records()
-        for b in upcoming_bookings:
-            b_doc_name = (b.doctor_name or "").strip().lower()
-            b_spec = (b.specialization or "").strip().lower()
-            b_date = (b.date or "").strip()
-            
-            leave_reason = None
-            for l in l_data:
-                l_name = str(l.get("DoctorName", "")).strip().lower()
-                l_spec = str(l.get("Specialization", "")).strip().lower()
-                l_date = str(l.get("Date", "")).strip()
-                if l_name == b_doc_name and l_spec == b_spec and l_date == b_date:
-                    leave_reason = (l.get("Reason") or "Temporary Leave").strip()
-                    break
+            leave_reason = get_doctor_leave_reason(b.doctor_name, b.specialization, b.date)
             b.is_doctor_on_leave = leave_reason is not None
-            b.doctor_leave_reason = leave_reason
+            b.doctor_leave_reason = (leave_reason or "Temporary Leave").strip() if b.is_doctor_on_leave else None
     except: pass
 
     active_upcoming_count = sum(1 for b in upcoming_bookings if b.status != 'cancelled')
@@ -1518,24 +1718,29 @@ def patient_dashboard():
     # Fetch pending referrals
     referrals = DoctorReferral.query.filter_by(user_id=user_id, status='pending').order_by(DoctorReferral.created_at.desc()).all()
 
-    # Query all referrals for this user to attach to bookings
-    all_user_referrals = DoctorReferral.query.filter_by(user_id=user_id).all()
-    booking_referral_map = {ref.booking_id: ref for ref in all_user_referrals if ref.booking_id}
+    # Referrals for the bookings on this page only
+    page_booking_ids = [b.id for b in upcoming_bookings] + [b.id for b in past_bookings]
+    page_referrals = DoctorReferral.query.filter(
+        DoctorReferral.user_id == user_id,
+        DoctorReferral.booking_id.in_(page_booking_ids)
+    ).all() if page_booking_ids else []
+    booking_referral_map = {ref.booking_id: ref for ref in page_referrals}
     
     for b in upcoming_bookings:
         b.referral = booking_referral_map.get(b.id)
     for b in past_bookings:
         b.referral = booking_referral_map.get(b.id)
 
-    user_email = session.get('user_email')
-    is_doctor = DoctorSession.query.filter_by(email=user_email).first() is not None
+    is_doctor = user_can_switch(refresh=True)
 
     return render_template('patient_dashboard.html', 
                            upcoming_bookings=upcoming_bookings,
                            past_bookings=past_bookings,
+                           past_total=page.past_total,
+                           past_next_cursor=page.past_next,
                            active_upcoming_count=active_upcoming_count,
                            prescriptions=prescriptions, 
-                           all_doctors=all_doctors,
+                           all_doctors=directory.doctors,
                            referrals=referrals,
                            can_switch=is_doctor)
 
@@ -1582,10 +1787,11 @@ def create_referral():
     today_str = datetime.now(ist).strftime("%Y-%m-%d")
     
     booking = PatientBooking.query.filter(
-        db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-        db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-        PatientBooking.date == today_str,
-        PatientBooking.token == int(token)
+        PatientBooking.doctor_key == normalize_key(doc_session.doctor_name),
+        PatientBooking.spec_key == normalize_key(doc_session.specialization),
+        PatientBooking.booking_date == as_date(today_str),
+        PatientBooking.token == int(token),
+        PatientBooking.status != 'cancelled'
     ).first()
 
     if not booking:
@@ -1646,44 +1852,20 @@ def cancel_own_booking():
 
     data = request.get_json()
     db_id = data.get('id')
-    sheet_url = data.get('sheet_url')
-    date_str = data.get('date')
-    token_str = data.get('token')
 
     booking = PatientBooking.query.filter_by(id=db_id, user_id=user_id).first()
     if not booking:
         return jsonify(success=False, msg="Booking not found in your account")
 
-    # Cancel in Google Sheet
-    try:
-        spreadsheet = client.open_by_url(sheet_url)
-        formatted_date = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%m-%Y")
-        worksheet = spreadsheet.worksheet(formatted_date)
-        
-        rows = worksheet.get_all_values()
-        if rows:
-            data_rows = rows[1:]
-            row_to_delete = None
-            for i, row in enumerate(data_rows):
-                if row and str(row[0]).strip() == str(token_str).strip():
-                    row_to_delete = i + 2
-                    break
-            
-            if row_to_delete:
-                total_rows = len(rows)
-                if row_to_delete == total_rows:
-                    worksheet.delete_rows(row_to_delete)
-                else:
-                    range_to_clear = f"B{row_to_delete}:F{row_to_delete}"
-                    worksheet.update(range_to_clear, [["", "", "", "", ""]])
-    except Exception as e:
-        app.logger.error(f"Error cancelling sheet booking: {e}")
-        # Even if sheet cleanup fails (e.g., date tab already deleted), we still remove from local DB
     # Update status to cancelled in local DB
     booking.status = 'cancelled'
     booking.cancelled_by = 'user'
     booking.cancelled_at = datetime.now(pytz.timezone('Asia/Kolkata')).strftime("%Y-%m-%d %H:%M:%S")
+    # The replicator blanks the row in the Google Sheet
+    booking.sync_state = 'pending'
     db.session.commit()
+    sheet_replicator.notify()
+    publish_booking_event(booking, "cancelled")
     return jsonify(success=True, msg="Booking cancelled successfully")
 
 @app.route('/add_prescription', methods=['POST'])
@@ -1874,7 +2056,7 @@ def admin_add_doctor():
                 })
 
         # Create personal sheet for this doctor
-        new_doc = client.create(sheet_title)
+        new_doc = sheets_pool.adopt(client.create(sheet_title))
         new_doc.share(YOUR_EMAIL, perm_type='user', role='writer')
         new_sheet = new_doc.sheet1
         new_sheet.update(
@@ -1982,7 +2164,7 @@ def admin_edit_doctor():
             # Check SQLite uniqueness (Safety layer)
             other_session = DoctorSession.query.filter(
                 DoctorSession.email == email_lower,
-                (db.func.lower(db.func.trim(DoctorSession.doctor_name)) != name) | (db.func.lower(db.func.trim(DoctorSession.specialization)) != spec)
+                (DoctorSession.doctor_key != name) | (DoctorSession.spec_key != spec)
             ).first()
             if other_session:
                  return jsonify({"success": False, "msg": f"Email is already assigned to {other_session.doctor_name} in system database."})
@@ -2003,8 +2185,8 @@ def admin_edit_doctor():
                     
                     # Update SQLite (Finding existing or syncing missing)
                     doc_session = DoctorSession.query.filter(
-                        db.func.lower(db.func.trim(DoctorSession.doctor_name)) == row_dict.get("Name", "").strip().lower(),
-                        db.func.lower(db.func.trim(DoctorSession.specialization)) == row_dict.get("Specialization", "").strip().lower()
+                        DoctorSession.doctor_key == normalize_key(row_dict.get("Name", "")),
+                        DoctorSession.spec_key == normalize_key(row_dict.get("Specialization", ""))
                     ).first()
                     
                     if doc_session:
@@ -2041,11 +2223,10 @@ def admin_edit_doctor():
         if not updated:
             return jsonify({"success": False, "msg": "Doctor metadata not found in sheet"})
 
-        doctors_ws.clear()
-        doctors_ws.append_row(headers)
         for i, row in enumerate(new_rows):
             row[0] = str(i + 1)  # keep serial numbers
-            doctors_ws.append_row(row)
+        # Rewrite the roster in one request so readers never see it half-written
+        SheetBatch(doctors_ws).replace_table([headers] + new_rows, previous_rows=len(all_rows)).commit()
 
         return jsonify({"success": True, "msg": "Doctor updated and credentials synchronized successfully"})
 
@@ -2106,11 +2287,11 @@ def admin_delete_doctor():
                 # We continue since sheet deletion is the primary goal, 
                 # but we log the error.
 
-        doctors_ws.clear()
-        doctors_ws.append_row(headers)
         for i, row in enumerate(updated_rows):
             row[0] = i + 1
-            doctors_ws.append_row(row)
+        # Rewrite the roster in one request; the freed last row is blanked in the same write
+        SheetBatch(doctors_ws).replace_table([headers] + updated_rows, previous_rows=len(doctors_data),
+                                             previous_width=len(headers)).commit()
 
         return jsonify({'success': True, 'msg': 'Doctor deleted successfully and login roles synchronized.'})
 
@@ -2163,6 +2344,7 @@ def admin_add_leave():
                 })
 
     leave_ws.append_row([doctor_name, specialization, date_str, reason])
+    invalidate_calendar_cache()
 
     # Trigger web push notification for patients whose appointments are affected
     try:
@@ -2275,10 +2457,8 @@ def admin_delete_leave():
     if not removed:
         return jsonify({"success": False, "msg": "No matching leave entry found."})
 
-    leave_ws.clear()
-    leave_ws.append_row(headers)
-    for row in new_rows:
-        leave_ws.append_row(row)
+    SheetBatch(leave_ws).replace_table([headers] + new_rows, previous_rows=len(all_rows)).commit()
+    invalidate_calendar_cache()
 
     # Trigger doctor leave cancellation push notification
     try:
@@ -2338,6 +2518,7 @@ def admin_add_holiday():
             return jsonify({"success": False, "msg": f"Skipped: Date(s) already marked as holidays ({skipped_count} skipped)."})
         
         holiday_ws.append_rows(new_entries)
+        invalidate_calendar_cache()
 
         # Trigger web push notification for patients whose appointments are affected by the holiday(s)
         try:
@@ -2497,6 +2678,7 @@ def admin_toggle_ticker_solo():
     
     setting.value = "enabled" if is_solo else "disabled"
     db.session.commit()
+    invalidate_settings_cache()
     return jsonify({"success": True, "is_solo": is_solo})
 
 @app.route("/admin_get_ticker_messages", methods=["GET"])
@@ -2505,8 +2687,7 @@ def admin_get_ticker_messages():
         return jsonify({"success": False, "msg": "Unauthorized"})
     
     msgs = TickerMessage.query.order_by(TickerMessage.created_at.desc()).all()
-    solo_setting = AppSettings.query.filter_by(key="ticker_solo_mode").first()
-    is_solo = solo_setting.value == "enabled" if solo_setting else False
+    is_solo = get_setting_value("ticker_solo_mode") == "enabled"
     
     ist = pytz.timezone('Asia/Kolkata')
     now_naive = datetime.now(ist).replace(tzinfo=None)
@@ -2557,8 +2738,8 @@ def admin_delete_holiday():
         new_rows.append(row)
     
     if found:
-        holiday_ws.clear()
-        holiday_ws.update("A1", new_rows)
+        SheetBatch(holiday_ws).replace_table(new_rows, previous_rows=len(all_rows)).commit()
+        invalidate_calendar_cache()
         
         # Trigger clinic holiday cancellation push notification
         try:
@@ -2595,6 +2776,7 @@ def admin_save_settings():
     
     try:
         db.session.commit()
+        invalidate_settings_cache()
         return jsonify({"success": True, "msg": "Settings saved successfully"})
     except Exception as e:
         db.session.rollback()
@@ -2689,6 +2871,7 @@ def admin_set_login_setting():
         setting.value = '1' if enabled else '0'
     try:
         db.session.commit()
+        invalidate_settings_cache()
         return jsonify({"success": True})
     except Exception as e:
         db.session.rollback()
@@ -2788,14 +2971,7 @@ def get_doctors():
 
 @app.route("/get_specializations")
 def get_specializations():
-    doctors = get_all_doctors()
-    specs = set()
-    for doc in doctors:
-        spec = doc.get("Specialization", "").strip()
-        if spec:
-            specs.add(spec)
-    sorted_specs = sorted(specs, key=lambda s: s.lower())
-    return jsonify(sorted_specs)
+    return jsonify(get_doctor_directory().specializations)
 
 
 @app.route("/get_doctor_pairs")
@@ -2891,127 +3067,204 @@ def sync_doctors_from_sheet():
 
 # ===================== Booking helpers & routes =====================
 
-def get_or_create_date_sheet(sheet, date_str):
-    formatted_date = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%m-%Y")
-    try:
-        worksheet = sheet.worksheet(formatted_date)
-    except gspread.exceptions.WorksheetNotFound:
-        worksheet = sheet.add_worksheet(title=formatted_date, rows="100", cols="10")
-        worksheet.append_row(["Token", "Name", "Age", "Gender", "Phone_Number", "Date"])
-    return worksheet
+def open_doctor_spreadsheet(sheet_url):
+    if client is None:
+        raise RuntimeError("Google Sheets is not connected")
+    return sheets_pool.open_by_url(sheet_url)
+
+def get_guest_user_id():
+    guest_user = User.query.filter_by(email="guest@primecare.com").first()
+    return guest_user.id if guest_user else None
+
+# Bookings are written to the local DB first; this pushes them to the doctor sheets
+sheet_replicator = SheetReplicator(
+    app, db, PatientBooking, open_doctor_spreadsheet,
+    forget_spreadsheet=sheets_pool.invalidate,
+    list_doctors=get_all_doctors,
+    guest_user_id=get_guest_user_id,
+    interval=int(os.environ.get("SHEET_SYNC_INTERVAL", "30")),
+    reconcile_interval=int(os.environ.get("SHEET_RECONCILE_INTERVAL", "3600"))
+)
 
+# Archives old date tabs into the DB and deletes them, off the booking path
+sheet_maintenance = SheetMaintenance(
+    app, sheet_replicator, get_all_doctors,
+    keep_last_n=int(os.environ.get("SHEET_KEEP_DATE_TABS", "4")),
+    interval=int(os.environ.get("SHEET_MAINTENANCE_INTERVAL", str(6 * 3600)))
+)
 
+def request_idempotency_key(specialization, date_str, name, age, gender, phone_number, doctor_name=None):
+    """booking_idempotency_key() for the current request, honouring an Idempotency-Key header."""
+    client_key = request.headers.get("Idempotency-Key") or (request.get_json(silent=True) or {}).get("idempotency_key")
+    return booking_idempotency_key(specialization, date_str, name, age, gender, phone_number,
+                                   client_key=str(client_key)[:200] if client_key else None,
+                                   doctor_name=doctor_name)
 
-def increment_booking_counter():
-    stats_ws = main_sheet.worksheet("BookingStats")
-    current = int(stats_ws.acell("A2").value)
-    stats_ws.update("A2", str(current + 1))
+def find_booking_by_key(idempotency_key):
+    """The confirmed booking created by an earlier submission with this key, if any."""
+    if not idempotency_key:
+        return None
+    return PatientBooking.query.filter_by(idempotency_key=idempotency_key).first()
 
-def get_filled_booking_count(ws):
-    """Counts rows where the Patient Name (Column B) is not empty."""
-    try:
-        rows = ws.get_all_values()
-        if len(rows) <= 1:
-            return 0
-        # Column B (index 1) is where Patient Name is stored
-        return sum(1 for row in rows[1:] if len(row) > 1 and row[1].strip())
-    except Exception:
-        return 0
+def replay_booking_response(booking, date_str, name, age, gender, phone_number):
+    """Success response for a repeated submission, pointing at the original booking."""
+    return jsonify({
+        "success": True,
+        "token": booking.token,
+        "doctor": booking.doctor_name,
+        "specialization": booking.specialization,
+        "date": date_str,
+        "time": booking.time,
+        "name": name,
+        "age": age,
+        "gender": gender,
+        "phone": phone_number,
+        "redirect": url_for(
+            "confirmation_page",
+            token=booking.token,
+            doctor=booking.doctor_name,
+            specialization=booking.specialization,
+            date=date_str,
+            time=booking.time,
+            name=name,
+            age=age,
+            gender=gender,
+            phone=phone_number
+        )
+    })
+
+def count_active_bookings(doctor_name, specialization, date_str):
+    """Bookings that still hold a slot for this doctor on this date."""
+    return PatientBooking.query.filter(
+        PatientBooking.doctor_key == normalize_key(doctor_name),
+        PatientBooking.spec_key == normalize_key(specialization),
+        PatientBooking.booking_date == as_date(date_str),
+        PatientBooking.status != 'cancelled'
+    ).count()
+
+BOOKING_CAPACITY = 25  # active bookings per doctor per day
 
-def deduplicate_bookings(doctor_name, specialization, date, patient_name, sheet=None):
+def freed_booking_token(doctor_key, spec_key, day):
     """
-    Ensure only exact duplicate bookings (same patient name, age, gender, and phone number)
-    for the same doctor on the same date are removed.
+    Lowest cancelled token for this doctor/day that no live booking holds,
+    or None. On the day of a running session only tokens the doctor has not
+    reached yet are offered, so a reused slot is never already behind the queue.
     """
-    try:
-        if not sheet:
-            # Fallback if sheet is not accessible: deduplicate by patient name and age (the only columns in DB)
-            bookings = PatientBooking.query.filter(
-                db.func.lower(db.func.trim(PatientBooking.patient_name)) == patient_name.lower().strip(),
-                db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doctor_name.lower().strip(),
-                db.func.lower(db.func.trim(PatientBooking.specialization)) == specialization.lower().strip(),
-                PatientBooking.date == date,
-                PatientBooking.status == 'confirmed'
-            ).order_by(PatientBooking.id.asc()).all()
-
-            seen_ages = set()
-            duplicates_to_delete = []
-            for b in bookings:
-                b_age = str(b.age).strip()
-                if b_age in seen_ages:
-                    duplicates_to_delete.append(b)
-                else:
-                    seen_ages.add(b_age)
+    floor = 0
+    doc_session = DoctorSession.query.filter(
+        DoctorSession.doctor_key == doctor_key,
+        DoctorSession.spec_key == spec_key
+    ).first()
+    if doc_session and as_date(doc_session.session_date) == day:
+        floor = doc_session.current_token or 0
 
-            if duplicates_to_delete:
-                for dup in duplicates_to_delete:
-                    db.session.delete(dup)
-                db.session.commit()
-                print(f"[DEDUPLICATE] Fallback removed {len(duplicates_to_delete)} SQLite bookings for {patient_name} on {date}.")
-            return
+    same_day = (
+        PatientBooking.doctor_key == doctor_key,
+        PatientBooking.spec_key == spec_key,
+        PatientBooking.booking_date == day
+    )
+    live_tokens = db.session.query(PatientBooking.token).filter(*same_day, PatientBooking.status != 'cancelled')
+    return db.session.query(db.func.min(PatientBooking.token)).filter(
+        *same_day,
+        PatientBooking.status == 'cancelled',
+        PatientBooking.token > floor,
+        ~PatientBooking.token.in_(live_tokens)
+    ).scalar()
+
+def allocate_booking_token(doctor_name, specialization, date_str, capacity=BOOKING_CAPACITY):
+    """
+    Reserve a token for this doctor/date inside the current transaction.
+
+    - The TokenCounter row is locked first with UPDATE ... RETURNING and
+      stays locked until the caller commits, so concurrent bookings for the
+      same doctor and day are serialised and never share a token.
+    - The capacity check runs under that lock. Returns None when the day is
+      full; the caller must roll back to release the counter.
+    - A slot freed by a cancellation is handed out again (see
+      freed_booking_token). Token N always lives on sheet row N + 1, so the
+      new booking simply overwrites the blanked row. Otherwise the counter
+      moves past the highest stored token, which also covers rows adopted
+      from the sheet.
+    """
+    doctor_key, spec_key, day = normalize_key(doctor_name), normalize_key(specialization), as_date(date_str)
+    C = TokenCounter.__table__
+    insert = pg_insert if db.engine.dialect.name == "postgresql" else sqlite_insert
+    db.session.execute(
+        insert(C).values(doctor_key=doctor_key, spec_key=spec_key, booking_date=day, last_token=0)
+        .on_conflict_do_nothing(index_elements=[C.c.doctor_key, C.c.spec_key, C.c.booking_date])
+    )
 
-        # If sheet is provided:
-        rows = sheet.get_all_values()
-        if len(rows) <= 1:
-            return
+    this_counter = (C.c.doctor_key == doctor_key, C.c.spec_key == spec_key, C.c.booking_date == day)
+    highest = db.session.query(db.func.coalesce(db.func.max(PatientBooking.token), 0)).filter(
+        PatientBooking.doctor_key == doctor_key,
+        PatientBooking.spec_key == spec_key,
+        PatientBooking.booking_date == day
+    ).scalar_subquery()
+    db.session.execute(
+        C.update().where(*this_counter)
+        .values(last_token=db.case((highest > C.c.last_token, highest), else_=C.c.last_token))
+    )
 
-        headers = [h.strip().lower() for h in rows[0]]
-        name_idx = headers.index("name") if "name" in headers else 1
-        age_idx = headers.index("age") if "age" in headers else 2
-        gender_idx = headers.index("gender") if "gender" in headers else 3
-        phone_idx = headers.index("phone_number") if "phone_number" in headers else 4
-        token_idx = headers.index("token") if "token" in headers else 0
-
-        seen_keys = set()
-        rows_to_delete = []
-        deleted_tokens = set()
-
-        for idx, row in enumerate(rows[1:], start=2):
-            if len(row) > max(name_idx, age_idx, gender_idx, phone_idx):
-                r_name = row[name_idx].lower().strip()
-                r_age = str(row[age_idx]).strip()
-                r_gender = row[gender_idx].lower().strip()
-                r_phone = str(row[phone_idx]).strip()
-                
-                try:
-                    r_token = int(row[token_idx])
-                except ValueError:
-                    r_token = row[token_idx]
-
-                if r_name == patient_name.lower().strip():
-                    key = (r_name, r_age, r_gender, r_phone)
-                    if key in seen_keys:
-                        rows_to_delete.append(idx)
-                        deleted_tokens.add(r_token)
-                    else:
-                        seen_keys.add(key)
-
-        if rows_to_delete:
-            for row_idx in reversed(rows_to_delete):
-                sheet.delete_rows(row_idx)
-            print(f"[DEDUPLICATE] Removed {len(rows_to_delete)} duplicate Google Sheet rows for {patient_name} on {date}.")
-
-        if deleted_tokens:
-            bookings_to_delete = PatientBooking.query.filter(
-                db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doctor_name.lower().strip(),
-                db.func.lower(db.func.trim(PatientBooking.specialization)) == specialization.lower().strip(),
-                PatientBooking.date == date,
-                PatientBooking.token.in_(list(deleted_tokens)),
-                PatientBooking.status == 'confirmed'
-            ).all()
-            for b in bookings_to_delete:
-                db.session.delete(b)
-            db.session.commit()
-            print(f"[DEDUPLICATE] Removed {len(bookings_to_delete)} duplicate DB bookings for {patient_name} on {date}.")
+    if capacity is not None and count_active_bookings(doctor_name, specialization, date_str) >= capacity:
+        return None
 
-    except Exception as e:
+    token = freed_booking_token(doctor_key, spec_key, day)
+    if token is None:
+        token = db.session.execute(
+            C.update().where(*this_counter)
+            .values(last_token=C.c.last_token + 1)
+            .returning(C.c.last_token)
+        ).scalar()
+    return token
+
+def create_booking(doctor_info, date_str, time_for_booking, user_id, name, age, gender, phone_number,
+                   capacity=BOOKING_CAPACITY, idempotency_key=None):
+    """
+    Store a booking locally and queue it for the doctor's Google Sheet.
+    The sheet row is written by sheet_replicator, outside the request.
+    Returns None if the doctor's day filled up (capacity=None skips the limit).
+    If a concurrent submission with the same idempotency_key committed first,
+    that booking is returned with .replayed set.
+    """
+    token = allocate_booking_token(doctor_info["Name"], doctor_info["Specialization"], date_str, capacity)
+    if token is None:
         db.session.rollback()
-        print(f"[WARNING] Deduplication failed: {e}")
+        return None
 
-@app.route("/book_doctor", methods=["POST"])
-def book_doctor():
-    data = request.get_json()
-    sheet_url = data.get("sheetname")
+    new_booking = PatientBooking(
+        user_id=user_id,
+        doctor_name=doctor_info["Name"],
+        specialization=doctor_info["Specialization"],
+        date=date_str,
+        time=time_for_booking,
+        token=token,
+        sheet_url=doctor_info["SheetURL"],
+        patient_name=name,
+        age=age or "-",
+        gender=gender,
+        phone_number=phone_number,
+        sync_state="pending",
+        idempotency_key=idempotency_key
+    )
+    db.session.add(new_booking)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        existing = find_booking_by_key(idempotency_key)
+        if existing is None:
+            raise
+        existing.replayed = True
+        return existing
+    new_booking.replayed = False
+    sheet_replicator.notify()
+    publish_booking_event(new_booking, "booked")
+    return new_booking
+
+@app.route("/book_doctor", methods=["POST"])
+def book_doctor():
+    data = request.get_json()
+    sheet_url = data.get("sheetname")
     name = data.get("name")
     age = data.get("age")
     gender = data.get("gender")
@@ -3022,8 +3275,7 @@ def book_doctor():
         return jsonify({"success": False, "msg": "Missing fields"}), 400
 
     try:
-        doctor_info = next((doc for doc in get_all_doctors()
-                            if doc["SheetURL"] == sheet_url), None)
+        doctor_info = get_doctor_directory().find_by_url(sheet_url)
         if not doctor_info:
             return jsonify({"success": False, "msg": "Doctor not found."}), 404
 
@@ -3055,8 +3307,8 @@ def book_doctor():
                 ist_now = pytz.timezone('Asia/Kolkata')
                 today_chk = datetime.now(ist_now).strftime("%Y-%m-%d")
                 sess_chk = DoctorSession.query.filter(
-                    db.func.lower(db.func.trim(DoctorSession.doctor_name)) == doctor_info["Name"].lower().strip(),
-                    db.func.lower(db.func.trim(DoctorSession.specialization)) == doctor_info["Specialization"].lower().strip(),
+                    DoctorSession.doctor_key == normalize_key(doctor_info["Name"]),
+                    DoctorSession.spec_key == normalize_key(doctor_info["Specialization"]),
                     DoctorSession.session_date == today_chk,
                     DoctorSession.status == 'completed'
                 ).first()
@@ -3071,103 +3323,21 @@ def book_doctor():
         day_times = doctor_info.get("DayTimes", {})
         time_for_booking = day_times.get(weekday, "")
 
-        # ─── Server-Side Duplicate Booking Pre-Check & Deduplication ───
-        existing_booking = None
-        db_bookings = PatientBooking.query.filter(
-            db.func.lower(db.func.trim(PatientBooking.patient_name)) == name.lower().strip(),
-            db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doctor_info["Name"].lower().strip(),
-            db.func.lower(db.func.trim(PatientBooking.specialization)) == doctor_info["Specialization"].lower().strip(),
-            PatientBooking.date == date,
-            PatientBooking.status == 'confirmed'
-        ).order_by(PatientBooking.id.asc()).all()
-
-        if db_bookings:
-            try:
-                spreadsheet = client.open_by_url(sheet_url)
-                sheet = get_or_create_date_sheet(spreadsheet, date)
-                
-                # Check for exact duplicate in sheet rows matching valid DB tokens
-                valid_tokens = {b.token for b in db_bookings}
-                rows = sheet.get_all_values()
-                if len(rows) > 1:
-                    headers = [h.strip().lower() for h in rows[0]]
-                    name_idx = headers.index("name") if "name" in headers else 1
-                    age_idx = headers.index("age") if "age" in headers else 2
-                    gender_idx = headers.index("gender") if "gender" in headers else 3
-                    phone_idx = headers.index("phone_number") if "phone_number" in headers else 4
-                    token_idx = headers.index("token") if "token" in headers else 0
-
-                    c_name = name.lower().strip()
-                    c_age = str(age).strip()
-                    c_gender = gender.lower().strip()
-                    c_phone = str(phone_number).strip()
-
-                    for row in rows[1:]:
-                        if len(row) > max(name_idx, age_idx, gender_idx, phone_idx):
-                            try:
-                                r_token = int(row[token_idx])
-                            except ValueError:
-                                r_token = row[token_idx]
-
-                            if r_token in valid_tokens:
-                                r_name = row[name_idx].lower().strip()
-                                r_age = str(row[age_idx]).strip()
-                                r_gender = row[gender_idx].lower().strip()
-                                r_phone = str(row[phone_idx]).strip()
-
-                                if r_name == c_name and r_age == c_age and r_gender == c_gender and r_phone == c_phone:
-                                    existing_booking = next(b for b in db_bookings if b.token == r_token)
-                                    break
-                
-                if existing_booking:
-                    deduplicate_bookings(doctor_info["Name"], doctor_info["Specialization"], date, name, sheet)
-            except Exception as e:
-                print(f"[WARNING] Sheet-based precheck failed in book_doctor: {e}")
-                existing_booking = db_bookings[0]
-                deduplicate_bookings(doctor_info["Name"], doctor_info["Specialization"], date, name)
-
+        # ─── Repeated submission: one indexed lookup on the idempotency key ───
+        idempotency_key = request_idempotency_key(doctor_info["Specialization"], date, name, age, gender, phone_number,
+                                                  doctor_name=doctor_info["Name"])
+        existing_booking = find_booking_by_key(idempotency_key)
         if existing_booking:
-            clean_booking = PatientBooking.query.filter_by(id=existing_booking.id).first() or existing_booking
-            
-            return jsonify({
-                "success": True,
-                "token": clean_booking.token,
-                "doctor": clean_booking.doctor_name,
-                "specialization": clean_booking.specialization,
-                "date": date,
-                "time": clean_booking.time,
-                "name": name,
-                "age": age,
-                "phone": phone_number,
-                "redirect": url_for(
-                    "confirmation_page",
-                    token=clean_booking.token,
-                    doctor=clean_booking.doctor_name,
-                    specialization=clean_booking.specialization,
-                    date=date,
-                    time=clean_booking.time,
-                    name=name,
-                    age=age,
-                    gender=gender,
-                    phone=phone_number
-                )
-            })
-
-        spreadsheet = client.open_by_url(sheet_url)
-        sheet = get_or_create_date_sheet(spreadsheet, date)
+            return replay_booking_response(existing_booking, date, name, age, gender, phone_number)
 
         # ─── Refined 25-Booking Limit Check (Hard Block) ───
-        filled_count = get_filled_booking_count(sheet)
-        if filled_count >= 25:
+        filled_count = count_active_bookings(doctor_info["Name"], doctor_info["Specialization"], date)
+        if filled_count >= BOOKING_CAPACITY:
             return jsonify({
                 "success": False, 
                 "msg": f"Booking is full for {doctor_info['Name']} on this date (25 slots filled)."
             }), 400
 
-        # Calculate token based on row count to ensure uniqueness
-        token = len(sheet.get_all_values())
-        sheet.append_row([token, name, age, gender, phone_number, date])
-
         user_id = session.get('user_id')
         is_guest = False
         if not user_id:
@@ -3176,28 +3346,26 @@ def book_doctor():
             if guest_user:
                 user_id = guest_user.id
 
-        if user_id:
-            new_booking = PatientBooking(
-                user_id=user_id,
-                doctor_name=doctor_info["Name"],
-                specialization=doctor_info["Specialization"],
-                date=date,
-                time=time_for_booking,
-                token=token,
-                sheet_url=sheet_url,
-                patient_name=name,
-                age=age or "-"
-            )
-            db.session.add(new_booking)
-            db.session.commit()
-            try:
-                from push_services import send_confirmation_notification
-                send_confirmation_notification(new_booking, app, db, PushSubscription)
-            except Exception as push_err:
-                app.logger.error(f"Failed to send booking confirmation push: {push_err}")
-            deduplicate_bookings(doctor_info["Name"], doctor_info["Specialization"], date, name, sheet)
-            if not is_guest:
-                mark_pending_referrals_booked(user_id, doctor_info["Specialization"], name)
+        if not user_id:
+            return jsonify({"success": False, "msg": "Could not record the booking. Please try again."}), 500
+
+        new_booking = create_booking(doctor_info, date, time_for_booking, user_id, name, age, gender, phone_number,
+                                     idempotency_key=idempotency_key)
+        if new_booking is None:
+            return jsonify({
+                "success": False, 
+                "msg": f"Booking is full for {doctor_info['Name']} on this date (25 slots filled)."
+            }), 400
+        if new_booking.replayed:
+            return replay_booking_response(new_booking, date, name, age, gender, phone_number)
+        token = new_booking.token
+        try:
+            from push_services import send_confirmation_notification
+            send_confirmation_notification(new_booking, app, db, PushSubscription)
+        except Exception as push_err:
+            app.logger.error(f"Failed to send booking confirmation push: {push_err}")
+        if not is_guest:
+            mark_pending_referrals_booked(user_id, doctor_info["Specialization"], name)
 
         # --- Auto-Update Doctor Session Total Tokens for today ---
         ist = pytz.timezone('Asia/Kolkata')
@@ -3205,13 +3373,13 @@ def book_doctor():
         if date == today_str:
             try:
                 doc_sess = DoctorSession.query.filter(
-                    db.func.lower(db.func.trim(DoctorSession.doctor_name)) == doctor_info["Name"].lower().strip(),
-                    db.func.lower(db.func.trim(DoctorSession.specialization)) == doctor_info["Specialization"].lower().strip(),
+                    DoctorSession.doctor_key == normalize_key(doctor_info["Name"]),
+                    DoctorSession.spec_key == normalize_key(doctor_info["Specialization"]),
                     DoctorSession.session_date == today_str
                 ).first()
                 if doc_sess:
-                    doc_sess.total_tokens += 1
-                    sync_doctor_session_status(doc_sess)
+                    doc_sess.total_tokens = max(doc_sess.total_tokens or 0, token)
+                    session_state.bookings_changed(doc_sess)
                     db.session.commit()
             except Exception as e:
                 db.session.rollback()
@@ -3220,9 +3388,6 @@ def book_doctor():
         # Set flag for celebratory confetti
         session['justBooked'] = True
 
-        increment_booking_counter()
-        cleanup_old_date_sheets(spreadsheet)
-
         return jsonify({
             "success": True,
             "token": token,
@@ -3268,8 +3433,7 @@ def admin_book_patient():
         return jsonify({"success": False, "msg": "Doctor, Name and Date are required."}), 400
 
     try:
-        doctor_info = next((doc for doc in get_all_doctors()
-                            if doc["SheetURL"] == sheet_url), None)
+        doctor_info = get_doctor_directory().find_by_url(sheet_url)
         if not doctor_info:
             return jsonify({"success": False, "msg": "Doctor not found."}), 404
 
@@ -3300,8 +3464,8 @@ def admin_book_patient():
                 ist_now2 = pytz.timezone('Asia/Kolkata')
                 today_chk2 = datetime.now(ist_now2).strftime("%Y-%m-%d")
                 sess_chk2 = DoctorSession.query.filter(
-                    db.func.lower(db.func.trim(DoctorSession.doctor_name)) == doctor_info["Name"].lower().strip(),
-                    db.func.lower(db.func.trim(DoctorSession.specialization)) == doctor_info["Specialization"].lower().strip(),
+                    DoctorSession.doctor_key == normalize_key(doctor_info["Name"]),
+                    DoctorSession.spec_key == normalize_key(doctor_info["Specialization"]),
                     DoctorSession.session_date == today_chk2,
                     DoctorSession.status == 'completed'
                 ).first()
@@ -3314,11 +3478,8 @@ def admin_book_patient():
                 pass
 
         # ─── Refined 25-Booking Limit Check (Admin Warning/Override) ───
-        spreadsheet = client.open_by_url(sheet_url)
-        sheet = get_or_create_date_sheet(spreadsheet, date)
-        
-        filled_count = get_filled_booking_count(sheet)
-        if filled_count >= 25 and not data.get("force"):
+        filled_count = count_active_bookings(doctor_info["Name"], doctor_info["Specialization"], date)
+        if filled_count >= BOOKING_CAPACITY and not data.get("force"):
             return jsonify({
                 "success": True, 
                 "warning": True, 
@@ -3332,106 +3493,19 @@ def admin_book_patient():
         today_ist_str = now_ist.strftime("%Y-%m-%d")
 
         if date == today_ist_str:
-            day_times = doctor_info.get("DayTimes", {})
-            time_range = day_times.get(weekday, "")
-            if time_range and "-" in time_range:
-                end_time_str = time_range.split("-")[1].strip()
-                now_time_str = now_ist.strftime("%H:%M")
-                if now_time_str > end_time_str:
-                    return jsonify({"success": False, "msg": "Duty hours for today have already ended."}), 400
+            shift = get_doctor_directory().shift(doctor_info["Name"], doctor_info["Specialization"], weekday)
+            if shift and now_ist.strftime("%H:%M") > shift[1]:
+                return jsonify({"success": False, "msg": "Duty hours for today have already ended."}), 400
 
         day_times = doctor_info.get("DayTimes", {})
         time_for_booking = day_times.get(weekday, "")
 
-        # ─── Server-Side Duplicate Booking Pre-Check & Deduplication ───
-        existing_booking = None
-        db_bookings = PatientBooking.query.filter(
-            db.func.lower(db.func.trim(PatientBooking.patient_name)) == name.lower().strip(),
-            db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doctor_info["Name"].lower().strip(),
-            db.func.lower(db.func.trim(PatientBooking.specialization)) == doctor_info["Specialization"].lower().strip(),
-            PatientBooking.date == date,
-            PatientBooking.status == 'confirmed'
-        ).order_by(PatientBooking.id.asc()).all()
-
-        if db_bookings:
-            try:
-                spreadsheet = client.open_by_url(sheet_url)
-                sheet = get_or_create_date_sheet(spreadsheet, date)
-                
-                # Check for exact duplicate in sheet rows matching valid DB tokens
-                valid_tokens = {b.token for b in db_bookings}
-                rows = sheet.get_all_values()
-                if len(rows) > 1:
-                    headers = [h.strip().lower() for h in rows[0]]
-                    name_idx = headers.index("name") if "name" in headers else 1
-                    age_idx = headers.index("age") if "age" in headers else 2
-                    gender_idx = headers.index("gender") if "gender" in headers else 3
-                    phone_idx = headers.index("phone_number") if "phone_number" in headers else 4
-                    token_idx = headers.index("token") if "token" in headers else 0
-
-                    c_name = name.lower().strip()
-                    c_age = str(age).strip()
-                    c_gender = gender.lower().strip()
-                    c_phone = str(phone_number).strip()
-
-                    for row in rows[1:]:
-                        if len(row) > max(name_idx, age_idx, gender_idx, phone_idx):
-                            try:
-                                r_token = int(row[token_idx])
-                            except ValueError:
-                                r_token = row[token_idx]
-
-                            if r_token in valid_tokens:
-                                r_name = row[name_idx].lower().strip()
-                                r_age = str(row[age_idx]).strip()
-                                r_gender = row[gender_idx].lower().strip()
-                                r_phone = str(row[phone_idx]).strip()
-
-                                if r_name == c_name and r_age == c_age and r_gender == c_gender and r_phone == c_phone:
-                                    existing_booking = next(b for b in db_bookings if b.token == r_token)
-                                    break
-                
-                if existing_booking:
-                    deduplicate_bookings(doctor_info["Name"], doctor_info["Specialization"], date, name, sheet)
-            except Exception as e:
-                print(f"[WARNING] Sheet-based precheck failed in admin_book_patient: {e}")
-                existing_booking = db_bookings[0]
-                deduplicate_bookings(doctor_info["Name"], doctor_info["Specialization"], date, name)
-
+        # ─── Repeated submission: one indexed lookup on the idempotency key ───
+        idempotency_key = request_idempotency_key(doctor_info["Specialization"], date, name, age, gender, phone_number,
+                                                  doctor_name=doctor_info["Name"])
+        existing_booking = find_booking_by_key(idempotency_key)
         if existing_booking:
-            clean_booking = PatientBooking.query.filter_by(id=existing_booking.id).first() or existing_booking
-            
-            return jsonify({
-                "success": True,
-                "token": clean_booking.token,
-                "doctor": clean_booking.doctor_name,
-                "specialization": clean_booking.specialization,
-                "date": date,
-                "time": clean_booking.time,
-                "name": name,
-                "age": age or "-",
-                "phone": phone_number or "-",
-                "redirect": url_for(
-                    "confirmation_page",
-                    token=clean_booking.token,
-                    doctor=clean_booking.doctor_name,
-                    specialization=clean_booking.specialization,
-                    date=date,
-                    time=clean_booking.time,
-                    name=name,
-                    age=age or "-",
-                    gender=gender,
-                    phone=phone_number or "-"
-                )
-            })
-
-        spreadsheet = client.open_by_url(sheet_url)
-        sheet = get_or_create_date_sheet(spreadsheet, date)
-
-        # Calculate token based on row count to ensure uniqueness
-        token = len(sheet.get_all_values())
-
-        sheet.append_row([token, name, age, gender, phone_number, date])
+            return replay_booking_response(existing_booking, date, name, age or "-", gender, phone_number or "-")
 
         # Try to find a registered user with a matching name (case-insensitive)
         booking_user = User.query.filter(db.func.lower(db.func.trim(User.name)) == name.lower().strip()).first()
@@ -3441,28 +3515,30 @@ def admin_book_patient():
             guest_user = User.query.filter_by(email="guest@primecare.com").first()
             booking_user_id = guest_user.id if guest_user else None
 
-        if booking_user_id:
-            new_booking = PatientBooking(
-                user_id=booking_user_id,
-                doctor_name=doctor_info["Name"],
-                specialization=doctor_info["Specialization"],
-                date=date,
-                time=time_for_booking,
-                token=token,
-                sheet_url=sheet_url,
-                patient_name=name,
-                age=age or "-"
-            )
-            db.session.add(new_booking)
-            db.session.commit()
-            try:
-                from push_services import send_confirmation_notification
-                send_confirmation_notification(new_booking, app, db, PushSubscription)
-            except Exception as push_err:
-                app.logger.error(f"Failed to send booking confirmation push: {push_err}")
-            deduplicate_bookings(doctor_info["Name"], doctor_info["Specialization"], date, name, sheet)
-            if booking_user and not booking_user.email.endswith("guest@primecare.com"):
-                mark_pending_referrals_booked(booking_user_id, doctor_info["Specialization"], name)
+        if not booking_user_id:
+            return jsonify({"success": False, "msg": "Could not record the booking. Please try again."}), 500
+
+        new_booking = create_booking(doctor_info, date, time_for_booking, booking_user_id, name, age, gender, phone_number,
+                                     capacity=None if data.get("force") else BOOKING_CAPACITY,
+                                     idempotency_key=idempotency_key)
+        if new_booking is None:
+            filled_count = count_active_bookings(doctor_info["Name"], doctor_info["Specialization"], date)
+            return jsonify({
+                "success": True, 
+                "warning": True, 
+                "count": filled_count,
+                "msg": f"Total bookings for this doctor have already reached {filled_count}. Proceed anyway?"
+            })
+        if new_booking.replayed:
+            return replay_booking_response(new_booking, date, name, age or "-", gender, phone_number or "-")
+        token = new_booking.token
+        try:
+            from push_services import send_confirmation_notification
+            send_confirmation_notification(new_booking, app, db, PushSubscription)
+        except Exception as push_err:
+            app.logger.error(f"Failed to send booking confirmation push: {push_err}")
+        if booking_user and not booking_user.email.endswith("guest@primecare.com"):
+            mark_pending_referrals_booked(booking_user_id, doctor_info["Specialization"], name)
 
         # --- Auto-Update Doctor Session Total Tokens for today ---
         ist = pytz.timezone('Asia/Kolkata')
@@ -3470,21 +3546,18 @@ def admin_book_patient():
         if date == today_str:
             try:
                 doc_sess = DoctorSession.query.filter(
-                    db.func.lower(db.func.trim(DoctorSession.doctor_name)) == doctor_info["Name"].lower().strip(),
-                    db.func.lower(db.func.trim(DoctorSession.specialization)) == doctor_info["Specialization"].lower().strip(),
+                    DoctorSession.doctor_key == normalize_key(doctor_info["Name"]),
+                    DoctorSession.spec_key == normalize_key(doctor_info["Specialization"]),
                     DoctorSession.session_date == today_str
                 ).first()
                 if doc_sess:
-                    doc_sess.total_tokens += 1
-                    sync_doctor_session_status(doc_sess)
+                    doc_sess.total_tokens = max(doc_sess.total_tokens or 0, token)
+                    session_state.bookings_changed(doc_sess)
                     db.session.commit()
             except Exception as e:
                 db.session.rollback()
                 app.logger.exception(f"Error auto-incrementing DoctorSession tokens: {e}")
 
-        increment_booking_counter()
-        cleanup_old_date_sheets(spreadsheet)
-
         session['justBooked'] = True
         return jsonify({
             "success": True,
@@ -3527,88 +3600,11 @@ def book_department():
         return jsonify({"success": False, "msg": "Missing fields"}), 400
 
     try:
-        # ─── Server-Side Duplicate Booking Pre-Check & Deduplication ───
-        existing_booking = None
-        db_bookings = PatientBooking.query.filter(
-            db.func.lower(db.func.trim(PatientBooking.patient_name)) == name.lower().strip(),
-            db.func.lower(db.func.trim(PatientBooking.specialization)) == specialization.lower().strip(),
-            PatientBooking.date == date_str,
-            PatientBooking.status == 'confirmed'
-        ).order_by(PatientBooking.id.asc()).all()
-
-        if db_bookings:
-            try:
-                # Use the sheet url of the first matching database booking to verify
-                spreadsheet = client.open_by_url(db_bookings[0].sheet_url)
-                date_sheet = get_or_create_date_sheet(spreadsheet, date_str)
-                
-                # Check for exact duplicate in sheet rows matching valid DB tokens
-                valid_tokens = {b.token for b in db_bookings}
-                rows = date_sheet.get_all_values()
-                if len(rows) > 1:
-                    headers = [h.strip().lower() for h in rows[0]]
-                    name_idx = headers.index("name") if "name" in headers else 1
-                    age_idx = headers.index("age") if "age" in headers else 2
-                    gender_idx = headers.index("gender") if "gender" in headers else 3
-                    phone_idx = headers.index("phone_number") if "phone_number" in headers else 4
-                    token_idx = headers.index("token") if "token" in headers else 0
-
-                    c_name = name.lower().strip()
-                    c_age = str(age).strip()
-                    c_gender = gender.lower().strip()
-                    c_phone = str(phone_number).strip()
-
-                    for row in rows[1:]:
-                        if len(row) > max(name_idx, age_idx, gender_idx, phone_idx):
-                            try:
-                                r_token = int(row[token_idx])
-                            except ValueError:
-                                r_token = row[token_idx]
-
-                            if r_token in valid_tokens:
-                                r_name = row[name_idx].lower().strip()
-                                r_age = str(row[age_idx]).strip()
-                                r_gender = row[gender_idx].lower().strip()
-                                r_phone = str(row[phone_idx]).strip()
-
-                                if r_name == c_name and r_age == c_age and r_gender == c_gender and r_phone == c_phone:
-                                    existing_booking = next(b for b in db_bookings if b.token == r_token)
-                                    break
-                
-                if existing_booking:
-                    deduplicate_bookings(existing_booking.doctor_name, specialization, date_str, name, date_sheet)
-            except Exception as e:
-                print(f"[WARNING] Sheet-based precheck failed in book_department: {e}")
-                existing_booking = db_bookings[0]
-                deduplicate_bookings(existing_booking.doctor_name, specialization, date_str, name)
-
+        # ─── Repeated submission: one indexed lookup on the idempotency key ───
+        idempotency_key = request_idempotency_key(specialization, date_str, name, age, gender, phone_number)
+        existing_booking = find_booking_by_key(idempotency_key)
         if existing_booking:
-            clean_booking = PatientBooking.query.filter_by(id=existing_booking.id).first() or existing_booking
-            
-            return jsonify({
-                "success": True,
-                "token": clean_booking.token,
-                "doctor": clean_booking.doctor_name,
-                "specialization": clean_booking.specialization,
-                "date": date_str,
-                "time": clean_booking.time,
-                "name": name,
-                "age": age,
-                "gender": gender,
-                "phone": phone_number,
-                "redirect": url_for(
-                    "confirmation_page",
-                    token=clean_booking.token,
-                    doctor=clean_booking.doctor_name,
-                    specialization=clean_booking.specialization,
-                    date=date_str,
-                    time=clean_booking.time,
-                    name=name,
-                    age=age,
-                    gender=gender,
-                    phone=phone_number
-                )
-            })
+            return replay_booking_response(existing_booking, date_str, name, age, gender, phone_number)
 
         # weekday name, e.g. "Monday"
         target_date_obj = datetime.strptime(date_str, "%Y-%m-%d")
@@ -3630,15 +3626,8 @@ def book_department():
         if is_holiday:
             return jsonify({"success": False, "msg": get_holiday_display_message(date_str, h_reason)}), 400
 
-        all_doctors = get_all_doctors()
-
         # Doctors in specialization working that weekday
-        # NOTE: if doc["Days"] is a string like "Monday, Wednesday",
-        # consider changing this to split, but I'm keeping your logic.
-        matching_doctors = [
-            doc for doc in all_doctors
-            if doc["Specialization"] == specialization and weekday in doc["Days"]
-        ]
+        matching_doctors = get_doctor_directory().working_on(weekday, specialization)
 
         # Exclude leave days
         available_doctors = []
@@ -3671,26 +3660,46 @@ def book_department():
                     "msg": "Selected doctor is not available for this date."
                 }), 400
 
-            spreadsheet = client.open_by_url(chosen_doc["SheetURL"])
-            date_sheet = get_or_create_date_sheet(spreadsheet, date_str)
-
             # ─── Refined 25-Booking Limit Check (Hard Block) ───
-            filled_count = get_filled_booking_count(date_sheet)
-            if filled_count >= 25:
+            filled_count = count_active_bookings(chosen_doc["Name"], chosen_doc["Specialization"], date_str)
+            if filled_count >= BOOKING_CAPACITY:
                 return jsonify({
                     "success": False, 
                     "msg": f"Booking is full for {chosen_doc['Name']} on this date (25 slots filled)."
                 }), 400
 
-            # count existing valid rows
-            # Calculate token based on row count to ensure uniqueness
-            token = len(date_sheet.get_all_values())
-
             # optional – get time string for this weekday
             day_times = chosen_doc.get("DayTimes", {})
             time_for_booking = day_times.get(weekday, "")
 
-            date_sheet.append_row([token, name, age, gender, phone_number, date_str])
+            user_id = session.get('user_id')
+            is_guest = False
+            if not user_id:
+                is_guest = True
+                guest_user = User.query.filter_by(email="guest@primecare.com").first()
+                if guest_user:
+                    user_id = guest_user.id
+
+            if not user_id:
+                return jsonify({"success": False, "msg": "Could not record the booking. Please try again."}), 500
+
+            new_booking = create_booking(chosen_doc, date_str, time_for_booking, user_id, name, age, gender, phone_number,
+                                         idempotency_key=idempotency_key)
+            if new_booking is None:
+                return jsonify({
+                    "success": False, 
+                    "msg": f"Booking is full for {chosen_doc['Name']} on this date (25 slots filled)."
+                }), 400
+            if new_booking.replayed:
+                return replay_booking_response(new_booking, date_str, name, age, gender, phone_number)
+            token = new_booking.token
+            try:
+                from push_services import send_confirmation_notification
+                send_confirmation_notification(new_booking, app, db, PushSubscription)
+            except Exception as push_err:
+                app.logger.error(f"Failed to send booking confirmation push: {push_err}")
+            if not is_guest:
+                mark_pending_referrals_booked(user_id, chosen_doc["Specialization"], name)
 
             # --- Auto-Update Doctor Session Total Tokens for today ---
             ist = pytz.timezone('Asia/Kolkata')
@@ -3698,52 +3707,18 @@ def book_department():
             if date_str == today_str:
                 try:
                     doc_sess = DoctorSession.query.filter(
-                        db.func.lower(db.func.trim(DoctorSession.doctor_name)) == chosen_doc["Name"].lower().strip(),
-                        db.func.lower(db.func.trim(DoctorSession.specialization)) == chosen_doc["Specialization"].lower().strip(),
+                        DoctorSession.doctor_key == normalize_key(chosen_doc["Name"]),
+                        DoctorSession.spec_key == normalize_key(chosen_doc["Specialization"]),
                         DoctorSession.session_date == today_str
                     ).first()
                     if doc_sess:
-                        doc_sess.total_tokens += 1
-                        sync_doctor_session_status(doc_sess)
+                        doc_sess.total_tokens = max(doc_sess.total_tokens or 0, token)
+                        session_state.bookings_changed(doc_sess)
                         db.session.commit()
                 except Exception as e:
                     db.session.rollback()
                     app.logger.exception(f"Error auto-incrementing DoctorSession tokens: {e}")
 
-            user_id = session.get('user_id')
-            is_guest = False
-            if not user_id:
-                is_guest = True
-                guest_user = User.query.filter_by(email="guest@primecare.com").first()
-                if guest_user:
-                    user_id = guest_user.id
-
-            if user_id:
-                new_booking = PatientBooking(
-                    user_id=user_id,
-                    doctor_name=chosen_doc["Name"],
-                    specialization=chosen_doc["Specialization"],
-                    date=date_str,
-                    time=time_for_booking,
-                    token=token,
-                    sheet_url=chosen_doc["SheetURL"],
-                    patient_name=name,
-                    age=age or "-"
-                )
-                db.session.add(new_booking)
-                db.session.commit()
-                try:
-                    from push_services import send_confirmation_notification
-                    send_confirmation_notification(new_booking, app, db, PushSubscription)
-                except Exception as push_err:
-                    app.logger.error(f"Failed to send booking confirmation push: {push_err}")
-                deduplicate_bookings(chosen_doc["Name"], chosen_doc["Specialization"], date_str, name, date_sheet)
-                if not is_guest:
-                    mark_pending_referrals_booked(user_id, chosen_doc["Specialization"], name)
-
-            increment_booking_counter()
-            cleanup_old_date_sheets(spreadsheet)
-
             return jsonify({
                 "success": True,
                 "token": token,
@@ -3773,30 +3748,16 @@ def book_department():
         # -> choose least-booked doctor among available_doctors for that date
         best_doc = None
         best_count = None
-        best_spreadsheet = None
-        best_sheet = None
 
         for doc in available_doctors:
-            try:
-                spreadsheet = client.open_by_url(doc["SheetURL"])
-                date_sheet = get_or_create_date_sheet(spreadsheet, date_str)
-                # Count only filled rows with names
-                count = get_filled_booking_count(date_sheet) 
-            except Exception as e:
-                # If one doctor's sheet fails, skip that doctor
-                app.logger.exception(
-                    f"Error counting bookings for doctor {doc.get('Name')}: {e}"
-                )
-                continue
-
+            # Count only slots still held by a booking
+            count = count_active_bookings(doc["Name"], doc["Specialization"], date_str)
             if best_count is None or count < best_count:
                 best_count = count
                 best_doc = doc
-                best_spreadsheet = spreadsheet
-                best_sheet = date_sheet
 
         # ─── CAPACITY GUARD: If even the best doctor is full, the department is full ───
-        if best_count is not None and best_count >= 25:
+        if best_count is not None and best_count >= BOOKING_CAPACITY:
             return jsonify({
                 "success": False,
                 "msg": f"Booking is full for all {specialization} doctors on this date (all 25-slot limits reached)."
@@ -3809,13 +3770,38 @@ def book_department():
                 "msg": "Could not determine an available doctor."
             }), 500
 
-        # Book with the selected least-booked doctor
-        token = len(best_sheet.get_all_values())
-
         day_times = best_doc.get("DayTimes", {})
         time_for_booking = day_times.get(weekday, "")
 
-        best_sheet.append_row([token, name, age, gender, phone_number, date_str])
+        user_id = session.get('user_id')
+        is_guest = False
+        if not user_id:
+            is_guest = True
+            guest_user = User.query.filter_by(email="guest@primecare.com").first()
+            if guest_user:
+                user_id = guest_user.id
+
+        if not user_id:
+            return jsonify({"success": False, "msg": "Could not record the booking. Please try again."}), 500
+
+        # Book with the selected least-booked doctor
+        new_booking = create_booking(best_doc, date_str, time_for_booking, user_id, name, age, gender, phone_number,
+                                     idempotency_key=idempotency_key)
+        if new_booking is None:
+            return jsonify({
+                "success": False,
+                "msg": f"Booking is full for {best_doc['Name']} on this date (25 slots filled)."
+            }), 400
+        if new_booking.replayed:
+            return replay_booking_response(new_booking, date_str, name, age, gender, phone_number)
+        token = new_booking.token
+        try:
+            from push_services import send_confirmation_notification
+            send_confirmation_notification(new_booking, app, db, PushSubscription)
+        except Exception as push_err:
+            app.logger.error(f"Failed to send booking confirmation push: {push_err}")
+        if not is_guest:
+            mark_pending_referrals_booked(user_id, best_doc["Specialization"], name)
 
         # --- Auto-Update Doctor Session Total Tokens for today ---
         ist = pytz.timezone('Asia/Kolkata')
@@ -3823,52 +3809,18 @@ def book_department():
         if date_str == today_str:
             try:
                 doc_sess = DoctorSession.query.filter(
-                    db.func.lower(db.func.trim(DoctorSession.doctor_name)) == best_doc["Name"].lower().strip(),
-                    db.func.lower(db.func.trim(DoctorSession.specialization)) == best_doc["Specialization"].lower().strip(),
+                    DoctorSession.doctor_key == normalize_key(best_doc["Name"]),
+                    DoctorSession.spec_key == normalize_key(best_doc["Specialization"]),
                     DoctorSession.session_date == today_str
                 ).first()
                 if doc_sess:
-                    doc_sess.total_tokens += 1
-                    sync_doctor_session_status(doc_sess)
+                    doc_sess.total_tokens = max(doc_sess.total_tokens or 0, token)
+                    session_state.bookings_changed(doc_sess)
                     db.session.commit()
             except Exception as e:
                 db.session.rollback()
                 app.logger.exception(f"Error auto-incrementing DoctorSession tokens: {e}")
 
-        user_id = session.get('user_id')
-        is_guest = False
-        if not user_id:
-            is_guest = True
-            guest_user = User.query.filter_by(email="guest@primecare.com").first()
-            if guest_user:
-                user_id = guest_user.id
-
-        if user_id:
-            new_booking = PatientBooking(
-                user_id=user_id,
-                doctor_name=best_doc["Name"],
-                specialization=best_doc["Specialization"],
-                date=date_str,
-                time=time_for_booking,
-                token=token,
-                sheet_url=best_doc["SheetURL"],
-                patient_name=name,
-                age=age or "-"
-            )
-            db.session.add(new_booking)
-            db.session.commit()
-            try:
-                from push_services import send_confirmation_notification
-                send_confirmation_notification(new_booking, app, db, PushSubscription)
-            except Exception as push_err:
-                app.logger.error(f"Failed to send booking confirmation push: {push_err}")
-            deduplicate_bookings(best_doc["Name"], best_doc["Specialization"], date_str, name, best_sheet)
-            if not is_guest:
-                mark_pending_referrals_booked(user_id, best_doc["Specialization"], name)
-
-        increment_booking_counter()
-        cleanup_old_date_sheets(best_spreadsheet)
-
         return jsonify({
             "success": True,
             "token": token,
@@ -3915,7 +3867,7 @@ def check_doctor_availability():
         return jsonify({"available": False, "msg": "Missing parameters"}), 400
 
     try:
-        all_doctors = get_all_doctors()
+        directory = get_doctor_directory()
         output = {}
         
         # IST Timezone handling
@@ -3941,7 +3893,7 @@ def check_doctor_availability():
 
         for url in sheet_urls:
             if not url: continue
-            doc = next((d for d in all_doctors if d["SheetURL"] == url), None)
+            doc = directory.find_by_url(url)
             if not doc:
                 output[url] = {"available": False, "reason": "Doctor not found"}
                 continue
@@ -3964,13 +3916,10 @@ def check_doctor_availability():
 
             # 4. Working hours finished
             if selected_date == today_ist:
-                day_times = doc.get("DayTimes", {})
-                time_range = day_times.get(weekday, "")
-                if time_range and "-" in time_range:
-                    end_time_str = time_range.split("-")[1].strip()
-                    if now_time_str > end_time_str:
-                        output[url] = {"available": False, "reason": f"{doc['Name']}'s duty is finished for today."}
-                        continue
+                shift = directory.shift(doc["Name"], doc["Specialization"], weekday)
+                if shift and now_time_str > shift[1]:
+                    output[url] = {"available": False, "reason": f"{doc['Name']}'s duty is finished for today."}
+                    continue
 
             output[url] = {"available": True}
 
@@ -4013,35 +3962,6 @@ def confirmation_page():
     )
 
 
-def cleanup_old_date_sheets(spreadsheet, keep_last_n=4):
-    try:
-        stats_ws = main_sheet.worksheet("BookingStats")
-        count = int(stats_ws.acell("A2").value)
-
-        if count < 10:
-            return  # Not time to clean up yet
-
-        stats_ws.update("A2", "0")
-
-        all_worksheets = spreadsheet.worksheets()
-
-        date_sheets = []
-        for ws in all_worksheets:
-            try:
-                datetime.strptime(ws.title, "%d-%m-%Y")
-                date_sheets.append(ws)
-            except ValueError:
-                continue  # non-date tabs
-
-        date_sheets.sort(key=lambda ws: datetime.strptime(ws.title, "%d-%m-%Y"))
-
-        for ws in date_sheets[:-keep_last_n]:
-            spreadsheet.del_worksheet(ws)
-
-    except Exception as e:
-        print(f"[ERROR] Failed to cleanup old sheets: {e}")
-
-
 @app.route('/api/doctor_stats', methods=['GET'])
 def get_doctor_stats():
     user_email = session.get('user_email')
@@ -4060,12 +3980,8 @@ def get_doctor_stats():
         dt_formatted = datetime.now(ist).strftime("%d-%m-%Y")
         
         # Find sheet URL (using robust case-insensitive check matching dashboard)
-        doctors = get_all_doctors()
-        sheet_url = None
-        for d in doctors:
-            if d.get("Name").strip().lower() == doc_session.doctor_name.strip().lower() and d.get("Specialization").strip().lower() == doc_session.specialization.strip().lower():
-                sheet_url = d.get("SheetURL")
-                break
+        doc_info = get_doctor_directory().find(doc_session.doctor_name, doc_session.specialization)
+        sheet_url = doc_info.get("SheetURL") if doc_info else None
         
         total_booked = 0
         empty_slots = []
@@ -4074,30 +3990,27 @@ def get_doctor_stats():
         
         # Pre-fetch SQLite bookings for today as fallback / verification
         db_bookings_today = PatientBooking.query.filter(
-            db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-            db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-            (PatientBooking.date == today_str) | (PatientBooking.date == dt_formatted),
+            PatientBooking.doctor_key == normalize_key(doc_session.doctor_name),
+            PatientBooking.spec_key == normalize_key(doc_session.specialization),
+            PatientBooking.booking_date == as_date(today_str),
             PatientBooking.status != 'cancelled'
         ).order_by(PatientBooking.token.asc()).all()
 
         loaded_from_sheet = False
         if sheet_url:
             try:
-                s = client.open_by_url(sheet_url)
+                s = open_doctor_spreadsheet(sheet_url)
                 ws = s.worksheet(dt_formatted)
                 records = get_worksheet_records_safe(ws)
                 total_tokens = len(records)
-                doc_session.total_tokens = total_tokens
-                sync_doctor_session_status(doc_session)
-                db.session.commit()
                 
-                skipped_set = set(doc_session.skipped_tokens.split(",")) if doc_session.skipped_tokens else set()
+                queue = doc_session.queue
                 
                 # Fetch bookings and referrals for today's session to identify referred patients
                 bookings_today = PatientBooking.query.filter(
-                    db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-                    db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-                    (PatientBooking.date == today_str) | (PatientBooking.date == dt_formatted)
+                    PatientBooking.doctor_key == normalize_key(doc_session.doctor_name),
+                    PatientBooking.spec_key == normalize_key(doc_session.specialization),
+                    PatientBooking.booking_date == as_date(today_str)
                 ).all()
                 
                 referred_tokens = set()
@@ -4118,18 +4031,9 @@ def get_doctor_stats():
                         total_booked += 1
                         
                         # Determine status
-                        t_str = str(t_val)
-                        if t_str in skipped_set:
-                            b_status = "skipped"
-                        elif doc_session.status == "active" and t_val == doc_session.current_token:
-                            b_status = "calling"
-                        elif doc_session.status in ["completed", "waiting_bookings"] or (doc_session.status == "active" and t_val < doc_session.current_token):
-                            if t_val in referred_tokens:
-                                b_status = "referred"
-                            else:
-                                b_status = "consulted"
-                        else:
-                            b_status = "waiting"
+                        b_status = queue.state_of(t_val)
+                        if b_status == "consulted" and t_val in referred_tokens:
+                            b_status = "referred"
                             
                         today_bookings.append({
                             "token": t_val,
@@ -4151,11 +4055,8 @@ def get_doctor_stats():
             total_booked = 0
             empty_slots = []
             total_tokens = len(db_bookings_today)
-            doc_session.total_tokens = total_tokens
-            sync_doctor_session_status(doc_session)
-            db.session.commit()
             
-            skipped_set = set(doc_session.skipped_tokens.split(",")) if doc_session.skipped_tokens else set()
+            queue = doc_session.queue
             
             # Fetch referrals to identify referred patients
             referred_tokens = set()
@@ -4174,25 +4075,16 @@ def get_doctor_stats():
                 p_name = b.patient_name
                 total_booked += 1
                 
-                t_str = str(t_val)
-                if t_str in skipped_set:
-                    b_status = "skipped"
-                elif doc_session.status == "active" and t_val == doc_session.current_token:
-                    b_status = "calling"
-                elif doc_session.status in ["completed", "waiting_bookings"] or (doc_session.status == "active" and t_val < doc_session.current_token):
-                    if t_val in referred_tokens:
-                        b_status = "referred"
-                    else:
-                        b_status = "consulted"
-                else:
-                    b_status = "waiting"
+                b_status = queue.state_of(t_val)
+                if b_status == "consulted" and t_val in referred_tokens:
+                    b_status = "referred"
                     
                 today_bookings.append({
                     "token": t_val,
                     "name": p_name,
                     "age": b.age or "-",
-                    "gender": "Not Specified",
-                    "phone": "",
+                    "gender": b.gender or "Not Specified",
+                    "phone": b.phone_number or "",
                     "status": b_status
                 })
 
@@ -4244,44 +4136,26 @@ def admin_get_bookings():
 
     try:
         # 1. Find the doctor's sheet URL
-        all_docs = get_all_doctors()
-        target_doc = None
-        for d in all_docs:
-            if (d["Name"].strip().lower() == name_query and 
-                d["Specialization"].strip().lower() == spec_query):
-                target_doc = d
-                break
+        target_doc = get_doctor_directory().find(name_query, spec_query)
         
         if not target_doc or not target_doc.get("SheetURL"):
             return jsonify({"success": False, "msg": "Doctor spreadsheet not found"})
 
-        # 2. Open the spreadsheet and specific date worksheet
-        spreadsheet = client.open_by_url(target_doc["SheetURL"])
-        # Pattern in app is DD-MM-YYYY for worksheet titles
-        formatted_date = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%m-%Y")
-        
-        try:
-            worksheet = spreadsheet.worksheet(formatted_date)
-        except gspread.exceptions.WorksheetNotFound:
-            return jsonify({"success": True, "bookings": [], "count": 0})
+        # 2. Bookings are stored locally; the sheet is a replica
+        rows = PatientBooking.query.filter(
+            PatientBooking.doctor_key == name_query,
+            PatientBooking.spec_key == spec_query,
+            PatientBooking.booking_date == as_date(date_str),
+            PatientBooking.status != 'cancelled'
+        ).order_by(PatientBooking.token.asc()).all()
 
-        # 3. Get all data safely
-        records = get_worksheet_records_safe(worksheet)
-        
-        # Normalize records (ensure keys exist) and filter out cancelled/empty rows
-        bookings = []
-        for r in records:
-            name = (r.get("Name", "") or "").strip()
-            if not name:
-                continue
-            
-            bookings.append({
-                "token": r.get("Token", ""),
-                "name": name,
-                "age": r.get("Age", ""),
-                "gender": r.get("Gender", ""),
-                "phone": r.get("Phone_Number", "")
-            })
+        bookings = [{
+            "token": b.token,
+            "name": b.patient_name,
+            "age": b.age or "",
+            "gender": b.gender or "",
+            "phone": b.phone_number or ""
+        } for b in rows]
  
         return jsonify({
             "success": True, 
@@ -4324,72 +4198,43 @@ def admin_delete_booking():
         # 2. Check if consultation has started today
         if date_str == today_str:
             doc_session = DoctorSession.query.filter(
-                db.func.lower(db.func.trim(DoctorSession.doctor_name)) == name_query,
-                db.func.lower(db.func.trim(DoctorSession.specialization)) == spec_query,
+                DoctorSession.doctor_key == name_query,
+                DoctorSession.spec_key == spec_query,
                 DoctorSession.session_date == today_str
             ).first()
             if doc_session and doc_session.status in ['active', 'completed']:
                 return jsonify({"success": False, "msg": "Cancellation is not allowed as the consultation session has already started."})
 
-        all_docs = get_all_doctors()
-        target_doc = next((d for d in all_docs if d["Name"].strip().lower() == name_query and d["Specialization"].strip().lower() == spec_query), None)
-        
-        if not target_doc:
-            return jsonify({"success": False, "msg": "Doctor not found"})
-
-        spreadsheet = client.open_by_url(target_doc["SheetURL"])
-        formatted_date = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%m-%Y")
-        worksheet = spreadsheet.worksheet(formatted_date)
+        try:
+            token_val = int(token_to_del)
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "msg": "Booking not found"})
 
-        rows = worksheet.get_all_values()
-        if not rows:
-            return jsonify({"success": False, "msg": "Sheet is empty"})
-            
-        data_rows = rows[1:]
-
-        # Find the row with matching token
-        # Token is usually in the first column (index 0)
-        row_to_delete = None
-        for i, row in enumerate(data_rows):
-            if row and len(row) > 0 and str(row[0]).strip() == str(token_to_del).strip():
-                # gspread uses 1-based indexing for rows, and we skipped header (row 1)
-                row_to_delete = i + 2 
-                break
-        
-        if not row_to_delete:
+        booking = PatientBooking.query.filter(
+            PatientBooking.doctor_key == name_query,
+            PatientBooking.spec_key == spec_query,
+            PatientBooking.booking_date == as_date(date_str),
+            PatientBooking.token == token_val,
+            PatientBooking.status != 'cancelled'
+        ).first()
+        if not booking:
             return jsonify({"success": False, "msg": "Booking not found"})
 
-        # Update SQLite booking status if it exists in SQLite
+        booking.status = 'cancelled'
+        booking.cancelled_by = 'admin'
+        booking.cancelled_at = datetime.now(pytz.timezone('Asia/Kolkata')).strftime("%Y-%m-%d %H:%M:%S")
+        # Soft delete in the sheet (token kept in Col A, B:F cleared) is done by the replicator
+        booking.sync_state = 'pending'
+        db.session.commit()
+        sheet_replicator.notify()
+        publish_booking_event(booking, "cancelled")
         try:
-            booking = PatientBooking.query.filter(
-                db.func.lower(db.func.trim(PatientBooking.doctor_name)) == name_query,
-                db.func.lower(db.func.trim(PatientBooking.specialization)) == spec_query,
-                PatientBooking.date == date_str,
-                PatientBooking.token == int(token_to_del)
-            ).first()
-            if booking:
-                booking.status = 'cancelled'
-                booking.cancelled_by = 'admin'
-                booking.cancelled_at = datetime.now(pytz.timezone('Asia/Kolkata')).strftime("%Y-%m-%d %H:%M:%S")
-                db.session.commit()
-                try:
-                    from push_services import send_cancellation_notification
-                    send_cancellation_notification(booking, app, db, PushSubscription)
-                except Exception as push_err:
-                    app.logger.error(f"Failed to send booking cancellation push: {push_err}")
-        except Exception as db_err:
-            app.logger.error(f"Failed to sync cancellation in SQLite: {db_err}")
-
-        # New Logic: If it's the last row, delete physically. If middle, soft-delete.
-        total_rows = len(rows) 
-        if row_to_delete == total_rows:
-            worksheet.delete_rows(row_to_delete)
-            return jsonify({"success": True, "msg": "Last booking deleted and slot freed."})
-        else:
-            # Soft delete: Clear cells from Col B to Col F (leaving Token in A)
-            range_to_clear = f"B{row_to_delete}:F{row_to_delete}"
-            worksheet.update(range_to_clear, [["", "", "", "", ""]])
-            return jsonify({"success": True, "msg": "Booking cancelled (slot preserved)"})
+            from push_services import send_cancellation_notification
+            send_cancellation_notification(booking, app, db, PushSubscription)
+        except Exception as push_err:
+            app.logger.error(f"Failed to send booking cancellation push: {push_err}")
+
+        return jsonify({"success": True, "msg": "Booking cancelled and slot freed."})
 
     except Exception as e:
         return jsonify({"success": False, "msg": get_friendly_error_message(e)})
@@ -4397,93 +4242,18 @@ def admin_delete_booking():
 
 # ===================== AI Triage =====================
 
-def build_clinic_context(user_id=None):
-    """Build a rich text snapshot of all doctors/schedules for the AI system prompt."""
-    try:
-        doctors = get_all_doctors()
-    except Exception:
-        doctors = []
-
+def build_user_context(user_id=None):
+    """Per-message part of the AI prompt: current time plus the user's upcoming bookings."""
     ist = pytz.timezone('Asia/Kolkata')
     now = datetime.now(ist)
-    lines = [
-        f"--- SYSTEM TIME & STATUS ---",
-        f"Current Time: {now.strftime('%A, %B %d, %Y, %H:%M:%S')} IST",
-        f"Clinic Status: Open for inquiries",
-        ""
-    ]
-    
-# 1. USER'S PERSONAL BOOKINGS (if logged in)
+    upcoming = None
     if user_id:
-        ist = pytz.timezone('Asia/Kolkata')
-        today_str = datetime.now(ist).strftime("%Y-%m-%d")
-        
-        # It already knows what PatientBooking is from the top of the file!
-        user_bookings = PatientBooking.query.filter_by(user_id=user_id).all()
-        upcoming = [b for b in user_bookings if (b.date or "") >= today_str]
-        upcoming.sort(key=lambda x: x.date + x.time)
-
-        lines.append("=== USER'S PERSONAL BOOKINGS ===")
-        if not upcoming:
-            lines.append("  You have no upcoming bookings.")
-        else:
-            lines.append(f"  Total upcoming bookings: {len(upcoming)}")
-            for i, b in enumerate(upcoming):
-                status = "NEXT UPCOMING" if i == 0 else f"Booking {i+1}"
-                lines.append(f"  - {status}: Doctor {b.doctor_name} on {b.date} at {b.time} (Token {b.token})")
-        lines.append("")
-
-    if not doctors:
-        lines.append("No doctor data is currently available.")
-    else:
-        # Department summary
-        from collections import defaultdict
-        dept_counts = defaultdict(int)
-        for d in doctors:
-            dept_counts[d.get("Specialization", "Unknown")] += 1
-
-        lines.append("=== CLINIC DOCTOR DIRECTORY ===")
-        lines.append(f"Total doctors: {len(doctors)}")
-        lines.append("")
-        lines.append("--- Departments & doctor counts ---")
-        for dept, cnt in sorted(dept_counts.items()):
-            lines.append(f"  {dept}: {cnt} doctor(s)")
-
-        lines.append("")
-        lines.append("--- Individual doctor details ---")
-        day_names = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-
-        for d in doctors:
-            name = d.get("Name", "Unknown")
-            spec = d.get("Specialization", "Unknown")
-            days = d.get("Days", [])
-            day_times = d.get("DayTimes", {})
-
-            schedule_parts = []
-            for day in day_names:
-                if day in days:
-                    t = day_times.get(day, "time not set")
-                    schedule_parts.append(f"{day}: {t}")
-
-            schedule_str = "; ".join(schedule_parts) if schedule_parts else "No schedule set"
-            lines.append(f"  Doctor: {name} | Specialization: {spec}")
-            lines.append(f"    Working days & times: {schedule_str}")
-
-        # Day-wise summary (who works on each day)
-        lines.append("")
-        lines.append("--- Doctors working on each day ---")
-        for day in day_names:
-            working = [d["Name"] for d in doctors if day in d.get("Days", [])]
-            if working:
-                lines.append(f"  {day}: {', '.join(working)} ({len(working)} doctor(s))")
-
-    # 3. Contact info
-    lines.append("")
-    lines.append("--- Clinic Contact Details ---")
-    lines.append("  Phone / WhatsApp: +91 8592031725")
-    lines.append("  Location: [Koorachundu](https://www.google.com/maps/place/7J3QGRQW%2B96J/@11.5384625,75.8429407,17z/data=!3m1!4b1!4m4!3m3!8m2!3d11.5384625!4d75.8455156?entry=ttu)")
-
-    return "\n".join(lines)
+        upcoming = PatientBooking.query.filter(
+            PatientBooking.user_id == user_id,
+            PatientBooking.booking_date >= now.date()
+        ).all()
+        upcoming.sort(key=lambda x: (x.date or "") + (x.time or ""))
+    return user_context(now, upcoming)
 
 
 # Configure Gemini once at startup
@@ -4511,6 +4281,31 @@ Behaviour rules:
 
 {clinic_context}"""
 
+# One Gemini client per process; the directory part of the prompt is rendered
+# (and context-cached) once per doctor directory version
+gemini_assistant = GeminiAssistant(
+    GEMINI_API_KEY, GEMINI_SYSTEM_PROMPT,
+    context_cache=os.environ.get("GEMINI_CONTEXT_CACHE", "1") != "0"
+)
+
+# Replies to repeated one-shot questions, keyed by (question, directory version, day)
+ai_reply_cache = ReplyCache(
+    max_entries=int(os.environ.get("AI_REPLY_CACHE_SIZE", "512")),
+    ttl=int(os.environ.get("AI_REPLY_CACHE_TTL", "1800"))
+)
+
+# Shared rate limit for every Gemini call (triage, admin chat, streaming).
+# GEMINI_RPM is per process: set it to the project quota / worker count.
+# Requests beyond it wait at most GEMINI_MAX_WAIT seconds and then get a
+# "busy" reply instead of sleeping in the request thread.
+gemini_governor = RequestGovernor(
+    rate_per_minute=int(os.environ.get("GEMINI_RPM", "60")),
+    burst=int(os.environ.get("GEMINI_BURST", "10")),
+    max_waiters=int(os.environ.get("GEMINI_MAX_WAITERS", "8")),
+    max_wait=float(os.environ.get("GEMINI_MAX_WAIT", "2")),
+    backoff=float(os.environ.get("GEMINI_BACKOFF", "5"))
+)
+
 from flask import send_from_directory, make_response
 
 @app.route('/sw.js', methods=['GET'])
@@ -4520,6 +4315,19 @@ def sw():
     response.headers['Service-Worker-Allowed'] = '/'
     return response
 
+# Web pushes are queued in PushDelivery and sent from a bounded pool
+push_dispatcher = init_push_dispatcher(
+    app, db, PushSubscription, PushDelivery,
+    workers=int(os.environ.get("PUSH_WORKERS", "16")),
+    interval=int(os.environ.get("PUSH_QUEUE_INTERVAL", "30"))
+)
+
+@app.route("/admin_push_metrics", methods=["GET"])
+def admin_push_metrics():
+    if session.get("admin_email") != ADMIN_EMAIL:
+        return jsonify({"success": False, "msg": "Unauthorized"})
+    return jsonify({"success": True, "metrics": push_dispatcher.metrics()})
+
 @app.route('/api/save_subscription', methods=['POST'])
 def save_subscription():
     sub_data = request.get_json()
@@ -4653,70 +4461,101 @@ def delete_saved_patient(patient_id):
     db.session.commit()
     return jsonify({'success': True, 'msg': 'Patient profile deleted successfully'})
 
+AI_GREETING = "Hello! I'm PrimeCare AI Assistant. How can I help you today?"
+AI_EMPTY_REPLY = "I apologize, but I cannot provide medical diagnosis for those specific symptoms. Please consult a doctor in person or describe your symptoms differently."
+AI_BUSY_REPLY = "Sorry, the clinic's AI assistant is currently busy. Please try again later."
+AI_UNREACHABLE_REPLY = "The AI assistant is momentarily unreachable. Please try again in a few seconds."
+AI_CONFUSED_REPLY = "I'm having trouble understanding that. Could you please rephrase your request?"
+AI_OFFLINE_REPLY = "Sorry, I'm having trouble connecting to the clinic information system right now."
+
+def prepare_triage_request(history):
+    """
+    Everything /ai_triage and /ai_triage/stream need before calling the model:
+    directory, history as genai Contents, reply-cache key and, on a cache
+    hit, the cached reply (the prompt context is then not built at all).
+    """
+    user_id = session.get('user_id')
+    directory = get_doctor_directory()
+
+    question = cacheable_question(history[-10:])
+    cache_key = None
+    if question:
+        today_str = datetime.now(pytz.timezone('Asia/Kolkata')).strftime("%Y-%m-%d")
+        cache_key = (question, directory.version, today_str)
+        cached_reply = ai_reply_cache.get(cache_key)
+        if cached_reply:
+            return {"cached_reply": cached_reply}
+
+    contents = []
+    for msg in history[-10:]:  # Keep last 10 turns max
+        role = msg.get("role", "user")
+        text = msg.get("text", "")
+        if role in ("user", "model") and text:
+            contents.append(
+                genai_types.Content(
+                    role=role,
+                    # Using from_text() which is the safest method in the new SDK
+                    parts=[genai_types.Part.from_text(text=text)] 
+                )
+            )
+
+    return {
+        "cached_reply": None,
+        "directory": directory,
+        "contents": contents,
+        "turn_context": build_user_context(user_id=user_id),
+        # Only replies generated without personal booking data are shared
+        "cache_key": cache_key if not user_id else None
+    }
+
 @app.route("/ai_triage", methods=["POST"])
 def ai_triage():
     """Gemini-powered symptom triage + clinic Q&A endpoint."""
     if not GEMINI_API_KEY:
-        return jsonify({"success": False, "reply": "Hello! I'm PrimeCare AI Assistant. How can I help you today?"})
+        return jsonify({"success": False, "reply": AI_GREETING})
 
     data = request.get_json() or {}
     history = data.get("history", [])  
 
     if not history:
-        return jsonify({"success": False, "reply": "Hello! I'm PrimeCare AI Assistant. How can I help you today?"})
+        return jsonify({"success": False, "reply": AI_GREETING})
 
     try:
-        user_id = session.get('user_id')
-        clinic_context = build_clinic_context(user_id=user_id)
-        system_prompt = GEMINI_SYSTEM_PROMPT.format(clinic_context=clinic_context)
-
-        client = genai.Client(api_key=GEMINI_API_KEY)
-
-        contents = []
-        for msg in history[-10:]:  # Keep last 10 turns max
-            role = msg.get("role", "user")
-            text = msg.get("text", "")
-            if role in ("user", "model") and text:
-                contents.append(
-                    genai_types.Content(
-                        role=role,
-                        # Using from_text() which is the safest method in the new SDK
-                        parts=[genai_types.Part.from_text(text=text)] 
-                    )
-                )
+        req = prepare_triage_request(history)
+        if req["cached_reply"]:
+            return jsonify({"success": True, "reply": req["cached_reply"]})
 
-        import time
         from google.genai.errors import APIError
 
         max_retries = 3
-        reply_text = "Sorry, the clinic's AI assistant is currently busy. Please try again later."
+        reply_text = AI_BUSY_REPLY
         
         for attempt in range(max_retries):
+            if not gemini_governor.acquire():
+                reply_text = AI_BUSY_REPLY
+                break
             try:
-                response = client.models.generate_content(
-                    model="gemini-2.5-flash",
-                    contents=contents,
-                    config=genai_types.GenerateContentConfig(
-                        system_instruction=system_prompt,
-                        temperature=0.7,
-                        max_output_tokens=600,
-                    )
-                )
+                response = gemini_assistant.generate(req["directory"], req["contents"], req["turn_context"],
+                                                     temperature=0.7, max_output_tokens=600)
                 if not response or not response.text:
-                    reply_text = "I apologize, but I cannot provide medical diagnosis for those specific symptoms. Please consult a doctor in person or describe your symptoms differently."
+                    reply_text = AI_EMPTY_REPLY
                     break
                 reply_text = response.text.strip()
+                if req["cache_key"]:
+                    ai_reply_cache.put(req["cache_key"], reply_text)
                 break # Success!
             except APIError as e:
-                if e.code == 429 and attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)
+                if e.code == 429:
+                    # Back off through the governor; the retry only runs if
+                    # a token frees up within its wait deadline
+                    gemini_governor.penalize()
+                    reply_text = AI_BUSY_REPLY
                     continue
-                else:
-                    reply_text = "The AI assistant is momentarily unreachable. Please try again in a few seconds."
-                    break
+                reply_text = AI_UNREACHABLE_REPLY
+                break
             except Exception as e:
                 app.logger.error(f"Generate error: {e}")
-                reply_text = "I'm having trouble understanding that. Could you please rephrase your request?"
+                reply_text = AI_CONFUSED_REPLY
                 break
 
         return jsonify({"success": True, "reply": reply_text})
@@ -4725,8 +4564,86 @@ def ai_triage():
         app.logger.error(f"AI Triage outer error: {e}")
         return jsonify({
             "success": False, 
-            "reply": "Sorry, I'm having trouble connecting to the clinic information system right now."
+            "reply": AI_OFFLINE_REPLY
         })
+
+def ai_sse_response(events):
+    """text/event-stream response for a generator of (event, data) pairs."""
+    def body():
+        for event, data in events:
+            yield format_sse(data, event=event)
+    return Response(
+        stream_with_context(body()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route("/ai_triage/stream", methods=["POST"])
+def ai_triage_stream():
+    """
+    Streaming /ai_triage. Server-Sent Events:
+    - "chunk" {"text"} for each piece of the reply as the model writes it;
+    - "done" {"success", "reply"} with the full reply (or the usual
+      fallback message) to end the stream.
+    Calls go through gemini_governor; a rate-limited call is retried only
+    before the first chunk is sent.
+    """
+    if not GEMINI_API_KEY:
+        return jsonify({"success": False, "reply": AI_GREETING})
+
+    data = request.get_json() or {}
+    history = data.get("history", [])
+    if not history:
+        return jsonify({"success": False, "reply": AI_GREETING})
+
+    try:
+        req = prepare_triage_request(history)
+    except Exception as e:
+        app.logger.error(f"AI Triage outer error: {e}")
+        return jsonify({"success": False, "reply": AI_OFFLINE_REPLY})
+
+    def events():
+        if req["cached_reply"]:
+            yield "chunk", {"text": req["cached_reply"]}
+            yield "done", {"success": True, "reply": req["cached_reply"]}
+            return
+
+        from google.genai.errors import APIError
+
+        max_retries = 3
+        parts = []
+        reply_text = AI_BUSY_REPLY
+        for attempt in range(max_retries):
+            if not gemini_governor.acquire():
+                reply_text = AI_BUSY_REPLY
+                break
+            try:
+                for text in gemini_assistant.generate_stream(req["directory"], req["contents"], req["turn_context"],
+                                                            temperature=0.7, max_output_tokens=600):
+                    parts.append(text)
+                    yield "chunk", {"text": text}
+                reply_text = "".join(parts).strip()
+                if not reply_text:
+                    reply_text = AI_EMPTY_REPLY
+                elif req["cache_key"]:
+                    ai_reply_cache.put(req["cache_key"], reply_text)
+                break
+            except APIError as e:
+                if e.code == 429:
+                    gemini_governor.penalize()
+                    if not parts:
+                        reply_text = AI_BUSY_REPLY
+                        continue
+                reply_text = AI_UNREACHABLE_REPLY
+                break
+            except Exception as e:
+                app.logger.error(f"Generate error: {e}")
+                reply_text = AI_CONFUSED_REPLY
+                break
+
+        yield "done", {"success": True, "reply": reply_text}
+
+    return ai_sse_response(events())
 # ===================== Admin session check =====================
 
 @app.route("/check_admin", methods=["GET"])
@@ -4746,28 +4663,17 @@ def admin_analytics():
     period = request.args.get('period', 'all')
     doctor_filter = request.args.get('doctor', 'all')
     
-    # 1. Fetch all doctors and bookings
+    # 1. Fetch all doctors
     all_doctors = []
     try:
         all_doctors = get_all_doctors()
     except Exception as e:
         print(f"[ERROR] Failed to fetch doctors: {e}")
         
-    bookings = []
-    try:
-        bookings = PatientBooking.query.all()
-    except Exception as e:
-        print(f"[ERROR] Failed to fetch bookings: {e}")
-        
     # 2. Timezone and range setups (IST)
     ist = pytz.timezone('Asia/Kolkata')
     now = datetime.now(ist)
-    
-    def to_ist(dt):
-        if dt is None:
-            return None
-        return pytz.utc.localize(dt).astimezone(ist)
-        
+    today = now.date()
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     
     weekday_idx = now.weekday()
@@ -4776,31 +4682,59 @@ def admin_analytics():
     month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     year_start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
     
-    # 3. Apply Doctor Filter
-    if doctor_filter != 'all':
-        bookings_filtered = [b for b in bookings if b.doctor_name and b.doctor_name.lower().strip() == doctor_filter.lower().strip()]
-    else:
-        bookings_filtered = bookings
-        
-    # 4. Summary cards computations
-    total_bookings_all_time = len(bookings_filtered)
+    # 3. Aggregates come from BookingDailyRollup (one row per doctor per day),
+    #    so the cost does not grow with the booking history
+    R = BookingDailyRollup
+    filter_key = normalize_key(doctor_filter) if doctor_filter != 'all' else None
     
-    bookings_today = sum(1 for b in bookings_filtered if to_ist(b.created_at) and to_ist(b.created_at).date() == now.date())
-    bookings_week = sum(1 for b in bookings_filtered if to_ist(b.created_at) and to_ist(b.created_at) >= week_start)
-    bookings_month = sum(1 for b in bookings_filtered if to_ist(b.created_at) and to_ist(b.created_at) >= month_start)
+    def rollup_query(*columns):
+        q = db.session.query(*columns)
+        if filter_key:
+            q = q.filter(R.doctor_key == filter_key)
+        return q
     
-    total_doctors = len(all_doctors) if doctor_filter == 'all' else 1
-    total_patients = len(set(b.user_id for b in bookings_filtered if b.user_id))
+    def since(day, column):
+        return db.func.coalesce(db.func.sum(db.case((R.day >= day, column), else_=0)), 0)
     
-    completed_bookings = [b for b in bookings_filtered if b.consultation_start_time and b.consultation_end_time and b.status != 'cancelled']
-    total_completed = len(completed_bookings)
-    total_cancelled = sum(1 for b in bookings_filtered if b.status == 'cancelled')
+    # 4. Summary cards computations
+    totals = rollup_query(
+        db.func.coalesce(db.func.sum(R.bookings), 0),
+        since(today, R.bookings),
+        since(week_start.date(), R.bookings),
+        since(month_start.date(), R.bookings),
+        db.func.coalesce(db.func.sum(R.completions), 0),
+        db.func.coalesce(db.func.sum(R.cancellations), 0),
+        db.func.coalesce(db.func.sum(R.consult_seconds), 0)
+    ).one()
+    (total_bookings_all_time, bookings_today, bookings_week, bookings_month,
+     total_completed, total_cancelled, total_seconds) = [int(v) if i < 6 else float(v) for i, v in enumerate(totals)]
+    
+    total_doctors = len(all_doctors) if doctor_filter == 'all' else 1
+    if filter_key:
+        total_patients = db.session.query(db.func.count(db.distinct(PatientBooking.user_id))) \
+            .filter(PatientBooking.user_id.isnot(None), PatientBooking.doctor_key == filter_key).scalar() or 0
+    else:
+        total_patients = system_stats.get()["bookings"]["patients"]
     
     # Average consultation duration
-    total_minutes = sum((b.consultation_end_time - b.consultation_start_time).total_seconds() for b in completed_bookings) / 60.0
-    avg_consultation_duration = round(total_minutes / total_completed, 1) if total_completed > 0 else 0.0
+    avg_consultation_duration = round((total_seconds / 60.0) / total_completed, 1) if total_completed > 0 else 0.0
+    
+    # 5. Doctor Statistics Table Calculations (one grouped query for every doctor)
+    per_doctor = {}
+    for row in db.session.query(
+        R.doctor_key,
+        db.func.coalesce(db.func.sum(R.completions), 0),
+        db.func.coalesce(db.func.sum(R.consult_seconds), 0),
+        since(today, R.completions),
+        since(week_start.date(), R.completions),
+        since(month_start.date(), R.completions),
+        since(year_start.date(), R.completions),
+        db.func.sum(db.case((R.completions > 0, 1), else_=0)),
+        since(week_start.date(), R.consult_seconds),
+        since(month_start.date(), R.consult_seconds)
+    ).group_by(R.doctor_key).all():
+        per_doctor[row[0]] = row[1:]
     
-    # 5. Doctor Statistics Table Calculations
     doctor_stats = []
     
     # Get all unique doctor names from active doctor list
@@ -4808,37 +4742,23 @@ def admin_analytics():
     if doctor_filter != 'all':
         doctor_names = [d for d in doctor_names if d.lower().strip() == doctor_filter.lower().strip()]
         
+    empty_row = (0, 0, 0, 0, 0, 0, 0, 0, 0)
     for doc_name in doctor_names:
-        doc_bookings = [b for b in bookings if b.doctor_name and b.doctor_name.lower().strip() == doc_name.lower().strip()]
-        doc_completed = [b for b in doc_bookings if b.consultation_start_time and b.consultation_end_time and b.status != 'cancelled']
-        
-        doc_today = sum(1 for b in doc_completed if to_ist(b.consultation_end_time) and to_ist(b.consultation_end_time).date() == now.date())
-        doc_week = sum(1 for b in doc_completed if to_ist(b.consultation_end_time) and to_ist(b.consultation_end_time) >= week_start)
-        doc_month = sum(1 for b in doc_completed if to_ist(b.consultation_end_time) and to_ist(b.consultation_end_time) >= month_start)
-        doc_year = sum(1 for b in doc_completed if to_ist(b.consultation_end_time) and to_ist(b.consultation_end_time) >= year_start)
+        (completed, _, doc_today, doc_week, doc_month, doc_year,
+         unique_days, seconds_week, seconds_month) = per_doctor.get(normalize_key(doc_name), empty_row)
         
         # Average consultations per day
-        unique_days = len(set(to_ist(b.consultation_end_time).date() for b in doc_completed))
-        doc_avg_per_day = round(len(doc_completed) / unique_days, 1) if unique_days > 0 else 0.0
-        
-        # Working hours this week/month (duration: end_time - start_time)
-        doc_week_bookings = [b for b in doc_completed if to_ist(b.consultation_end_time) >= week_start]
-        seconds_week = sum((b.consultation_end_time - b.consultation_start_time).total_seconds() for b in doc_week_bookings)
-        doc_hours_week = round(seconds_week / 3600.0, 1)
-        
-        doc_month_bookings = [b for b in doc_completed if to_ist(b.consultation_end_time) >= month_start]
-        seconds_month = sum((b.consultation_end_time - b.consultation_start_time).total_seconds() for b in doc_month_bookings)
-        doc_hours_month = round(seconds_month / 3600.0, 1)
+        doc_avg_per_day = round(completed / unique_days, 1) if unique_days else 0.0
         
         doctor_stats.append({
             "name": doc_name,
-            "today": doc_today,
-            "week": doc_week,
-            "month": doc_month,
-            "year": doc_year,
+            "today": int(doc_today),
+            "week": int(doc_week),
+            "month": int(doc_month),
+            "year": int(doc_year),
             "avg_per_day": doc_avg_per_day,
-            "hours_week": doc_hours_week,
-            "hours_month": doc_hours_month
+            "hours_week": round(float(seconds_week) / 3600.0, 1),
+            "hours_month": round(float(seconds_month) / 3600.0, 1)
         })
         
     # 6. Additional Statistics
@@ -4846,8 +4766,7 @@ def admin_analytics():
     most_consulted_doc = "N/A"
     max_consults = -1
     for doc_name in [d.get("Name") for d in all_doctors]:
-        completed_count = sum(1 for b in bookings if b.doctor_name and b.doctor_name.lower().strip() == doc_name.lower().strip() 
-                              and b.consultation_start_time and b.consultation_end_time and b.status != 'cancelled')
+        completed_count = int(per_doctor.get(normalize_key(doc_name), empty_row)[0])
         if completed_count > max_consults and completed_count > 0:
             max_consults = completed_count
             most_consulted_doc = f"{doc_name} ({completed_count} consults)"
@@ -4856,10 +4775,7 @@ def admin_analytics():
     highest_hours_doc = "N/A"
     max_hours = -1.0
     for doc_name in [d.get("Name") for d in all_doctors]:
-        doc_completed = [b for b in bookings if b.doctor_name and b.doctor_name.lower().strip() == doc_name.lower().strip() 
-                         and b.consultation_start_time and b.consultation_end_time and b.status != 'cancelled']
-        total_sec = sum((b.consultation_end_time - b.consultation_start_time).total_seconds() for b in doc_completed)
-        total_hrs = total_sec / 3600.0
+        total_hrs = float(per_doctor.get(normalize_key(doc_name), empty_row)[1]) / 3600.0
         if total_hrs > max_hours and total_hrs > 0:
             max_hours = total_hrs
             highest_hours_doc = f"{doc_name} ({round(total_hrs, 1)} hrs)"
@@ -4869,21 +4785,15 @@ def admin_analytics():
     holidays_this_year = 0
     holiday_dates = set()
     try:
-        holiday_ws = get_holiday_worksheet()
-        if holiday_ws:
-            all_vals = holiday_ws.get_all_values()
-            if len(all_vals) > 1:
-                for row in all_vals[1:]:
-                    if not row: continue
-                    d_str = str(row[0]).strip()
-                    try:
-                        dt = datetime.strptime(d_str, "%Y-%m-%d")
-                        holiday_dates.add(d_str)
-                        if dt.year == now.year:
-                            holidays_this_year += 1
-                            if dt.month == now.month:
-                                holidays_this_month += 1
-                    except: pass
+        for d_str in get_calendar()["holidays"]:
+            try:
+                dt = datetime.strptime(d_str, "%Y-%m-%d")
+                holiday_dates.add(d_str)
+                if dt.year == now.year:
+                    holidays_this_year += 1
+                    if dt.month == now.month:
+                        holidays_this_month += 1
+            except: pass
     except Exception as e:
         print(f"[ERROR] Failed to fetch holiday statistics: {e}")
         
@@ -4895,46 +4805,46 @@ def admin_analytics():
     trend_labels = []
     trend_values = []
     
+    def bookings_by_day(first_day, last_day):
+        rows = rollup_query(R.day, db.func.sum(R.bookings)) \
+            .filter(R.day >= first_day, R.day <= last_day).group_by(R.day).all()
+        return {day: int(count or 0) for day, count in rows}
+    
     if period == 'today':
+        # Hourly buckets need the booking timestamps; only today's rows are read
         hours = {h: 0 for h in range(24)}
-        for b in bookings_filtered:
-            ist_dt = to_ist(b.created_at)
-            if ist_dt and ist_dt.date() == now.date():
+        today_q = db.session.query(PatientBooking.created_at).filter(
+            PatientBooking.created_at >= today_start.astimezone(pytz.utc).replace(tzinfo=None)
+        )
+        if filter_key:
+            today_q = today_q.filter(PatientBooking.doctor_key == filter_key)
+        for (created_at,) in today_q.all():
+            ist_dt = pytz.utc.localize(created_at).astimezone(ist)
+            if ist_dt.date() == today:
                 hours[ist_dt.hour] += 1
         trend_labels = [f"{h:02d}:00" for h in range(24)]
         trend_values = [hours[h] for h in range(24)]
     elif period == 'this_week':
-        days = {week_start.date() + timedelta(days=d): 0 for d in range(7)}
-        for b in bookings_filtered:
-            ist_dt = to_ist(b.created_at)
-            if ist_dt and ist_dt.date() in days:
-                days[ist_dt.date()] += 1
-        trend_labels = [d.strftime("%a (%d %b)") for d in sorted(days.keys())]
-        trend_values = [days[d] for d in sorted(days.keys())]
+        days = [week_start.date() + timedelta(days=d) for d in range(7)]
+        counts = bookings_by_day(days[0], days[-1])
+        trend_labels = [d.strftime("%a (%d %b)") for d in days]
+        trend_values = [counts.get(d, 0) for d in days]
     elif period == 'this_month':
-        days = {month_start.date() + timedelta(days=d): 0 for d in range(num_days)}
-        for b in bookings_filtered:
-            ist_dt = to_ist(b.created_at)
-            if ist_dt and ist_dt.date() in days:
-                days[ist_dt.date()] += 1
-        trend_labels = [d.strftime("%d %b") for d in sorted(days.keys())]
-        trend_values = [days[d] for d in sorted(days.keys())]
+        days = [month_start.date() + timedelta(days=d) for d in range(num_days)]
+        counts = bookings_by_day(days[0], days[-1])
+        trend_labels = [d.strftime("%d %b") for d in days]
+        trend_values = [counts.get(d, 0) for d in days]
     elif period == 'this_year':
         months = {m: 0 for m in range(1, 13)}
-        for b in bookings_filtered:
-            ist_dt = to_ist(b.created_at)
-            if ist_dt and ist_dt.year == now.year:
-                months[ist_dt.month] += 1
+        for day, count in bookings_by_day(year_start.date(), year_start.date().replace(month=12, day=31)).items():
+            months[day.month] += count
         trend_labels = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
         trend_values = [months[m] for m in range(1, 13)]
     else: # 'all' or default: last 7 days trend
-        days = {(now - timedelta(days=d)).date(): 0 for d in range(7)}
-        for b in bookings_filtered:
-            ist_dt = to_ist(b.created_at)
-            if ist_dt and ist_dt.date() in days:
-                days[ist_dt.date()] += 1
-        trend_labels = [d.strftime("%a (%d %b)") for d in sorted(days.keys())]
-        trend_values = [days[d] for d in sorted(days.keys())]
+        days = [today - timedelta(days=d) for d in range(6, -1, -1)]
+        counts = bookings_by_day(days[0], days[-1])
+        trend_labels = [d.strftime("%a (%d %b)") for d in days]
+        trend_values = [counts.get(d, 0) for d in days]
         
     return render_template(
         "admin_analytics.html",
@@ -4968,110 +4878,135 @@ def is_doctor_working_hours_finished(doctor_name, specialization):
         weekday = now_ist.strftime("%A")
         current_time_str = now_ist.strftime("%H:%M")
         
-        doctors = get_all_doctors()
-        for d in doctors:
-            if d.get("Name").strip().lower() == doctor_name.strip().lower() and d.get("Specialization").strip().lower() == specialization.strip().lower():
-                day_times = d.get("DayTimes", {})
-                time_range = day_times.get(weekday, "")
-                if "-" in time_range:
-                    try:
-                        end_time_str = time_range.replace(" ", "").split("-")[1].strip() # HH:MM format
-                        if current_time_str >= end_time_str:
-                            return True
-                    except:
-                        pass
-                break
+        shift = get_doctor_directory().shift(doctor_name, specialization, weekday)
+        if shift and current_time_str >= shift[1]:  # HH:MM format
+            return True
     except Exception as e:
         print(f"[Error] is_doctor_working_hours_finished: {e}")
     return False
 
-def sync_doctor_session_status(doc_session):
-    try:
-        ist = pytz.timezone('Asia/Kolkata')
-        today_str = datetime.now(ist).strftime("%Y-%m-%d")
-        dt_formatted = datetime.now(ist).strftime("%d-%m-%Y")
-        
-        # Reset session if new day
-        if doc_session.session_date != today_str:
-            doc_session.status = 'idle'
-            doc_session.current_token = 0
-            doc_session.session_date = today_str
-            doc_session.start_time = None
-            doc_session.end_time = None
-            doc_session.skipped_tokens = ""
-            doc_session.broadcast_message = None
-            
-            # Count bookings for this doctor/spec on today's date in local DB (handles both formats)
-            try:
-                today_count = PatientBooking.query.filter(
-                    db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-                    db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-                    (PatientBooking.date == today_str) | (PatientBooking.date == dt_formatted),
-                    PatientBooking.status != 'cancelled'
-                ).count()
-                doc_session.total_tokens = today_count
-            except Exception:
-                doc_session.total_tokens = 0
-                
-            db.session.commit()
-            return
+# ===================== Doctor session state machine =====================
+
+# Columns a state transition may change (see session_state.py)
+SESSION_STATE_FIELDS = ("status", "current_token", "session_date", "total_tokens",
+                        "start_time", "end_time", "skipped_tokens", "broadcast_message")
+
+def has_remaining_patients(doc_session):
+    """True if a live booking at or after the current token is still waiting today."""
+    cur_tok = doc_session.current_token if doc_session.current_token > 0 else 1
+    return db.session.query(PatientBooking.id).filter(
+        PatientBooking.doctor_key == normalize_key(doc_session.doctor_name),
+        PatientBooking.spec_key == normalize_key(doc_session.specialization),
+        PatientBooking.booking_date == as_date(doc_session.session_date),
+        PatientBooking.status != 'cancelled',
+        PatientBooking.token >= cur_tok
+    ).first() is not None
+
+def highest_live_token(doctor_name, specialization, day_str):
+    """
+    total_tokens for a session: the highest token still booked (not cancelled)
+    that day. The booking paths keep it as max(total_tokens, token), so a
+    cancelled token in the middle still leaves the queue running up to it.
+    """
+    return db.session.query(db.func.max(PatientBooking.token)).filter(
+        PatientBooking.doctor_key == normalize_key(doctor_name),
+        PatientBooking.spec_key == normalize_key(specialization),
+        PatientBooking.booking_date == as_date(day_str),
+        PatientBooking.status != 'cancelled'
+    ).scalar() or 0
+
+def advance_doctor_session(doc_session):
+    """next_token/skip_token moved current_token; the caller commits."""
+    shift_over = is_doctor_working_hours_finished(doc_session.doctor_name, doc_session.specialization)
+    has_remaining = has_remaining_patients(doc_session) if shift_over else True
+    session_state.advance(doc_session, shift_over, has_remaining, datetime.now(pytz.timezone('Asia/Kolkata')))
+
+def next_session_deadline(now_ist):
+    """Earliest shift end still ahead today, for SessionScheduler."""
+    directory = get_doctor_directory()
+    weekday = now_ist.strftime("%A")
+    now_hm = now_ist.strftime("%H:%M")
+    ends = sorted(
+        shift[1] for d in directory.working_on(weekday)
+        if (shift := directory.shift(d.get("Name"), d.get("Specialization"), weekday)) and shift[1] > now_hm
+    )
+    if not ends:
+        return None
+    hour, minute = (int(x) for x in ends[0].split(":"))
+    return now_ist.replace(hour=hour, minute=minute, second=0, microsecond=0)
 
-        if doc_session.status == 'completed':
-            return
+def apply_session_timer(doc_session, transition):
+    """
+    Run a timer transition on a copy of the session's state and write only
+    the fields it changed, with a conditional UPDATE. If the doctor's routes
+    or another worker moved the queue since the row was read, nothing is
+    written. Returns True if this call applied the change.
+    """
+    state = SimpleNamespace(**{f: getattr(doc_session, f) for f in SESSION_STATE_FIELDS})
+    if not transition(state):
+        return False
+    changes = {f: getattr(state, f) for f in SESSION_STATE_FIELDS if getattr(state, f) != getattr(doc_session, f)}
+    if not changes:
+        return False
+    claimed = DoctorSession.query.filter(
+        DoctorSession.id == doc_session.id,
+        DoctorSession.status == doc_session.status,
+        DoctorSession.session_date == doc_session.session_date,
+        DoctorSession.current_token == doc_session.current_token,
+        DoctorSession.skipped_tokens == doc_session.skipped_tokens
+    ).update(changes, synchronize_session=False)
+    db.session.commit()
+    if claimed:
+        # Bulk UPDATE skips the before_flush listener
+        invalidate_live_snapshot()
+    return claimed == 1
 
-        # Check if the doctor's working hours have finished
-        hours_finished = is_doctor_working_hours_finished(doc_session.doctor_name, doc_session.specialization)
-        
-        # Check if there are any remaining booked patients for today (handles both formats)
-        cur_tok = doc_session.current_token if doc_session.current_token > 0 else 1
-        remaining_bookings = PatientBooking.query.filter(
-            db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-            db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-            (PatientBooking.date == today_str) | (PatientBooking.date == dt_formatted),
-            PatientBooking.status != 'cancelled',
-            PatientBooking.token >= cur_tok
-        ).all()
-        has_remaining_patients = len(remaining_bookings) > 0
-
-        # Auto-complete session if working hours have finished
-        should_complete = False
-        if hours_finished:
-            if doc_session.status == 'active':
-                # Active session only completes when no further patients are in the queue
-                if not has_remaining_patients:
-                    should_complete = True
-            elif doc_session.status in ['idle', 'waiting_bookings']:
-                # Idle or waiting sessions complete immediately once shift ends
-                should_complete = True
-
-        if should_complete:
-            doc_session.status = 'completed'
-            doc_session.end_time = datetime.now(ist).strftime("%H:%M %p")
-            if doc_session.current_token > doc_session.total_tokens:
-                doc_session.current_token = doc_session.total_tokens if doc_session.total_tokens > 0 else 0
-            db.session.commit()
+def run_session_timers(now_ist):
+    """Midnight rollover and shift-end completion for every doctor session. Safe to repeat."""
+    today_str = now_ist.strftime("%Y-%m-%d")
+    weekday = now_ist.strftime("%A")
+    now_hm = now_ist.strftime("%H:%M")
+    directory = get_doctor_directory()
+    sessions = DoctorSession.query.all()
+
+    stale = [s for s in sessions if s.session_date != today_str]
+    if stale:
+        # Highest live token per doctor, as in highest_live_token()
+        counts = dict(
+            ((doctor_key, spec_key), n) for doctor_key, spec_key, n in db.session.query(
+                PatientBooking.doctor_key, PatientBooking.spec_key, db.func.max(PatientBooking.token)
+            ).filter(
+                PatientBooking.booking_date == as_date(today_str),
+                PatientBooking.status != 'cancelled'
+            ).group_by(PatientBooking.doctor_key, PatientBooking.spec_key).all()
+        )
+        for doc_session in stale:
+            total = counts.get((normalize_key(doc_session.doctor_name), normalize_key(doc_session.specialization))) or 0
+            if apply_session_timer(doc_session, lambda st: session_state.rollover(st, today_str, total)):
+                db.session.refresh(doc_session)
+                publish_session_event(doc_session, "rollover")
+
+    for doc_session in sessions:
+        if doc_session.session_date != today_str or doc_session.status == session_state.COMPLETED:
+            continue
+        shift = directory.shift(doc_session.doctor_name, doc_session.specialization, weekday)
+        if not shift or now_hm < shift[1]:
+            continue
+        has_remaining = doc_session.status == session_state.ACTIVE and has_remaining_patients(doc_session)
+        if apply_session_timer(doc_session, lambda st: session_state.shift_ended(st, has_remaining, now_ist)):
+            db.session.refresh(doc_session)
+            publish_session_event(doc_session, "shift_end")
             try:
                 from push_services import trigger_push
                 trigger_push(doc_session.doctor_name, doc_session.session_date, doc_session.current_token, "completed", app, db, PatientBooking, PushSubscription)
             except Exception as e:
                 print(f"Push Error: {e}")
-            return
-
-        if doc_session.status == 'idle':
-            # Idle sessions remain idle until explicitly started
-            return
 
-        total_tokens = doc_session.total_tokens
-        if total_tokens >= doc_session.current_token and total_tokens > 0:
-            if doc_session.status != 'active':
-                doc_session.status = 'active'
-                db.session.commit()
-        else:
-            if doc_session.status != 'waiting_bookings':
-                doc_session.status = 'waiting_bookings'
-                db.session.commit()
-    except Exception as e:
-        print(f"[Error] sync_doctor_session_status: {e}")
+# Applies shift-end and midnight transitions on time so read paths never write
+session_scheduler = SessionScheduler(
+    app, next_session_deadline, run_session_timers,
+    max_sleep=int(os.environ.get("SESSION_SCHEDULER_MAX_SLEEP", "300"))
+)
 
 # ===================== LIVE TOKEN TRACKING =====================
 
@@ -5090,22 +5025,11 @@ def doctor_dashboard():
     today_str = datetime.now(ist).strftime("%Y-%m-%d")
     dt_formatted = datetime.now(ist).strftime("%d-%m-%Y")
     
-    # Reset session if new day
-    if doc_session.session_date != today_str:
-        doc_session.status = 'idle'
-        doc_session.current_token = 0
-        doc_session.session_date = today_str
-        doc_session.total_tokens = 0
-        doc_session.start_time = None
-        doc_session.end_time = None
-        doc_session.skipped_tokens = ""
-        db.session.commit()
-    
     # Fetch local SQLite bookings for today as fallback / verification source
     db_bookings_today = PatientBooking.query.filter(
-        db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-        db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-        (PatientBooking.date == today_str) | (PatientBooking.date == dt_formatted),
+        PatientBooking.doctor_key == normalize_key(doc_session.doctor_name),
+        PatientBooking.spec_key == normalize_key(doc_session.specialization),
+        PatientBooking.booking_date == as_date(today_str),
         PatientBooking.status != 'cancelled'
     ).order_by(PatientBooking.token.asc()).all()
 
@@ -5116,22 +5040,16 @@ def doctor_dashboard():
     loaded_from_sheet = False
 
     try:
-        doctors = get_all_doctors()
-        sheet_url = None
-        for d in doctors:
-            if d.get("Name").strip().lower() == doc_session.doctor_name.strip().lower() and d.get("Specialization").strip().lower() == doc_session.specialization.strip().lower():
-                sheet_url = d.get("SheetURL")
-                break
+        doc_info = get_doctor_directory().find(doc_session.doctor_name, doc_session.specialization)
+        sheet_url = doc_info.get("SheetURL") if doc_info else None
                 
         if sheet_url:
-            s = client.open_by_url(sheet_url)
+            s = open_doctor_spreadsheet(sheet_url)
             try:
                 ws = s.worksheet(dt_formatted)
                 records = get_worksheet_records_safe(ws)
-                doc_session.total_tokens = len(records)
-                sync_doctor_session_status(doc_session)
                 
-                skipped_set = set(doc_session.skipped_tokens.split(",")) if doc_session.skipped_tokens else set()
+                queue = doc_session.queue
                 
                 for r in records:
                     t_val = r.get("Token")
@@ -5139,15 +5057,7 @@ def doctor_dashboard():
                     if p_name:
                         total_booked += 1
                         
-                        t_str = str(t_val)
-                        if t_str in skipped_set:
-                            b_status = "skipped"
-                        elif doc_session.status == "active" and t_val == doc_session.current_token:
-                            b_status = "calling"
-                        elif doc_session.status in ["completed", "waiting_bookings"] or (doc_session.status == "active" and t_val < doc_session.current_token):
-                            b_status = "consulted"
-                        else:
-                            b_status = "waiting"
+                        b_status = queue.state_of(t_val)
                             
                         today_bookings.append({
                             "token": t_val,
@@ -5161,8 +5071,7 @@ def doctor_dashboard():
                         empty_slots.append(t_val)
                 loaded_from_sheet = True
             except gspread.exceptions.WorksheetNotFound:
-                doc_session.total_tokens = 0
-            db.session.commit()
+                pass
     except Exception as e:
         app.logger.warning(f"Could not calculate total tokens for {doc_session.doctor_name} from Google Sheet: {e}")
 
@@ -5171,47 +5080,31 @@ def doctor_dashboard():
         today_bookings = []
         total_booked = 0
         empty_slots = []
-        doc_session.total_tokens = len(db_bookings_today)
-        sync_doctor_session_status(doc_session)
         
-        skipped_set = set(doc_session.skipped_tokens.split(",")) if doc_session.skipped_tokens else set()
+        queue = doc_session.queue
         for b in db_bookings_today:
             t_val = b.token
             p_name = b.patient_name
             total_booked += 1
             
-            t_str = str(t_val)
-            if t_str in skipped_set:
-                b_status = "skipped"
-            elif doc_session.status == "active" and t_val == doc_session.current_token:
-                b_status = "calling"
-            elif doc_session.status in ["completed", "waiting_bookings"] or (doc_session.status == "active" and t_val < doc_session.current_token):
-                b_status = "consulted"
-            else:
-                b_status = "waiting"
+            b_status = queue.state_of(t_val)
                 
             today_bookings.append({
                 "token": t_val,
                 "name": p_name,
                 "age": b.age or "-",
-                "gender": "Not Specified",
-                "phone": "",
+                "gender": b.gender or "Not Specified",
+                "phone": b.phone_number or "",
                 "status": b_status
             })
-        db.session.commit()
         
     # Compute today's scheduled start time for the push notification reminder
     sched_start_today = ""
     try:
-        all_docs_for_start = get_all_doctors()
         weekday_today = datetime.now(ist).strftime("%A")
-        for d in all_docs_for_start:
-            if (d.get("Name", "").strip().lower() == doc_session.doctor_name.strip().lower() and
-                    d.get("Specialization", "").strip().lower() == doc_session.specialization.strip().lower()):
-                tr = d.get("DayTimes", {}).get(weekday_today, "")
-                if "-" in tr:
-                    sched_start_today = tr.replace(" ", "").split("-")[0].strip()
-                break
+        shift = get_doctor_directory().shift(doc_session.doctor_name, doc_session.specialization, weekday_today)
+        if shift:
+            sched_start_today = shift[0]
     except Exception:
         pass
 
@@ -5343,18 +5236,12 @@ def start_session():
         
     ist = pytz.timezone('Asia/Kolkata')
     today_str = datetime.now(ist).strftime("%Y-%m-%d")
-    dt_formatted = datetime.now(ist).strftime("%d-%m-%Y")
     
-    # Self-healing fallback: If total_tokens is 0 but SQLite has today's bookings, restore the correct count
+    # Self-healing fallback: If total_tokens is 0 but SQLite has today's bookings, restore the highest live token
     if doc_session.total_tokens == 0:
-        sqlite_count = PatientBooking.query.filter(
-            db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-            db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-            (PatientBooking.date == today_str) | (PatientBooking.date == dt_formatted),
-            PatientBooking.status != 'cancelled'
-        ).count()
-        if sqlite_count > 0:
-            doc_session.total_tokens = sqlite_count
+        highest_token = highest_live_token(doc_session.doctor_name, doc_session.specialization, today_str)
+        if highest_token > 0:
+            doc_session.total_tokens = highest_token
             db.session.commit()
 
     if doc_session.total_tokens == 0:
@@ -5369,9 +5256,9 @@ def start_session():
     
     # Start first patient's consultation time (using robust date filter)
     first_booking = PatientBooking.query.filter(
-        db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-        db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-        (PatientBooking.date == today_str) | (PatientBooking.date == dt_formatted),
+        PatientBooking.doctor_key == normalize_key(doc_session.doctor_name),
+        PatientBooking.spec_key == normalize_key(doc_session.specialization),
+        PatientBooking.booking_date == as_date(today_str),
         PatientBooking.token == 1,
         PatientBooking.status != 'cancelled'
     ).first()
@@ -5379,6 +5266,7 @@ def start_session():
         first_booking.consultation_start_time = datetime.utcnow()
         
     db.session.commit()
+    publish_session_event(doc_session, "start_session")
     
     try:
         from push_services import trigger_push
@@ -5405,6 +5293,7 @@ def complete_session():
     if doc_session.current_token > doc_session.total_tokens:
         doc_session.current_token = doc_session.total_tokens if doc_session.total_tokens > 0 else 0
     db.session.commit()
+    publish_session_event(doc_session, "complete_session")
     
     try:
         from push_services import trigger_push
@@ -5425,16 +5314,11 @@ def next_token():
     if not doc_session or doc_session.status != 'active':
         return jsonify(success=False, msg="Session not active")
         
-    try:
-        dt_formatted = datetime.strptime(doc_session.session_date, "%Y-%m-%d").strftime("%d-%m-%Y")
-    except Exception:
-        dt_formatted = doc_session.session_date
-
     # End current consultation
     prev_booking = PatientBooking.query.filter(
-        db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-        db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-        (PatientBooking.date == doc_session.session_date) | (PatientBooking.date == dt_formatted),
+        PatientBooking.doctor_key == normalize_key(doc_session.doctor_name),
+        PatientBooking.spec_key == normalize_key(doc_session.specialization),
+        PatientBooking.booking_date == as_date(doc_session.session_date),
         PatientBooking.token == doc_session.current_token,
         PatientBooking.status != 'cancelled'
     ).first()
@@ -5443,14 +5327,14 @@ def next_token():
 
     doc_session.current_token += 1
     
-    sync_doctor_session_status(doc_session)
+    advance_doctor_session(doc_session)
     
     if doc_session.status == "active":
         # Start next patient's consultation time
         next_booking = PatientBooking.query.filter(
-            db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-            db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-            (PatientBooking.date == doc_session.session_date) | (PatientBooking.date == dt_formatted),
+            PatientBooking.doctor_key == normalize_key(doc_session.doctor_name),
+            PatientBooking.spec_key == normalize_key(doc_session.specialization),
+            PatientBooking.booking_date == as_date(doc_session.session_date),
             PatientBooking.token == doc_session.current_token,
             PatientBooking.status != 'cancelled'
         ).first()
@@ -5458,11 +5342,14 @@ def next_token():
             next_booking.consultation_start_time = datetime.utcnow()
         
     db.session.commit()
+    publish_session_event(doc_session, "next_token")
     
     try:
         from push_services import trigger_push
         if doc_session.status == "active":
             trigger_push(doc_session.doctor_name, doc_session.session_date, doc_session.current_token, "active", app, db, PatientBooking, PushSubscription)
+        elif doc_session.status == "completed":
+            trigger_push(doc_session.doctor_name, doc_session.session_date, doc_session.current_token, "completed", app, db, PatientBooking, PushSubscription)
     except Exception as e:
         print(f"Push Error: {e}")
     
@@ -5484,39 +5371,31 @@ def skip_token():
     if not doc_session or doc_session.status != 'active':
         return jsonify(success=False, msg="Session not active")
  
-    try:
-        dt_formatted = datetime.strptime(doc_session.session_date, "%Y-%m-%d").strftime("%d-%m-%Y")
-    except Exception:
-        dt_formatted = doc_session.session_date
-
     # Clear start time of skipped token so we ignore it
     skipped_booking = PatientBooking.query.filter(
-        db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-        db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-        (PatientBooking.date == doc_session.session_date) | (PatientBooking.date == dt_formatted),
+        PatientBooking.doctor_key == normalize_key(doc_session.doctor_name),
+        PatientBooking.spec_key == normalize_key(doc_session.specialization),
+        PatientBooking.booking_date == as_date(doc_session.session_date),
         PatientBooking.token == doc_session.current_token,
         PatientBooking.status != 'cancelled'
     ).first()
     if skipped_booking:
         skipped_booking.consultation_start_time = None
 
-    # Add current token to skipped list
-    skipped = doc_session.skipped_tokens.strip().split(',') if doc_session.skipped_tokens else []
-    skipped.append(str(doc_session.current_token))
-    doc_session.skipped_tokens = ",".join(skipped)
-    
+    # Add current token to skipped list and move to the next token
     skipped_tok = doc_session.current_token
-    # Move to next token
-    doc_session.current_token += 1
+    queue = doc_session.queue.skip_current()
+    doc_session.skipped_tokens = queue.encode()
+    doc_session.current_token = queue.current_token
     
-    sync_doctor_session_status(doc_session)
+    advance_doctor_session(doc_session)
     
     if doc_session.status == "active":
         # Start next patient's consultation time
         next_booking = PatientBooking.query.filter(
-            db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-            db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-            (PatientBooking.date == doc_session.session_date) | (PatientBooking.date == dt_formatted),
+            PatientBooking.doctor_key == normalize_key(doc_session.doctor_name),
+            PatientBooking.spec_key == normalize_key(doc_session.specialization),
+            PatientBooking.booking_date == as_date(doc_session.session_date),
             PatientBooking.token == doc_session.current_token,
             PatientBooking.status != 'cancelled'
         ).first()
@@ -5524,6 +5403,7 @@ def skip_token():
             next_booking.consultation_start_time = datetime.utcnow()
         
     db.session.commit()
+    publish_session_event(doc_session, "skip_token")
     
     try:
         from push_services import trigger_push
@@ -5532,6 +5412,8 @@ def skip_token():
         # Send alert for the new current token
         if doc_session.status == "active":
             trigger_push(doc_session.doctor_name, doc_session.session_date, doc_session.current_token, "active", app, db, PatientBooking, PushSubscription)
+        elif doc_session.status == "completed":
+            trigger_push(doc_session.doctor_name, doc_session.session_date, doc_session.current_token, "completed", app, db, PatientBooking, PushSubscription)
     except Exception as e:
         print(f"Push Error: {e}")
  
@@ -5557,21 +5439,15 @@ def consult_skipped():
     if not doc_session or not target_token:
         return jsonify(success=False, msg="Invalid request")
 
-    skipped = doc_session.skipped_tokens.strip().split(',') if doc_session.skipped_tokens else []
-    if target_token in skipped:
-        skipped.remove(target_token)
-        doc_session.skipped_tokens = ",".join(skipped)
+    queue = doc_session.queue.recall(target_token)
+    if queue is not None:
+        doc_session.skipped_tokens = queue.encode()
         
-        try:
-            dt_formatted = datetime.strptime(doc_session.session_date, "%Y-%m-%d").strftime("%d-%m-%Y")
-        except Exception:
-            dt_formatted = doc_session.session_date
-
         # Set start and end time for consulted skipped token
         booking = PatientBooking.query.filter(
-            db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doc_session.doctor_name.lower().strip(),
-            db.func.lower(db.func.trim(PatientBooking.specialization)) == doc_session.specialization.lower().strip(),
-            (PatientBooking.date == doc_session.session_date) | (PatientBooking.date == dt_formatted),
+            PatientBooking.doctor_key == normalize_key(doc_session.doctor_name),
+            PatientBooking.spec_key == normalize_key(doc_session.specialization),
+            PatientBooking.booking_date == as_date(doc_session.session_date),
             PatientBooking.token == int(target_token),
             PatientBooking.status != 'cancelled'
         ).first()
@@ -5580,6 +5456,7 @@ def consult_skipped():
             booking.consultation_end_time = datetime.utcnow()
             
         db.session.commit()
+        publish_session_event(doc_session, "consult_skipped")
         return jsonify(success=True, skipped_tokens=doc_session.skipped_tokens)
     
     return jsonify(success=False, msg="Token not found in skipped list")
@@ -5598,8 +5475,8 @@ def save_doctor_broadcast():
         return jsonify(success=False, msg="Doctor name and specialization are required.")
     
     doc_session = DoctorSession.query.filter(
-        db.func.lower(db.func.trim(DoctorSession.doctor_name)) == doctor_name.lower().strip(),
-        db.func.lower(db.func.trim(DoctorSession.specialization)) == specialization.lower().strip()
+        DoctorSession.doctor_key == normalize_key(doctor_name),
+        DoctorSession.spec_key == normalize_key(specialization)
     ).first()
     
     if not doc_session:
@@ -5607,6 +5484,7 @@ def save_doctor_broadcast():
     
     doc_session.broadcast_message = message
     db.session.commit()
+    publish_session_event(doc_session, "broadcast")
     return jsonify(success=True, msg="Broadcast alert updated.")
 
 @app.route('/live-tracking')
@@ -5620,10 +5498,36 @@ def live_tracking():
                                msg='Login to view live tracking of doctors'))
     return render_template('live_tracking.html')
 
-@app.route('/live_tokens', methods=['GET'])
-def live_tokens():
-    ist = pytz.timezone('Asia/Kolkata')
-    now = datetime.now(ist)
+# ===================== Live token snapshot =====================
+
+LIVE_SNAPSHOT = {
+    "payload": None,            # shared part of the /live_tokens response
+    "digest": "",               # hash of payload, combined with user_tokens into the ETag
+    "day": None,                # "YYYY-MM-DD" the payload was built for
+    "directory_version": None,  # DoctorDirectory.version the payload was built from
+    "stale": True,              # set by mark_live_snapshot_stale on session/ticker changes
+    "ts": 0.0,                  # timestamp of last build
+    "ttl": 5.0                  # seconds before time-driven status changes are picked up
+}
+LIVE_SNAPSHOT_LOCK = threading.Lock()
+
+def invalidate_live_snapshot():
+    LIVE_SNAPSHOT["stale"] = True
+
+@event.listens_for(db.session, "before_flush")
+def mark_live_snapshot_stale(db_session, flush_context, instances):
+    """Any real change to a DoctorSession, ticker message or setting rebuilds the snapshot."""
+    for obj in list(db_session.new) + list(db_session.deleted):
+        if isinstance(obj, (DoctorSession, TickerMessage, AppSettings)):
+            invalidate_live_snapshot()
+            return
+    for obj in db_session.dirty:
+        if isinstance(obj, (DoctorSession, TickerMessage, AppSettings)) and db_session.is_modified(obj):
+            invalidate_live_snapshot()
+            return
+
+def build_live_snapshot(directory, now):
+    """Doctor statuses, holidays and ticker messages shared by every /live_tokens caller."""
     today_str = now.strftime("%Y-%m-%d")
     tomorrow_str = (now + timedelta(days=1)).strftime("%Y-%m-%d")
     weekday = now.strftime("%A")
@@ -5632,46 +5536,37 @@ def live_tokens():
     today_holiday = None
     tomorrow_holiday = None
     try:
-        holiday_ws = get_holiday_worksheet()
-        all_vals = holiday_ws.get_all_values()
-        if len(all_vals) > 1:
-            for row in all_vals[1:]:
-                if not row: continue
-                d_str = str(row[0]).strip()
-                reason = (row[1] if len(row) > 1 else "Clinic Leave").strip()
-                if d_str == today_str: today_holiday = reason
-                if d_str == tomorrow_str: tomorrow_holiday = reason
+        holidays = get_calendar()["holidays"]
+        today_holiday = holidays.get(today_str)
+        tomorrow_holiday = holidays.get(tomorrow_str)
     except: pass
 
     # ── Fetch Admin Messages ──
     # Only return messages that are active today (start_time <= now <= end_time)
-    ist = pytz.timezone('Asia/Kolkata')
-    now_naive = datetime.now(ist).replace(tzinfo=None)
+    now_naive = now.replace(tzinfo=None)
     active_msgs = TickerMessage.query.filter(
         (TickerMessage.start_time == None) | (TickerMessage.start_time <= now_naive),
         (TickerMessage.end_time == None) | (TickerMessage.end_time >= now_naive)
     ).all()
     admin_msgs = [{"content": m.content, "color_dot": m.color_dot or "yellow"} for m in active_msgs]
-    solo_setting = AppSettings.query.filter_by(key="ticker_solo_mode").first()
-    is_solo = solo_setting.value == "enabled" if solo_setting else False
-    
+    is_solo = get_setting_value("ticker_solo_mode") == "enabled"
+
     # ── Fetch Doctor Statuses ──
     response_data = []
     try:
-        all_docs = get_all_doctors()
-        working_today = [d for d in all_docs if weekday in d.get("Days", [])]
-        
+        working_today = directory.working_on(weekday)
+        sessions = {}
+        if working_today:
+            for doc_session in DoctorSession.query.filter(
+                DoctorSession.doctor_key.in_([normalize_key(d.get("Name")) for d in working_today])
+            ).all():
+                sessions.setdefault((doc_session.doctor_key, doc_session.spec_key), doc_session)
+
         for d in working_today:
             doc_name = d.get("Name")
             doc_spec = d.get("Specialization")
-            
-            doc_session = DoctorSession.query.filter(
-                db.func.lower(db.func.trim(DoctorSession.doctor_name)) == doc_name.lower().strip(),
-                db.func.lower(db.func.trim(DoctorSession.specialization)) == doc_spec.lower().strip()
-            ).first()
-            
-            if doc_session:
-                sync_doctor_session_status(doc_session)
+
+            doc_session = sessions.get((normalize_key(doc_name), normalize_key(doc_spec)))
             
             status = "Yet to start"
             status_raw = "idle"
@@ -5694,11 +5589,8 @@ def live_tokens():
             day_times_map = (d.get("DayTimes") or {})
             time_range_str = day_times_map.get(weekday, "Not Set")
             
-            sched_start = "99:99"
-            if " - " in time_range_str:
-                try:
-                    sched_start = time_range_str.split(" - ")[0].strip()
-                except: pass
+            shift = directory.shift(doc_name, doc_spec, weekday)
+            sched_start = shift[0] if shift else "99:99"
 
             session_start = ""
             session_end = ""
@@ -5721,16 +5613,67 @@ def live_tokens():
                 "broadcast_message": broadcast_message
             })
     except: pass
-        
+
+    return {
+        "data": response_data,
+        "today_holiday": today_holiday,
+        "tomorrow_holiday": tomorrow_holiday,
+        "admin_messages": admin_msgs,
+        "solo_mode": is_solo
+    }
+
+def get_live_snapshot():
+    """
+    Shared /live_tokens payload, rebuilt at most once per TTL.
+
+    - mark_live_snapshot_stale and invalidate_calendar_cache() force an
+      earlier rebuild when a session, ticker message or holiday changes.
+    - A new day or a roster change (directory version) also rebuilds it.
+    """
+    global LIVE_SNAPSHOT
+
+    ist = pytz.timezone('Asia/Kolkata')
+    now = datetime.now(ist)
+    today_str = now.strftime("%Y-%m-%d")
+    directory = get_doctor_directory()
+
+    with LIVE_SNAPSHOT_LOCK:
+        snap = LIVE_SNAPSHOT
+        if (
+            snap["payload"] is not None
+            and not snap["stale"]
+            and snap["day"] == today_str
+            and snap["directory_version"] == directory.version
+            and (time.time() - snap["ts"]) < snap["ttl"]
+        ):
+            return snap
+
+        payload = build_live_snapshot(directory, now)
+        digest = hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+        LIVE_SNAPSHOT = {
+            "payload": payload,
+            "digest": digest,
+            "day": today_str,
+            "directory_version": directory.version,
+            "stale": False,
+            "ts": time.time(),
+            "ttl": snap["ttl"]
+        }
+        return LIVE_SNAPSHOT
+
+@app.route('/live_tokens', methods=['GET'])
+def live_tokens():
+    snapshot = get_live_snapshot()
+    today_str = snapshot["day"]
+
     # ── Fetch User's Own Tokens Today ──
     user_tokens = {}
     user_id = session.get('user_id')
     if user_id:
         try:
-            dt_formatted = now.strftime("%d-%m-%Y")
             my_bookings = PatientBooking.query.filter(
                 PatientBooking.user_id == user_id,
-                (PatientBooking.date == today_str) | (PatientBooking.date == dt_formatted)
+                PatientBooking.booking_date == as_date(today_str)
             ).all()
             for b in my_bookings:
                 # Key by lowered (doctor, spec) for robust matching
@@ -5744,15 +5687,83 @@ def live_tokens():
                 user_tokens[k].sort()
         except: pass
 
-    return jsonify({
-        "success": True, 
-        "data": response_data,
-        "user_tokens": user_tokens,
-        "today_holiday": today_holiday,
-        "tomorrow_holiday": tomorrow_holiday,
-        "admin_messages": admin_msgs,
-        "solo_mode": is_solo
+    etag = hashlib.sha1(
+        f"{snapshot['digest']}|{json.dumps(user_tokens, sort_keys=True)}".encode()
+    ).hexdigest()
+
+    response = jsonify({
+        "success": True,
+        **snapshot["payload"],
+        "user_tokens": user_tokens
     })
+    # Pollers revalidate every time; unchanged snapshots come back as 304 with no body
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+# ===================== Live token stream (SSE) =====================
+
+LIVE_STREAM_MAX_SECONDS = int(os.environ.get("LIVE_STREAM_MAX_SECONDS", "300"))
+
+def publish_session_event(doc_session, action):
+    """Push a doctor's session state to /live_tokens/stream subscribers (call after commit)."""
+    live_sessions.update(doc_session)
+    try:
+        live_event_broker.publish("session", {
+            "action": action,
+            "doctor_name": doc_session.doctor_name,
+            "specialization": doc_session.specialization,
+            "session_date": doc_session.session_date,
+            "status_raw": doc_session.status,
+            "current_token": doc_session.current_token,
+            "total_tokens": doc_session.total_tokens,
+            "skipped_tokens": doc_session.skipped_tokens or "",
+            "broadcast_message": doc_session.broadcast_message or "",
+            "session_start": doc_session.start_time or "",
+            "session_end": doc_session.end_time or ""
+        })
+    except Exception as e:
+        print(f"[Live Stream] Failed to publish {action}: {e}")
+
+def publish_booking_event(booking, action):
+    """Today's bookings change total_tokens on the live boards; later dates are not streamed."""
+    today = datetime.now(pytz.timezone('Asia/Kolkata')).date()
+    if booking.booking_date != today:
+        return
+    try:
+        live_event_broker.publish("booking", {
+            "action": action,
+            "doctor_name": booking.doctor_name,
+            "specialization": booking.specialization,
+            "token": booking.token
+        })
+    except Exception as e:
+        print(f"[Live Stream] Failed to publish {action}: {e}")
+
+@app.route('/live_tokens/stream', methods=['GET'])
+def live_tokens_stream():
+    """
+    Server-Sent Events feed of session changes.
+    EventSource resends Last-Event-ID on reconnect; ?last_event_id= does the same for manual resumes.
+    """
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    return Response(
+        live_event_broker.stream(last_event_id, max_seconds=LIVE_STREAM_MAX_SECONDS),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ===================== Patient token status =====================
+
+live_sessions = LiveSessionMap(
+    lambda day_str: DoctorSession.query.filter(DoctorSession.session_date == day_str).all(),
+    ttl=float(os.environ.get("LIVE_SESSIONS_TTL", "5"))
+)
 
 @app.route('/my_token_status', methods=['GET'])
 def my_token_status():
@@ -5767,57 +5778,54 @@ def my_token_status():
         
     ist = pytz.timezone('Asia/Kolkata')
     today_str = datetime.now(ist).strftime("%Y-%m-%d")
-    dt_formatted = datetime.now(ist).strftime("%d-%m-%Y")
     
-    # Debug: Print incoming status request details
-    print(f"\n[DEBUG] Token Status Request for user_id: {user_id} on {today_str}")
-    
-    # Find all patient's bookings for today (handles both YYYY-MM-DD and DD-MM-YYYY)
+    # Find all patient's live bookings for today; a cancelled token may
+    # already belong to someone else
     bookings = PatientBooking.query.filter(
         PatientBooking.user_id == user_id,
-        (PatientBooking.date == today_str) | (PatientBooking.date == dt_formatted)
+        PatientBooking.booking_date == as_date(today_str),
+        PatientBooking.status != 'cancelled'
     ).all()
     if not bookings:
         return jsonify({"success": False, "msg": "No booking today", "data": []})
     
+    sessions = live_sessions.states(today_str)
     results = []
     for booking in bookings:
-        # Find active doctor session
-        doc_session = DoctorSession.query.filter(
-            db.func.lower(db.func.trim(DoctorSession.doctor_name)) == booking.doctor_name.lower().strip(),
-            db.func.lower(db.func.trim(DoctorSession.specialization)) == booking.specialization.lower().strip(),
-            DoctorSession.session_date == today_str
-        ).first()
-        
-        if not doc_session:
+        state = sessions.get((booking.doctor_key or normalize_key(booking.doctor_name),
+                              booking.spec_key or normalize_key(booking.specialization)))
+        if not state:
             continue
 
+        queue = state["queue"]
         item = {
             "doctor_name": booking.doctor_name,
             "specialization": booking.specialization,
             "your_token": booking.token,
-            "current_token": doc_session.current_token,
-            "status": "idle",
-            "patients_ahead": booking.token - doc_session.current_token,
+            "current_token": queue.current_token,
+            "status": queue.status,
+            "patients_ahead": queue.patients_ahead(booking.token),
             "date": booking.date,
             "msg": ""
         }
 
-        if doc_session.session_date == today_str:
-            item["status"] = doc_session.status
-            
-            skipped = doc_session.skipped_tokens.strip().split(',') if doc_session.skipped_tokens else []
-            if str(booking.token) in skipped:
-                item["status"] = "skipped"
-            elif booking.token < doc_session.current_token:
-                item["status"] = "consulted"
+        if queue.is_skipped(booking.token):
+            item["status"] = "skipped"
+        elif booking.token < queue.current_token:
+            item["status"] = "consulted"
         
         results.append(item)
 
-    return jsonify({
+    # Same bookings + same session state -> same version; pollers get a 304 until something moves
+    version = hashlib.sha1(json.dumps(results, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    response = jsonify({
         "success": True,
+        "version": version,
         "data": results
     })
+    response.set_etag(version)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 # ===================== Admin AI Assistant =====================
 
@@ -5861,7 +5869,7 @@ def check_doctor_bookings_and_schedule(doctor_name_query: str, date_str: str) ->
             return f"{doctor_name} has no Google Sheet linked. Schedule is active on {date_str} but bookings cannot be retrieved."
         
         # Access sheet
-        spreadsheet = client.open_by_url(sheet_url)
+        spreadsheet = open_doctor_spreadsheet(sheet_url)
         formatted_date = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%m-%Y")
         
         try:
@@ -5899,10 +5907,7 @@ def get_upcoming_holidays() -> str:
     Retrieves the list of upcoming clinic holidays from the ClinicHolidays sheet.
     """
     try:
-        ws = get_holiday_worksheet()
-        if not ws:
-            return "Unable to access the ClinicHolidays sheet."
-        all_vals = ws.get_all_values()
+        all_vals = get_calendar()["holiday_rows"]
         if not all_vals or len(all_vals) <= 1:
             return "No clinic holidays are currently scheduled."
         
@@ -5943,207 +5948,317 @@ def get_upcoming_holidays() -> str:
     except Exception as e:
         return f"Error retrieving upcoming holidays: {str(e)}"
 
+def load_system_statistics():
+    """
+    Raw counts behind get_system_statistics: one grouped aggregate query
+    per table instead of a COUNT per figure.
+    """
+    count = db.func.count
+    def count_if(condition):
+        return db.func.coalesce(db.func.sum(db.case((condition, 1), else_=0)), 0)
+
+    users = dict(db.session.query(User.role, count()).group_by(User.role).all())
+
+    PB = PatientBooking
+    total, confirmed, cancelled, completed, patients = db.session.query(
+        count(),
+        count_if(PB.status == 'confirmed'),
+        count_if(PB.status == 'cancelled'),
+        count(PB.consultation_end_time),
+        count(db.distinct(PB.user_id))
+    ).one()
+
+    referrals = dict(db.session.query(DoctorReferral.status, count()).group_by(DoctorReferral.status).all())
+
+    ist = pytz.timezone('Asia/Kolkata')
+    today_str = datetime.now(ist).strftime("%Y-%m-%d")
+
+    return {
+        "users": {
+            "total": sum(users.values()),
+            "patient": users.get('patient', 0),
+            "doctor": users.get('doctor', 0),
+            "admin": users.get('admin', 0)
+        },
+        "bookings": {
+            "total": total,
+            "confirmed": int(confirmed),
+            "cancelled": int(cancelled),
+            "completed": completed,
+            "patients": patients
+        },
+        "referrals": {
+            "total": sum(referrals.values()),
+            "pending": referrals.get('pending', 0),
+            "booked": referrals.get('booked', 0)
+        },
+        "prescriptions": db.session.query(count(Prescription.id)).scalar() or 0,
+        "active_tickers": db.session.query(count(TickerMessage.id)).filter(TickerMessage.is_active.is_(True)).scalar() or 0,
+        "sessions_today": db.session.query(count(DoctorSession.id)).filter(DoctorSession.session_date == today_str).scalar() or 0
+    }
+
+# Shared by get_system_statistics, the admin AI system instruction and /admin/analytics
+system_stats = admin_queries.TimedSnapshot(
+    load_system_statistics,
+    ttl=float(os.environ.get("SYSTEM_STATS_TTL", "30"))
+)
+
+def format_system_statistics(raw):
+    users, bookings, referrals = raw["users"], raw["bookings"], raw["referrals"]
+    cancellation_rate = 0.0
+    if bookings["total"] > 0:
+        cancellation_rate = (bookings["cancelled"] / bookings["total"]) * 100.0
+    return {
+        "Users Breakdown": {
+            "Total Registered Users": users["total"],
+            "Patients": users["patient"],
+            "Doctors": users["doctor"],
+            "Admins": users["admin"]
+        },
+        "Bookings Breakdown": {
+            "Total Bookings Record": bookings["total"],
+            "Confirmed Bookings": bookings["confirmed"],
+            "Cancelled Bookings": bookings["cancelled"],
+            "Completed Consultations": bookings["completed"],
+            "Cancellation Rate (%)": round(cancellation_rate, 2)
+        },
+        "Referrals & Prescriptions": {
+            "Total Referrals": referrals["total"],
+            "Pending Referrals": referrals["pending"],
+            "Booked Referrals": referrals["booked"],
+            "Total Prescriptions Issued": raw["prescriptions"]
+        },
+        "Real-time Queue": {
+            "Active Doctor Sessions Today": raw["sessions_today"],
+            "Live Ticker Messages": raw["active_tickers"]
+        }
+    }
+
 def get_system_statistics() -> str:
     """
     Returns high-level administrative statistics and operational metrics.
     Includes user counts by role, database booking states, active wait queues,
     referral counts, prescription counts, and cancellation rate.
+    Figures may be up to a few seconds old.
     """
     try:
-        total_users = User.query.count()
-        patients_count = User.query.filter_by(role='patient').count()
-        doctors_count = User.query.filter_by(role='doctor').count()
-        admins_count = User.query.filter_by(role='admin').count()
-        
-        total_bookings = PatientBooking.query.count()
-        confirmed_bookings = PatientBooking.query.filter_by(status='confirmed').count()
-        cancelled_bookings = PatientBooking.query.filter_by(status='cancelled').count()
-        completed_bookings = PatientBooking.query.filter(PatientBooking.consultation_end_time.isnot(None)).count()
-        
-        cancellation_rate = 0.0
-        if total_bookings > 0:
-            cancellation_rate = (cancelled_bookings / total_bookings) * 100.0
-            
-        total_referrals = DoctorReferral.query.count()
-        pending_referrals = DoctorReferral.query.filter_by(status='pending').count()
-        booked_referrals = DoctorReferral.query.filter_by(status='booked').count()
-        
-        total_prescriptions = Prescription.query.count()
-        active_ticker_messages = TickerMessage.query.filter_by(is_active=True).count()
-        
-        ist = pytz.timezone('Asia/Kolkata')
-        today_str = datetime.now(ist).strftime("%Y-%m-%d")
-        active_sessions = DoctorSession.query.filter_by(session_date=today_str).count()
-        
-        stats = {
-            "Users Breakdown": {
-                "Total Registered Users": total_users,
-                "Patients": patients_count,
-                "Doctors": doctors_count,
-                "Admins": admins_count
-            },
-            "Bookings Breakdown": {
-                "Total Bookings Record": total_bookings,
-                "Confirmed Bookings": confirmed_bookings,
-                "Cancelled Bookings": cancelled_bookings,
-                "Completed Consultations": completed_bookings,
-                "Cancellation Rate (%)": round(cancellation_rate, 2)
-            },
-            "Referrals & Prescriptions": {
-                "Total Referrals": total_referrals,
-                "Pending Referrals": pending_referrals,
-                "Booked Referrals": booked_referrals,
-                "Total Prescriptions Issued": total_prescriptions
-            },
-            "Real-time Queue": {
-                "Active Doctor Sessions Today": active_sessions,
-                "Live Ticker Messages": active_ticker_messages
-            }
-        }
-        return json.dumps(stats, indent=2)
+        return json.dumps(format_system_statistics(system_stats.get()), indent=2)
     except Exception as e:
         return f"Error gathering statistics: {str(e)}"
 
-def query_users(role: str = None, search_query: str = None) -> str:
+# Fields each data tool can return (`fields`), the default projection, and
+# the columns it can aggregate on (`group_by`)
+USER_TOOL_FIELDS = {
+    "ID": lambda u: u.id,
+    "Name": lambda u: u.name,
+    "Email": lambda u: u.email,
+    "Role": lambda u: u.role,
+    "Registered At": lambda u: u.created_at,
+}
+USER_TOOL_DEFAULT = ("ID", "Name", "Email", "Role")
+USER_TOOL_GROUPS = {"role": User.role}
+
+APPOINTMENT_TOOL_FIELDS = {
+    "Booking ID": lambda b: b.id,
+    "Patient Name": lambda b: b.patient_name,
+    "Age": lambda b: b.age,
+    "Gender": lambda b: b.gender,
+    "Doctor Name": lambda b: b.doctor_name,
+    "Specialization": lambda b: b.specialization,
+    "Date": lambda b: b.date,
+    "Time": lambda b: b.time,
+    "Token": lambda b: b.token,
+    "Status": lambda b: b.status,
+    "Cancelled By": lambda b: b.cancelled_by,
+    "Cancellation Reason": lambda b: b.cancellation_reason,
+    "Cancelled At": lambda b: b.cancelled_at,
+    "Consultation Start": lambda b: b.consultation_start_time,
+    "Consultation End": lambda b: b.consultation_end_time,
+}
+APPOINTMENT_TOOL_DEFAULT = ("Booking ID", "Patient Name", "Doctor Name", "Date", "Token", "Status")
+APPOINTMENT_TOOL_GROUPS = {
+    "status": PatientBooking.status,
+    "doctor": PatientBooking.doctor_name,
+    "specialization": PatientBooking.specialization,
+    "date": PatientBooking.booking_date,
+    "cancelled_by": PatientBooking.cancelled_by,
+}
+
+REFERRAL_TOOL_FIELDS = {
+    "Referral ID": lambda r: r.id,
+    "Patient Name": lambda r: r.patient_name,
+    "From Doctor": lambda r: r.from_doctor,
+    "To Specialization": lambda r: r.to_specialization,
+    "Notes": lambda r: r.notes,
+    "Status": lambda r: r.status,
+    "Created At": lambda r: r.created_at,
+}
+REFERRAL_TOOL_DEFAULT = ("Referral ID", "Patient Name", "From Doctor", "To Specialization", "Status", "Created At")
+REFERRAL_TOOL_GROUPS = {
+    "status": DoctorReferral.status,
+    "from_doctor": DoctorReferral.from_doctor,
+    "to_specialization": DoctorReferral.to_specialization,
+}
+
+PRESCRIPTION_TOOL_FIELDS = {
+    "Prescription ID": lambda p: p.id,
+    "Patient Name": lambda p: p.patient_name,
+    "Doctor Name": lambda p: p.doctor_name,
+    "Consultation Date": lambda p: p.consultation_date,
+    "Text Content": lambda p: p.text_content,
+    "Uploaded File": lambda p: p.file_path,
+    "Created At": lambda p: p.created_at,
+}
+PRESCRIPTION_TOOL_DEFAULT = ("Prescription ID", "Patient Name", "Doctor Name", "Consultation Date")
+PRESCRIPTION_TOOL_GROUPS = {
+    "doctor": Prescription.doctor_name,
+    "date": Prescription.consultation_date,
+}
+
+def tool_result(q, sort_col, id_col, field_map, default_fields, groups, group_by, fields, limit, cursor):
+    """
+    Shared tail of the admin data tools: GROUP BY counts when group_by is
+    given, else one keyset page of projected rows. The first page also
+    reports the total number of matches.
+    """
+    if group_by:
+        group_col = groups.get(group_by.strip().lower())
+        if group_col is None:
+            return f"Cannot group by '{group_by}'. Use one of: {', '.join(groups)}."
+        return admin_queries.groups_result(group_by, admin_queries.group_counts(q, group_col))
+
+    total = None if cursor else q.order_by(None).count()
+    rows, next_cursor = admin_queries.page(q, sort_col, id_col, limit, cursor)
+    chosen = admin_queries.parse_fields(fields, field_map, default_fields)
+    return admin_queries.rows_result(rows, chosen, field_map, next_cursor, total)
+
+def matching_doctor_keys(doctor_name):
+    """doctor_key of every directory doctor whose name contains doctor_name."""
+    query = normalize_key(doctor_name).replace("dr.", "").strip()
+    return {normalize_key(d.get("Name")) for d in get_doctor_directory()
+            if query and query in normalize_key(d.get("Name"))}
+
+def query_users(role: str = None, search_query: str = None, group_by: str = None,
+                fields: str = None, limit: int = 20, cursor: str = None) -> str:
     """
-    Search and retrieve user accounts.
+    Search user accounts. Returns one page of results as JSON with "total",
+    "next_cursor" and "results"; pass next_cursor back as `cursor` for the
+    next page. Use group_by for counts instead of listing rows.
     Args:
         role: Filter by user role ('patient', 'doctor', 'admin').
         search_query: Search term for name or email.
+        group_by: Return counts per 'role' instead of rows.
+        fields: Comma-separated fields to return (ID, Name, Email, Role, Registered At) or 'all'.
+        limit: Rows per page (default 20, max 100).
+        cursor: next_cursor from the previous page.
     """
     try:
         q = User.query
         if role:
             q = q.filter_by(role=role)
         if search_query:
-            search_pattern = f"%{search_query}%"
-            q = q.filter(db.or_(User.name.like(search_pattern), User.email.like(search_pattern)))
-        
-        users = q.all()
-        results = []
-        for u in users:
-            results.append({
-                "ID": u.id,
-                "Name": u.name,
-                "Email": u.email,
-                "Role": u.role,
-                "Registered At": u.created_at.strftime("%Y-%m-%d %H:%M:%S") if u.created_at else "Unknown"
-            })
-        return json.dumps(results, indent=2)
+            q = q.filter(name_search.match(User, search_query))
+        return tool_result(q, User.created_at, User.id, USER_TOOL_FIELDS, USER_TOOL_DEFAULT,
+                           USER_TOOL_GROUPS, group_by, fields, limit, cursor)
     except Exception as e:
         return f"Error querying users: {str(e)}"
 
-def query_appointments(doctor_name: str = None, date_str: str = None, status: str = None, patient_name: str = None) -> str:
+def query_appointments(doctor_name: str = None, date_str: str = None, status: str = None, patient_name: str = None,
+                       group_by: str = None, fields: str = None, limit: int = 20, cursor: str = None) -> str:
     """
-    Queries patient appointments/bookings from the local database cache.
+    Queries patient appointments/bookings from the local database cache,
+    newest date first. Returns one page as JSON with "total", "next_cursor"
+    and "results"; pass next_cursor back as `cursor` for the next page.
+    Use group_by for counts instead of listing rows.
     Args:
         doctor_name: Filter by doctor name (fuzzy search).
         date_str: Filter by date (YYYY-MM-DD).
         status: Filter by booking status ('confirmed', 'cancelled').
         patient_name: Filter by patient name (fuzzy search).
+        group_by: Return counts per 'status', 'doctor', 'specialization', 'date' or 'cancelled_by' instead of rows.
+        fields: Comma-separated fields to return (Booking ID, Patient Name, Age, Gender, Doctor Name,
+            Specialization, Date, Time, Token, Status, Cancelled By, Cancellation Reason, Cancelled At,
+            Consultation Start, Consultation End) or 'all'.
+        limit: Rows per page (default 20, max 100).
+        cursor: next_cursor from the previous page.
     """
     try:
         q = PatientBooking.query
         if doctor_name:
-            search_pattern = f"%{doctor_name}%"
-            q = q.filter(PatientBooking.doctor_name.like(search_pattern))
+            # Directory match -> indexed doctor_key lookup; unknown names fall back to LIKE
+            keys = matching_doctor_keys(doctor_name)
+            if keys:
+                q = q.filter(PatientBooking.doctor_key.in_(keys))
+            else:
+                q = q.filter(PatientBooking.doctor_name.like(f"%{doctor_name}%"))
         if date_str:
-            q = q.filter_by(date=date_str)
+            q = q.filter(PatientBooking.booking_date == as_date(date_str))
         if status:
             q = q.filter_by(status=status)
         if patient_name:
-            search_pattern = f"%{patient_name}%"
-            q = q.filter(PatientBooking.patient_name.like(search_pattern))
-            
-        bookings = q.order_by(PatientBooking.date.desc(), PatientBooking.token.asc()).all()
-        results = []
-        for b in bookings:
-            results.append({
-                "Booking ID": b.id,
-                "Patient Name": b.patient_name,
-                "Age": b.age,
-                "Doctor Name": b.doctor_name,
-                "Specialization": b.specialization,
-                "Date": b.date,
-                "Time": b.time,
-                "Token": b.token,
-                "Status": b.status,
-                "Cancelled By": b.cancelled_by,
-                "Cancellation Reason": b.cancellation_reason,
-                "Cancelled At": b.cancelled_at,
-                "Consultation Start": b.consultation_start_time.strftime("%Y-%m-%d %H:%M:%S") if b.consultation_start_time else None,
-                "Consultation End": b.consultation_end_time.strftime("%Y-%m-%d %H:%M:%S") if b.consultation_end_time else None
-            })
-        return json.dumps(results[:100], indent=2)
+            q = q.filter(name_search.match(PatientBooking, patient_name))
+        return tool_result(q, PatientBooking.booking_date, PatientBooking.id, APPOINTMENT_TOOL_FIELDS,
+                           APPOINTMENT_TOOL_DEFAULT, APPOINTMENT_TOOL_GROUPS, group_by, fields, limit, cursor)
     except Exception as e:
         return f"Error querying appointments: {str(e)}"
 
-def query_referrals(from_doctor: str = None, to_specialization: str = None, status: str = None) -> str:
+def query_referrals(from_doctor: str = None, to_specialization: str = None, status: str = None,
+                    group_by: str = None, fields: str = None, limit: int = 20, cursor: str = None) -> str:
     """
-    Retrieves and filters doctor-to-specialist patient referrals.
+    Retrieves and filters doctor-to-specialist patient referrals, newest
+    first. Returns one page as JSON with "total", "next_cursor" and
+    "results"; pass next_cursor back as `cursor` for the next page. Use
+    group_by for counts instead of listing rows.
     Args:
         from_doctor: Filter by referring doctor (fuzzy search).
         to_specialization: Filter by target specialization.
         status: Filter by status ('pending', 'booked', 'dismissed').
+        group_by: Return counts per 'status', 'from_doctor' or 'to_specialization' instead of rows.
+        fields: Comma-separated fields to return (Referral ID, Patient Name, From Doctor,
+            To Specialization, Notes, Status, Created At) or 'all'.
+        limit: Rows per page (default 20, max 100).
+        cursor: next_cursor from the previous page.
     """
     try:
         q = DoctorReferral.query
         if from_doctor:
-            search_pattern = f"%{from_doctor}%"
-            q = q.filter(DoctorReferral.from_doctor.like(search_pattern))
+            q = q.filter(DoctorReferral.from_doctor.like(f"%{from_doctor}%"))
         if to_specialization:
             q = q.filter_by(to_specialization=to_specialization)
         if status:
             q = q.filter_by(status=status)
-            
-        referrals = q.order_by(DoctorReferral.created_at.desc()).all()
-        results = []
-        for r in referrals:
-            results.append({
-                "Referral ID": r.id,
-                "Patient Name": r.patient_name,
-                "From Doctor": r.from_doctor,
-                "To Specialization": r.to_specialization,
-                "Notes": r.notes,
-                "Status": r.status,
-                "Created At": r.created_at.strftime("%Y-%m-%d %H:%M:%S") if r.created_at else "Unknown"
-            })
-        return json.dumps(results, indent=2)
+        return tool_result(q, DoctorReferral.created_at, DoctorReferral.id, REFERRAL_TOOL_FIELDS,
+                           REFERRAL_TOOL_DEFAULT, REFERRAL_TOOL_GROUPS, group_by, fields, limit, cursor)
     except Exception as e:
         return f"Error querying referrals: {str(e)}"
 
-def query_prescriptions(doctor_name: str = None, patient_name: str = None, date_str: str = None) -> str:
+def query_prescriptions(doctor_name: str = None, patient_name: str = None, date_str: str = None,
+                        group_by: str = None, fields: str = None, limit: int = 20, cursor: str = None) -> str:
     """
-    Queries prescription history and logs.
+    Queries prescription history and logs, newest first. Returns one page
+    as JSON with "total", "next_cursor" and "results"; pass next_cursor back
+    as `cursor` for the next page. Text Content is only included when asked
+    for in `fields`. Use group_by for counts instead of listing rows.
     Args:
         doctor_name: Filter by prescribing doctor (fuzzy).
         patient_name: Filter by patient name (fuzzy).
         date_str: Filter by consultation date (YYYY-MM-DD).
+        group_by: Return counts per 'doctor' or 'date' instead of rows.
+        fields: Comma-separated fields to return (Prescription ID, Patient Name, Doctor Name,
+            Consultation Date, Text Content, Uploaded File, Created At) or 'all'.
+        limit: Rows per page (default 20, max 100).
+        cursor: next_cursor from the previous page.
     """
     try:
         q = Prescription.query
         if doctor_name:
-            search_pattern = f"%{doctor_name}%"
-            q = q.filter(Prescription.doctor_name.like(search_pattern))
+            q = q.filter(Prescription.doctor_name.like(f"%{doctor_name}%"))
         if patient_name:
-            search_pattern = f"%{patient_name}%"
-            q = q.filter(Prescription.patient_name.like(search_pattern))
+            q = q.filter(name_search.match(Prescription, patient_name))
         if date_str:
             q = q.filter_by(consultation_date=date_str)
-            
-        prescriptions = q.order_by(Prescription.created_at.desc()).all()
-        results = []
-        for p in prescriptions:
-            results.append({
-                "Prescription ID": p.id,
-                "Patient Name": p.patient_name,
-                "Doctor Name": p.doctor_name,
-                "Consultation Date": p.consultation_date,
-                "Text Content": p.text_content,
-                "Uploaded File": p.file_path,
-                "Created At": p.created_at.strftime("%Y-%m-%d %H:%M:%S") if p.created_at else "Unknown"
-            })
-        return json.dumps(results[:50], indent=2)
+        return tool_result(q, Prescription.created_at, Prescription.id, PRESCRIPTION_TOOL_FIELDS,
+                           PRESCRIPTION_TOOL_DEFAULT, PRESCRIPTION_TOOL_GROUPS, group_by, fields, limit, cursor)
     except Exception as e:
         return f"Error querying prescriptions: {str(e)}"
 
@@ -6179,41 +6294,37 @@ def query_leaves_and_holidays() -> str:
     try:
         leaves = []
         try:
-            leave_ws = get_leave_worksheet()
-            if leave_ws:
-                all_vals = leave_ws.get_all_values()
-                if all_vals and len(all_vals) > 1:
-                    headers = all_vals[0]
-                    for row in all_vals[1:]:
-                        if not row or len(row) < 3:
-                            continue
-                        row_dict = dict(zip(headers, row))
-                        leaves.append({
-                            "Type": "Doctor Leave",
-                            "Doctor Name": row_dict.get("DoctorName", ""),
-                            "Specialization": row_dict.get("Specialization", ""),
-                            "Date": row_dict.get("Date", ""),
-                            "Reason": row_dict.get("Reason", "")
-                        })
+            all_vals = get_calendar()["leave_rows"]
+            if all_vals and len(all_vals) > 1:
+                headers = all_vals[0]
+                for row in all_vals[1:]:
+                    if not row or len(row) < 3:
+                        continue
+                    row_dict = dict(zip(headers, row))
+                    leaves.append({
+                        "Type": "Doctor Leave",
+                        "Doctor Name": row_dict.get("DoctorName", ""),
+                        "Specialization": row_dict.get("Specialization", ""),
+                        "Date": row_dict.get("Date", ""),
+                        "Reason": row_dict.get("Reason", "")
+                    })
         except Exception as e:
             leaves.append({"Type": "Error", "Message": f"Failed to fetch leaves: {str(e)}"})
 
         holidays = []
         try:
-            holiday_ws = get_holiday_worksheet()
-            if holiday_ws:
-                all_vals = holiday_ws.get_all_values()
-                if all_vals and len(all_vals) > 1:
-                    headers = all_vals[0]
-                    for row in all_vals[1:]:
-                        if not row or len(row) < 2:
-                            continue
-                        row_dict = dict(zip(headers, row))
-                        holidays.append({
-                            "Type": "Clinic Holiday",
-                            "Date": row_dict.get("HolidayDate", row[0]),
-                            "Reason": row_dict.get("Reason", row[1] if len(row) > 1 else "")
-                        })
+            all_vals = get_calendar()["holiday_rows"]
+            if all_vals and len(all_vals) > 1:
+                headers = all_vals[0]
+                for row in all_vals[1:]:
+                    if not row or len(row) < 2:
+                        continue
+                    row_dict = dict(zip(headers, row))
+                    holidays.append({
+                        "Type": "Clinic Holiday",
+                        "Date": row_dict.get("HolidayDate", row[0]),
+                        "Reason": row_dict.get("Reason", row[1] if len(row) > 1 else "")
+                    })
         except Exception as e:
             holidays.append({"Type": "Error", "Message": f"Failed to fetch holidays: {str(e)}"})
 
@@ -6247,6 +6358,11 @@ def get_admin_ai_system_instruction():
     login_setting = AppSettings.query.filter_by(key='password_login_enabled').first()
     password_login_status = "Enabled" if (not login_setting or login_setting.value == '1') else "Disabled"
 
+    try:
+        stats_json = json.dumps(format_system_statistics(system_stats.get()), indent=2)
+    except Exception as e:
+        stats_json = f"Unavailable ({e}); call get_system_statistics()."
+
     instruction = f"""You are the official PrimeCare Clinic Admin AI Assistant — a fully data-aware administrative intelligence system.
 You have access to the administrative system context, settings, operations, and database query tools.
 Your goal is to provide highly accurate, context-rich, analytical, and actionable responses instead of generic AI answers.
@@ -6267,6 +6383,10 @@ Here is the JSON representation of the current clinic settings:
 Here is the JSON representation of the registered clinic doctors and their default schedules:
 {doctors_json}
 
+### SYSTEM STATISTICS SNAPSHOT
+Same figures as `get_system_statistics()`, at most {int(system_stats.ttl)} seconds old. Answer overview questions from here; call the tool only for a fresh figure later in the conversation:
+{stats_json}
+
 ### DATABASE MODELS & SCHEMAS
 The system operates on an SQLite database. Here is the schema outline:
 1. **User**: stores accounts. Roles: `'patient'`, `'doctor'`, or `'admin'`.
@@ -6292,10 +6412,11 @@ The system operates on an SQLite database. Here is the schema outline:
 ### OPERATIONAL CAPABILITIES & TOOLS
 You must call the appropriate tool(s) to fetch real-time application data to answer the administrator's questions:
 1. `get_system_statistics()`: Get high-level database counts, booking stats, active session count, prescription volume, referral status, and cancellation rates. Use this for general health checks, performance overviews, or operational metrics.
-2. `query_users(role, search_query)`: Find registered users/patients/doctors. Use this when the admin asks about specific accounts or total users.
-3. `query_appointments(doctor_name, date_str, status, patient_name)`: Search appointment bookings in the local cache. Use this to verify booking details, analyze doctor booking load, compare dates, or find cancelled appointments.
-4. `query_referrals(from_doctor, to_specialization, status)`: Search and count clinical referrals between doctors and specialties.
-5. `query_prescriptions(doctor_name, patient_name, date_str)`: Fetch prescription history.
+2. `query_users(role, search_query, group_by, fields, limit, cursor)`: Find registered users/patients/doctors. Use this when the admin asks about specific accounts or total users.
+3. `query_appointments(doctor_name, date_str, status, patient_name, group_by, fields, limit, cursor)`: Search appointment bookings in the local cache. Use this to verify booking details, analyze doctor booking load, compare dates, or find cancelled appointments.
+4. `query_referrals(from_doctor, to_specialization, status, group_by, fields, limit, cursor)`: Search and count clinical referrals between doctors and specialties.
+5. `query_prescriptions(doctor_name, patient_name, date_str, group_by, fields, limit, cursor)`: Fetch prescription history.
+   Tools 2-5 return one page at a time (`total`, `next_cursor`, `results`). For counts and breakdowns ("how many", "per doctor", "by status") use `group_by` instead of listing and counting rows yourself. Ask only for the `fields` you need, and follow `next_cursor` only when the admin needs the full list.
 6. `query_doctor_sessions_today()`: Retrieve live patient queue data for today (current token, total tokens, queue status, skipped tokens). Use this to answer questions about wait times, who is currently consulting, or queue backlogs.
 7. `query_leaves_and_holidays()`: Retrieves all scheduled doctor leaves and clinic holidays.
 8. `check_doctor_bookings_and_schedule(doctor_name_query, date_str)`: Fetch real-time schedule and patient lists for a specific doctor on a specific date (reads from the live Google Sheet).
@@ -6350,99 +6471,114 @@ Map admin requests directly to these panels and paths:
 """
     return instruction
 
-@app.route('/admin_ai_chat', methods=['POST'])
-def admin_ai_chat():
+ADMIN_AI_FALLBACK_REPLY = ("I’m sorry, the AI service is temporarily unavailable. "
+                           "Please try again in a few moments.")
+ADMIN_AI_EMPTY_REPLY = ("I’m not sure how to answer that. "
+                        "Could you re-phrase the question or ask something else?")
+ADMIN_AI_NO_ACCESS = ("Your Google AI project does not have access to Gemini right now. "
+                      "Check the project’s quota or contact your Google Cloud admin.")
+
+def check_admin_ai_request():
+    """(message, history, None) for a valid admin chat request, else (None, None, error response)."""
     if not session.get("admin_logged_in") or session.get("admin_email") != ADMIN_EMAIL:
-        return jsonify({"success": False, "error": "Unauthorized access"}), 403
+        return None, None, (jsonify({"success": False, "error": "Unauthorized access"}), 403)
 
     data = request.get_json() or {}
     message = data.get("message", "").strip()
     history = data.get("history", [])
 
     if not message:
-        return jsonify({"success": False, "error": "Message is required"}), 400
+        return None, None, (jsonify({"success": False, "error": "Message is required"}), 400)
 
-    api_key = os.environ.get("GOOGLE_API_KEY")
-    if not api_key:
-        return jsonify({
+    if not os.environ.get("GOOGLE_API_KEY"):
+        return None, None, (jsonify({
             "success": False,
             "error": "The Gemini API Key is missing from the server environment. Please define GOOGLE_API_KEY in the server .env."
-        }), 500
-
-    try:
-        client_genai = genai.Client(api_key=api_key)
-        
-        # Build contents from history
-        contents = []
-        for h in history:
-            role = h.get("role")
-            text = h.get("text")
-            if role in ["user", "model"] and text:
-                contents.append(
-                    genai_types.Content(
-                        role=role,
-                        parts=[genai_types.Part.from_text(text=text)]
-                    )
+        }), 500)
+    return message, history, None
+
+def create_admin_chat(history):
+    """Gemini chat with the admin tools, seeded with the conversation so far."""
+    # Build contents from history
+    contents = []
+    for h in history:
+        role = h.get("role")
+        text = h.get("text")
+        if role in ["user", "model"] and text:
+            contents.append(
+                genai_types.Content(
+                    role=role,
+                    parts=[genai_types.Part.from_text(text=text)]
                 )
-        
-        system_instruction = get_admin_ai_system_instruction()
-
-        # Initialize chat with history
-        chat = client_genai.chats.create(
-            model='gemini-2.5-flash',
-            history=contents,
-            config=genai_types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                tools=[
-                    check_doctor_bookings_and_schedule,
-                    get_upcoming_holidays,
-                    get_system_statistics,
-                    query_users,
-                    query_appointments,
-                    query_referrals,
-                    query_prescriptions,
-                    query_doctor_sessions_today,
-                    query_leaves_and_holidays
-                ],
-                temperature=0.2
             )
+    
+    return gemini_assistant.client.chats.create(
+        model='gemini-2.5-flash',
+        history=contents,
+        config=genai_types.GenerateContentConfig(
+            system_instruction=get_admin_ai_system_instruction(),
+            tools=[
+                check_doctor_bookings_and_schedule,
+                get_upcoming_holidays,
+                get_system_statistics,
+                query_users,
+                query_appointments,
+                query_referrals,
+                query_prescriptions,
+                query_doctor_sessions_today,
+                query_leaves_and_holidays
+            ],
+            temperature=0.2
         )
+    )
+
+def admin_ai_failure(exc, attempt, max_retries):
+    """
+    None to retry (once gemini_governor allows it), else (error message,
+    HTTP status) to give up with. Shared by /admin_ai_chat and its
+    streaming variant.
+    """
+    from google.genai.errors import ClientError, APIError
+
+    if isinstance(exc, ClientError) and exc.code == 403:
+        return ADMIN_AI_NO_ACCESS, 403
+    if isinstance(exc, APIError):
+        if exc.code == 429:
+            gemini_governor.penalize()
+        if attempt == max_retries - 1:
+            return ADMIN_AI_FALLBACK_REPLY, 503
+        return None
+    if attempt == max_retries - 1:
+        app.logger.error(f"[Admin AI Error] {str(exc)}", exc_info=True)
+        return ADMIN_AI_FALLBACK_REPLY, 500
+    return None
+
+@app.route('/admin_ai_chat', methods=['POST'])
+def admin_ai_chat():
+    message, history, error = check_admin_ai_request()
+    if error:
+        return error
+
+    try:
+        # Initialize chat with history
+        chat = create_admin_chat(history)
 
         max_retries = 3
-        fallback_reply = ("I’m sorry, the AI service is temporarily unavailable. "
-                          "Please try again in a few moments.")
-                          
         for attempt in range(max_retries):
+            if not gemini_governor.acquire():
+                return jsonify({"success": False, "error": ADMIN_AI_FALLBACK_REPLY}), 503
             try:
                 response = chat.send_message(message)
 
                 if response and response.text:
                     return jsonify({"success": True, "reply": response.text.strip()})
                     
-                return jsonify({
-                    "success": True,
-                    "reply": ("I’m not sure how to answer that. "
-                              "Could you re-phrase the question or ask something else?")
-                })
+                return jsonify({"success": True, "reply": ADMIN_AI_EMPTY_REPLY})
                 
             except Exception as exc:
-                from google.genai.errors import ClientError, APIError, RateLimitError
-                
-                if isinstance(exc, ClientError) and exc.status_code == 403:
-                    friendly = ("Your Google AI project does not have access to Gemini right now. "
-                                "Check the project’s quota or contact your Google Cloud admin.")
-                    return jsonify({"success": False, "error": friendly}), 403
-
-                if isinstance(exc, (APIError, RateLimitError)):
-                    if attempt == max_retries - 1:
-                        return jsonify({"success": False, "error": fallback_reply}), 503
-                    import time
-                    time.sleep(1)
-                    continue
-
-                if attempt == max_retries - 1:
-                    app.logger.error(f"[Admin AI Error] {str(exc)}", exc_info=True)
-                    return jsonify({"success": False, "error": fallback_reply}), 500
+                failure = admin_ai_failure(exc, attempt, max_retries)
+                if failure:
+                    return jsonify({"success": False, "error": failure[0]}), failure[1]
 
     except Exception as e:
         error_msg = str(e)
@@ -6453,6 +6589,52 @@ def admin_ai_chat():
             "details": error_msg
         }), 500
 
+@app.route('/admin_ai_chat/stream', methods=['POST'])
+def admin_ai_chat_stream():
+    """
+    Streaming /admin_ai_chat: "chunk" {"text"} events as the reply is
+    written (tool calls run before the first chunk), then "done"
+    {"success", "reply"} or "error" {"success": false, "error"}.
+    """
+    message, history, error = check_admin_ai_request()
+    if error:
+        return error
+
+    try:
+        chat = create_admin_chat(history)
+    except Exception as e:
+        app.logger.error(f"[Admin AI Error Outer] {str(e)}", exc_info=True)
+        return jsonify({
+            "success": False,
+            "error": "An unexpected error occurred setting up the AI.",
+            "details": str(e)
+        }), 500
+
+    def events():
+        max_retries = 3
+        parts = []
+        for attempt in range(max_retries):
+            if not gemini_governor.acquire():
+                yield "error", {"success": False, "error": ADMIN_AI_FALLBACK_REPLY}
+                return
+            try:
+                for chunk in chat.send_message_stream(message):
+                    text = getattr(chunk, "text", None)
+                    if text:
+                        parts.append(text)
+                        yield "chunk", {"text": text}
+                reply = "".join(parts).strip() or ADMIN_AI_EMPTY_REPLY
+                yield "done", {"success": True, "reply": reply}
+                return
+            except Exception as exc:
+                # Once text has reached the browser a retry would repeat it
+                failure = admin_ai_failure(exc, max_retries - 1 if parts else attempt, max_retries)
+                if failure:
+                    yield "error", {"success": False, "error": failure[0]}
+                    return
+
+    return ai_sse_response(events())
+
 # ===================== Error Handlers =====================
 @app.errorhandler(404)
 def page_not_found(e):
@@ -6465,6 +6647,12 @@ def internal_error(e):
 
 # ===================== Main =====================
 
+if client is not None:
+    sheet_replicator.start()
+    sheet_maintenance.start()
+push_dispatcher.start()
+session_scheduler.start()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=True)
@@ -0,0 +1,175 @@
+"""
+Loads and classifies a patient's bookings for /booking and /patient_dashboard.
+
+Both pages show an "Upcoming" and a "Past" list. They used to load every
+booking the user ever made and, for each of today's bookings, query the
+doctor's DoctorSession separately. load_user_bookings() keeps the cost
+bounded:
+
+- bookings from today onwards are loaded in full (there are only a few);
+- older bookings are read one page at a time with keyset pagination on
+  (booking_date, id), using the user_id/booking_date index, so a long
+  history does not slow the page down;
+- the DoctorSession rows for today's bookings come from a single IN query.
+
+classify() then sorts today's and future bookings into upcoming/past and
+marks skipped/missed tokens in one pass.
+"""
+from datetime import datetime
+
+from doctor_directory import normalize_key
+
+PAST_PAGE_SIZE = 30
+
+
+def encode_cursor(booking):
+    """Keyset cursor for the page after `booking`: 'YYYY-MM-DD_<id>' ('_<id>' for undated rows)."""
+    day = booking.booking_date.isoformat() if booking.booking_date else ""
+    return f"{day}_{booking.id}"
+
+
+def decode_cursor(cursor):
+    """(date or None, id) from encode_cursor(), or None if the cursor is malformed."""
+    if not cursor or "_" not in cursor:
+        return None
+    day_str, _, id_str = cursor.rpartition("_")
+    try:
+        day = datetime.strptime(day_str, "%Y-%m-%d").date() if day_str else None
+        return day, int(id_str)
+    except ValueError:
+        return None
+
+
+class BookingPage:
+    """Result of load_user_bookings(): classified lists plus paging info."""
+
+    def __init__(self, upcoming, past, past_total, past_next):
+        self.upcoming = upcoming
+        self.past = past
+        self.past_total = past_total
+        self.past_next = past_next  # cursor for the next page of past bookings, or None
+
+
+def _past_query(PatientBooking, user_id, today):
+    PB = PatientBooking
+    return PB.query.filter(PB.user_id == user_id, (PB.booking_date < today) | PB.booking_date.is_(None))
+
+
+def _after_cursor(query, PatientBooking, cursor):
+    PB = PatientBooking
+    day, last_id = cursor
+    if day is None:
+        return query.filter(PB.booking_date.is_(None), PB.id < last_id)
+    return query.filter(
+        (PB.booking_date < day)
+        | ((PB.booking_date == day) & (PB.id < last_id))
+        | PB.booking_date.is_(None)
+    )
+
+
+def sessions_for(DoctorSession, bookings, today_str):
+    """{(doctor_key, spec_key): DoctorSession} for today's sessions of the given bookings, in one query."""
+    keys = {(b.doctor_key or normalize_key(b.doctor_name), b.spec_key or normalize_key(b.specialization))
+            for b in bookings}
+    keys = {k for k in keys if k[0] and k[1]}
+    if not keys:
+        return {}
+    rows = DoctorSession.query.filter(
+        DoctorSession.doctor_key.in_({k[0] for k in keys}),
+        DoctorSession.session_date == today_str
+    ).all()
+    sessions = {}
+    for s in rows:
+        key = (s.doctor_key, s.spec_key)
+        if key in keys:
+            sessions.setdefault(key, s)
+    return sessions
+
+
+def classify(bookings, sessions, directory, now_ist, skipped_stays_upcoming=False):
+    """
+    Split today's and future bookings into (upcoming, past).
+
+    A booking for today moves to past once the doctor's session is completed,
+    the doctor has called a later token, or the shift has ended. A skipped
+    token stays upcoming until the session ends when skipped_stays_upcoming
+    is set (/booking), so the patient still sees the "Skipped" badge there.
+    Today's bookings get live_token/live_status/sched_start attached for the
+    live-sync widgets.
+    """
+    today = now_ist.date()
+    weekday = now_ist.strftime("%A")
+    current_time_str = now_ist.strftime("%H:%M")
+
+    upcoming, past = [], []
+    for b in bookings:
+        b.is_skipped = False
+        b.is_missed = False
+        is_past = b.booking_date is None or b.booking_date < today
+
+        if not is_past and b.booking_date == today:
+            doc_key = b.doctor_key or normalize_key(b.doctor_name)
+            spec_key = b.spec_key or normalize_key(b.specialization)
+            shift = directory.shift(b.doctor_name, b.specialization, weekday)
+            doc_session = sessions.get((doc_key, spec_key))
+
+            if doc_session:
+                b.live_token = doc_session.current_token
+                b.live_status = doc_session.status
+                b.sched_start = shift[0] if shift else "00:00"
+                b.is_start_time_passed = (current_time_str >= b.sched_start)
+
+                passed = doc_session.current_token > (b.token or 0)
+                if doc_session.queue.is_skipped(b.token):
+                    b.is_skipped = True
+                elif passed and b.status != 'cancelled':
+                    # Token was silently bypassed: treat as missed/unconsulted
+                    b.is_missed = True
+
+                if doc_session.status == 'completed':
+                    is_past = True
+                elif passed and not (b.is_skipped and skipped_stays_upcoming):
+                    is_past = True
+
+            if not is_past and shift and current_time_str > shift[1]:
+                is_past = True
+
+        (past if is_past else upcoming).append(b)
+
+    upcoming.sort(key=lambda x: (1 if x.status == 'cancelled' else 0, x.date or "", x.token or 0))
+    past.sort(key=lambda x: (x.date or "", x.token or 0), reverse=True)
+    return upcoming, past
+
+
+def load_user_bookings(PatientBooking, DoctorSession, user_id, directory, now_ist,
+                       past_before=None, page_size=PAST_PAGE_SIZE, skipped_stays_upcoming=False):
+    """
+    Bookings for one user as a BookingPage.
+
+    - past_before: cursor from a previous page's past_next. The first page
+      (no cursor) also carries today's bookings that are already over.
+    """
+    PB = PatientBooking
+    today = now_ist.date()
+    cursor = decode_cursor(past_before)
+
+    current = PB.query.filter(PB.user_id == user_id, PB.booking_date >= today).all()
+    sessions = sessions_for(DoctorSession, [b for b in current if b.booking_date == today],
+                            today.strftime("%Y-%m-%d"))
+    upcoming, past_today = classify(current, sessions, directory, now_ist,
+                                    skipped_stays_upcoming=skipped_stays_upcoming)
+
+    older_q = _past_query(PB, user_id, today)
+    past_total = older_q.count() + len(past_today)
+    if cursor:
+        older_q = _after_cursor(older_q, PB, cursor)
+    older = older_q.order_by(PB.booking_date.desc().nulls_last(), PB.id.desc()).limit(page_size + 1).all()
+    past_next = encode_cursor(older[page_size - 1]) if len(older) > page_size else None
+    older = older[:page_size]
+    older.sort(key=lambda x: (x.date or "", x.token or 0), reverse=True)
+    for b in older:
+        b.is_skipped = False
+        b.is_missed = False
+
+    past = (past_today if not cursor else []) + older
+    return BookingPage(upcoming, past, past_total, past_next)
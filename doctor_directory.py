@@ -0,0 +1,102 @@
+"""
+Indexed, read-only view of the doctor roster.
+
+get_all_doctors() in app.py parses the Doctors sheet into plain dicts
+(Name, Specialization, Days, DayTimes, Time, SheetURL, Image, Email).
+DoctorDirectory wraps that list once per cache refresh and prebuilds the
+lookups the request handlers need, so they are dictionary hits instead of
+scans over the roster, and "HH:MM-HH:MM" shift strings are parsed once.
+"""
+from datetime import datetime
+
+DAY_NAMES = ["Monday", "Tuesday", "Wednesday", "Thursday",
+             "Friday", "Saturday", "Sunday"]
+
+
+def normalize_key(value):
+    """Case/whitespace-insensitive key used to match doctor and specialization names."""
+    return (value or "").strip().lower()
+
+
+def _normalize_clock(value):
+    """'9:00' -> '09:00' so shift times compare correctly as strings."""
+    value = (value or "").strip()
+    try:
+        return datetime.strptime(value, "%H:%M").strftime("%H:%M")
+    except ValueError:
+        return value
+
+
+def parse_shift(time_range):
+    """'09:00 - 13:00' -> ('09:00', '13:00'), or None if not a range."""
+    if not time_range or "-" not in time_range:
+        return None
+    start, end = time_range.replace(" ", "").split("-", 1)
+    return _normalize_clock(start), _normalize_clock(end)
+
+
+class DoctorDirectory:
+    """Doctor list plus hash indexes by SheetURL, (name, specialization), email and weekday."""
+
+    def __init__(self, doctors, version=1):
+        self.doctors = doctors
+        self.version = version
+
+        self.by_url = {}
+        self.by_key = {}
+        self.by_name = {}
+        self.by_email = {}
+        self.by_weekday = {day: [] for day in DAY_NAMES}
+        self.shifts = {}
+        specs = set()
+
+        for doc in doctors:
+            key = (normalize_key(doc.get("Name")), normalize_key(doc.get("Specialization")))
+            if doc.get("SheetURL"):
+                self.by_url.setdefault(doc["SheetURL"], doc)
+            self.by_key.setdefault(key, doc)
+            self.by_name.setdefault(key[0], doc)
+            email = normalize_key(doc.get("Email"))
+            if email:
+                self.by_email.setdefault(email, doc)
+            for day in doc.get("Days", []):
+                self.by_weekday.setdefault(day, []).append(doc)
+            if doc.get("Specialization"):
+                specs.add(doc["Specialization"])
+
+            shifts = {}
+            for day, time_range in (doc.get("DayTimes") or {}).items():
+                shift = parse_shift(time_range)
+                if shift:
+                    shifts[day] = shift
+            self.shifts.setdefault(key, shifts)
+
+        self.specializations = sorted(specs, key=lambda s: s.lower())
+
+    def __iter__(self):
+        return iter(self.doctors)
+
+    def __len__(self):
+        return len(self.doctors)
+
+    def find_by_url(self, sheet_url):
+        return self.by_url.get(sheet_url)
+
+    def find(self, name, specialization):
+        return self.by_key.get((normalize_key(name), normalize_key(specialization)))
+
+    def find_by_name(self, name):
+        return self.by_name.get(normalize_key(name))
+
+    def find_by_email(self, email):
+        return self.by_email.get(normalize_key(email))
+
+    def working_on(self, weekday, specialization=None):
+        docs = self.by_weekday.get(weekday, [])
+        if specialization:
+            return [d for d in docs if d["Specialization"] == specialization]
+        return list(docs)
+
+    def shift(self, name, specialization, weekday):
+        """(start, end) as zero-padded 'HH:MM' strings for that weekday, or None."""
+        return self.shifts.get((normalize_key(name), normalize_key(specialization)), {}).get(weekday)
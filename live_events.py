@@ -0,0 +1,112 @@
+"""
+In-process pub/sub for live token updates, served as Server-Sent Events.
+
+Doctor-side routes in app.py (start_session, next_token, skip_token,
+consult_skipped, complete_session, save_doctor_broadcast) publish a small
+"session" event after they commit; bookings and cancellations for today
+publish a "booking" event. /live_tokens/stream subscribers block on
+a condition variable, so an idle clinic costs a sleeping thread per client
+and one heartbeat comment every `heartbeat` seconds.
+
+Events are kept in a bounded ring buffer with increasing ids. A client that
+reconnects with Last-Event-ID gets everything it missed; if the id has
+already fallen out of the buffer it gets a single "resync" event and is
+expected to refetch /live_tokens.
+
+The broker is per process: with several worker processes each one only
+sees its own publishes, and clients fall back to their polling timer.
+"""
+import json
+import threading
+import time
+from collections import deque
+
+
+def format_sse(data, event=None, event_id=None):
+    """Encode one SSE message."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    payload = json.dumps(data, default=str)
+    lines.extend(f"data: {line}" for line in payload.splitlines() or [""])
+    return "\n".join(lines) + "\n\n"
+
+
+class LiveEventBroker:
+    def __init__(self, buffer_size=500, heartbeat=15, retry_ms=3000):
+        self.heartbeat = heartbeat
+        self.retry_ms = retry_ms
+        self._events = deque(maxlen=buffer_size)  # (id, event, data)
+        self._last_id = 0
+        self._cond = threading.Condition()
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def publish(self, event, data):
+        """Append an event and wake every subscriber. Returns the event id."""
+        with self._cond:
+            self._last_id += 1
+            self._events.append((self._last_id, event, data))
+            self._cond.notify_all()
+            return self._last_id
+
+    def _events_after(self, last_id):
+        """Events newer than last_id, or None if some of them were already dropped."""
+        if self._events and last_id < self._events[0][0] - 1:
+            return None
+        return [e for e in self._events if e[0] > last_id]
+
+    def stream(self, last_event_id=None, max_seconds=None):
+        """
+        Generator of SSE text for one client.
+
+        - last_event_id: resume point (Last-Event-ID header); None starts at "now".
+        - max_seconds: close the response after this long so long-lived
+          connections do not pin a worker forever; EventSource reconnects
+          on its own and resumes from the last id it saw.
+        """
+        started = time.time()
+        with self._cond:
+            cursor = self._last_id if last_event_id is None else last_event_id
+            if cursor > self._last_id:
+                # Id from before a server restart
+                cursor = self._last_id
+                pending = [(cursor, "resync", {})]
+            else:
+                missed = self._events_after(cursor)
+                pending = missed if missed is not None else [(self._last_id, "resync", {})]
+                if missed is None:
+                    cursor = self._last_id
+
+        yield f"retry: {self.retry_ms}\n\n"
+
+        while True:
+            for event_id, event, data in pending:
+                cursor = max(cursor, event_id)
+                yield format_sse(data, event=event, event_id=event_id)
+
+            timeout = self.heartbeat
+            if max_seconds:
+                remaining = max_seconds - (time.time() - started)
+                if remaining <= 0:
+                    return
+                timeout = min(timeout, remaining)
+
+            with self._cond:
+                if self._last_id == cursor:
+                    self._cond.wait(timeout=timeout)
+                missed = self._events_after(cursor)
+                if missed is None:
+                    pending = [(self._last_id, "resync", {})]
+                else:
+                    pending = missed
+
+            if not pending:
+                yield ": heartbeat\n\n"
+
+
+broker = LiveEventBroker()
@@ -0,0 +1,81 @@
+"""
+Today's live queue state per (doctor, specialization), kept in memory for
+/my_token_status.
+
+Patients' devices poll /my_token_status every few seconds. It used to run
+one DoctorSession query per booking, so each poll cost 1 + N queries even
+when nothing had moved. LiveSessionMap holds the TokenQueue (status,
+current token, skipped tokens) of every session dated today. The map is
+loaded with one query and updated in place after commits by the
+doctor-side routes (start_session, next_token, skip_token,
+consult_skipped, complete_session) and by the session scheduler.
+
+Each change bumps `version`. The map is per process, so it is also
+reloaded after `ttl` seconds and on a new day. That picks up changes made
+by other worker processes or by routes that do not report here.
+"""
+import threading
+import time
+
+from doctor_directory import normalize_key
+from token_queue import TokenQueue
+
+
+def session_state(doc_session):
+    """Snapshot of the DoctorSession fields /my_token_status reads."""
+    return {
+        "session_date": doc_session.session_date,
+        "queue": TokenQueue.of(doc_session),
+    }
+
+
+class LiveSessionMap:
+    def __init__(self, load_sessions, ttl=5.0):
+        # load_sessions(day_str) -> iterable of DoctorSession rows for that day
+        self._load_sessions = load_sessions
+        self.ttl = ttl
+        self._states = {}   # (doctor_key, spec_key) -> session_state()
+        self._day = None
+        self._ts = 0.0
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def _reload(self, day_str):
+        states = {}
+        for doc_session in self._load_sessions(day_str):
+            key = (doc_session.doctor_key or normalize_key(doc_session.doctor_name),
+                   doc_session.spec_key or normalize_key(doc_session.specialization))
+            states.setdefault(key, session_state(doc_session))
+        with self._lock:
+            if states != self._states or self._day != day_str:
+                self.version += 1
+            self._states = states
+            self._day = day_str
+            self._ts = time.time()
+
+    def states(self, day_str):
+        """{(doctor_key, spec_key): state} for day_str, reloading it if expired."""
+        with self._lock:
+            fresh = self._day == day_str and (time.time() - self._ts) < self.ttl
+        if not fresh:
+            self._reload(day_str)
+        return self._states
+
+    def get(self, day_str, doctor_name, specialization):
+        return self.states(day_str).get((normalize_key(doctor_name), normalize_key(specialization)))
+
+    def update(self, doc_session):
+        """Record a committed DoctorSession change."""
+        key = (normalize_key(doc_session.doctor_name), normalize_key(doc_session.specialization))
+        state = session_state(doc_session)
+        with self._lock:
+            if self._day != doc_session.session_date or self._states.get(key) == state:
+                return
+            states = dict(self._states)
+            states[key] = state
+            self._states = states
+            self.version += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._ts = 0.0
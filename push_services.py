@@ -1,7 +1,29 @@
+"""
+Web push notifications for patients.
+
+The send_* helpers and trigger_push only decide *who* gets *what*; the
+messages are handed to a single PushDispatcher (set up by app.py through
+init_dispatcher) which:
+
+- resolves every recipient's subscriptions with one IN query,
+- stores one PushDelivery row per (message, subscription), so queued
+  pushes survive a restart,
+- sends them from a bounded thread pool over a shared, connection-pooled
+  requests session,
+- retries transient failures with exponential backoff and deletes
+  subscriptions the push service reports as gone (404/410),
+- keeps simple counters, exposed by metrics().
+"""
 import os
 import json
 import threading
-from datetime import datetime
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
 from pywebpush import webpush, WebPushException
 
 # Load VAPID private key
@@ -19,393 +41,401 @@ try:
 except Exception as e:
     print(f"[Push Service] Warning: Could not load VAPID keys: {e}")
 
-def trigger_push(doctor_name, date_str, current_token, status, app, db, PatientBooking, PushSubscription):
-    """
-    Spawns a background thread to identify and send push notifications
-    to patients who are exactly next or 2 tokens away, or skipped.
-    """
+def _as_date(date_str):
+    """Booking dates arrive as YYYY-MM-DD (or legacy DD-MM-YYYY); PatientBooking.booking_date is a DATE."""
+    for fmt in ("%Y-%m-%d", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(date_str.strip(), fmt).date()
+        except (AttributeError, ValueError):
+            continue
+    return None
+
+
+def _doctor_display(name):
+    doc_disp = (name or "").strip()
+    if not doc_disp.lower().startswith("dr."):
+        doc_disp = f"Dr. {doc_disp}"
+    return doc_disp
+
+def _message(user_id, title, body, tag, vibrate, url):
+    return (user_id, {
+        "title": title,
+        "body": body,
+        "tag": tag,
+        "vibrate": vibrate,
+        "silent": False,
+        "url": url
+    })
+
+
+class PushDispatcher:
+    """Persistent push queue (PushDelivery rows) drained by a bounded worker pool."""
+
+    def __init__(self, app, db, PushSubscription, PushDelivery,
+                 workers=16, batch_size=200, interval=30,
+                 max_attempts=5, base_backoff=5, timeout=10):
+        self.app = app
+        self.db = db
+        self.PushSubscription = PushSubscription
+        self.PushDelivery = PushDelivery
+        self.workers = workers
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.timeout = timeout
+        # Rows claimed by this process; a crashed claimer's rows are picked up again
+        self.worker_id = uuid.uuid4().hex
+        self.claim_timeout = timedelta(minutes=5)
+
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="push")
+        # One pooled connection set per push service host (FCM, Mozilla, Apple...)
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=workers)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+
+        self._counters = defaultdict(int)
+        self._counter_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._drain_lock = threading.Lock()
+        self._thread = None
+
+    # ─── Worker lifecycle ───
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="push-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def notify(self):
+        self._wake.set()
+
+    def _run(self):
+        next_purge = datetime.utcnow()
+        while not self._stop.is_set():
+            try:
+                while self.drain() >= self.batch_size:
+                    pass
+            except Exception as e:
+                print(f"[Push Service] Drain failed: {e}")
+
+            if datetime.utcnow() >= next_purge:
+                try:
+                    self.purge()
+                except Exception as e:
+                    print(f"[Push Service] Purge failed: {e}")
+                next_purge = datetime.utcnow() + timedelta(hours=1)
+
+            self._wake.wait(self._seconds_until_next_due())
+            self._wake.clear()
+
+    def _count(self, key, amount=1):
+        with self._counter_lock:
+            self._counters[key] += amount
+
+    def metrics(self):
+        """Counters since start plus the current queue depth by state."""
+        PD = self.PushDelivery
+        with self._counter_lock:
+            data = dict(self._counters)
+        try:
+            with self.app.app_context():
+                rows = self.db.session.query(PD.state, self.db.func.count(PD.id)).group_by(PD.state).all()
+                data["queue"] = {state: count for state, count in rows}
+        except Exception as e:
+            data["queue_error"] = str(e)
+        data["workers"] = self.workers
+        return data
+
+    # ─── Producing ───
+
+    def submit(self, plan, label="Push"):
+        """
+        Run plan() on the pool (inside an app context) and queue the
+        (user_id, payload) messages it returns. Callers never block on
+        database lookups or HTTP.
+        """
+        def job():
+            with self.app.app_context():
+                try:
+                    messages = plan()
+                    if messages:
+                        self.enqueue(messages)
+                except Exception as e:
+                    self.db.session.rollback()
+                    print(f"[Push Service] {label} Error: {e}")
+        self.pool.submit(job)
+
+    def enqueue(self, messages):
+        """Store one delivery per subscription of each recipient. Returns the number queued."""
+        PS, PD = self.PushSubscription, self.PushDelivery
+        user_ids = {user_id for user_id, _ in messages if user_id}
+        if not user_ids:
+            return 0
+
+        subs_by_user = defaultdict(list)
+        for sub in PS.query.filter(PS.user_id.in_(user_ids)).all():
+            subs_by_user[sub.user_id].append(sub.id)
+
+        now = datetime.utcnow()
+        deliveries = []
+        for user_id, payload in messages:
+            encoded = json.dumps(payload)
+            # Note: We push to ALL devices logged in as this user_id
+            for sub_id in subs_by_user.get(user_id, []):
+                deliveries.append(PD(subscription_id=sub_id, payload=encoded, state="pending",
+                                     attempts=0, next_attempt_at=now))
+        if deliveries:
+            self.db.session.add_all(deliveries)
+            self.db.session.commit()
+            self._count("queued", len(deliveries))
+            self.notify()
+        return len(deliveries)
+
+    # ─── Delivering ───
+
+    def drain(self):
+        """Send one batch of due deliveries. Returns how many were attempted."""
+        PS, PD = self.PushSubscription, self.PushDelivery
+        with self._drain_lock, self.app.app_context():
+            now = datetime.utcnow()
+            # Release rows left 'sending' by a worker that died mid-batch
+            PD.query.filter(PD.state == "sending", PD.claimed_at < now - self.claim_timeout) \
+                .update({"state": "pending"}, synchronize_session=False)
+
+            due_ids = [row.id for row in PD.query.with_entities(PD.id)
+                       .filter(PD.state == "pending", PD.next_attempt_at <= now)
+                       .order_by(PD.id.asc()).limit(self.batch_size).all()]
+            if not due_ids:
+                self.db.session.commit()
+                return 0
+
+            PD.query.filter(PD.id.in_(due_ids), PD.state == "pending").update(
+                {"state": "sending", "claimed_by": self.worker_id, "claimed_at": now},
+                synchronize_session=False)
+            self.db.session.commit()
+
+            rows = PD.query.filter(PD.id.in_(due_ids), PD.state == "sending",
+                                   PD.claimed_by == self.worker_id).all()
+            subs = {s.id: s for s in PS.query.filter(PS.id.in_({r.subscription_id for r in rows})).all()}
+
+            in_flight = []
+            for row in rows:
+                sub = subs.get(row.subscription_id)
+                if sub is None:
+                    row.state = "gone"
+                    continue
+                push_info = {
+                    "endpoint": sub.endpoint,
+                    "keys": {
+                        "p256dh": sub.p256dh,
+                        "auth": sub.auth
+                    }
+                }
+                in_flight.append((row, self.pool.submit(self._send, push_info, row.payload)))
+
+            gone_subs = set()
+            for row, future in in_flight:
+                outcome, error = future.result()
+                row.attempts = (row.attempts or 0) + 1
+                row.last_error = (error or "")[:255] or None
+                if outcome == "sent":
+                    row.state = "sent"
+                    row.sent_at = datetime.utcnow()
+                    self._count("sent")
+                elif outcome == "gone":
+                    row.state = "gone"
+                    gone_subs.add(row.subscription_id)
+                    self._count("gone")
+                elif row.attempts >= self.max_attempts:
+                    row.state = "failed"
+                    self._count("failed")
+                    print(f"[Push Service] Giving up on delivery {row.id}: {error}")
+                else:
+                    row.state = "pending"
+                    row.next_attempt_at = datetime.utcnow() + timedelta(
+                        seconds=self.base_backoff * (2 ** (row.attempts - 1)))
+                    self._count("retried")
+
+            if gone_subs:
+                print(f"[Push Service] Deleting {len(gone_subs)} unsubscribed endpoint(s)")
+                PS.query.filter(PS.id.in_(gone_subs)).delete(synchronize_session=False)
+            self.db.session.commit()
+            return len(rows)
+
+    def _send(self, push_info, payload):
+        """One HTTP push; runs on the pool, no database access."""
+        try:
+            webpush(
+                subscription_info=push_info,
+                data=payload,
+                vapid_private_key=VAPID_PRIVATE_KEY,
+                vapid_claims=dict(VAPID_CLAIMS),
+                timeout=self.timeout,
+                requests_session=self.http
+            )
+            return "sent", None
+        except WebPushException as ex:
+            if ex.response is not None and ex.response.status_code in [404, 410]:
+                # Subscription expired or unsubscribed
+                return "gone", repr(ex)
+            return "retry", repr(ex)
+        except Exception as e:
+            return "retry", repr(e)
+
+    def _seconds_until_next_due(self):
+        PD = self.PushDelivery
+        try:
+            with self.app.app_context():
+                next_due = self.db.session.query(self.db.func.min(PD.next_attempt_at)) \
+                    .filter(PD.state == "pending").scalar()
+        except Exception:
+            return self.interval
+        if next_due is None:
+            return self.interval
+        return max(0.5, min(self.interval, (next_due - datetime.utcnow()).total_seconds()))
+
+    def purge(self, keep=timedelta(days=2)):
+        """Drop finished deliveries older than `keep`."""
+        PD = self.PushDelivery
+        with self.app.app_context():
+            PD.query.filter(PD.state.in_(["sent", "gone", "failed"]),
+                            PD.created_at < datetime.utcnow() - keep).delete(synchronize_session=False)
+            self.db.session.commit()
+
+
+dispatcher = None
+
+def init_dispatcher(app, db, PushSubscription, PushDelivery, **options):
+    """Create the process-wide dispatcher used by the send_* helpers below."""
+    global dispatcher
+    dispatcher = PushDispatcher(app, db, PushSubscription, PushDelivery, **options)
+    return dispatcher
+
+def _dispatch(plan, label):
     if not VAPID_PRIVATE_KEY:
         print("[Push Service] No VAPID keys installed. Aborting push.")
         return
+    if dispatcher is None:
+        print("[Push Service] Dispatcher not initialised. Aborting push.")
+        return
+    dispatcher.submit(plan, label)
 
-    def run_push():
-        with app.app_context():
-            try:
-                # 1. Find all active bookings for this doctor today (handling both YYYY-MM-DD and DD-MM-YYYY formats)
-                try:
-                    if len(date_str.split('-')[0]) == 4:
-                        alt_date_str = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%m-%Y")
-                    else:
-                        alt_date_str = datetime.strptime(date_str, "%d-%m-%Y").strftime("%Y-%m-%d")
-                except Exception:
-                    alt_date_str = date_str
-
-                bookings = PatientBooking.query.filter(
-                    db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doctor_name.strip().lower(),
-                    (PatientBooking.date == date_str) | (PatientBooking.date == alt_date_str)
-                ).all()
-
-                for b in bookings:
-                    token = b.token
-                    if token < current_token and status != 'skipped':
-                        continue # past token
-
-                    ahead = token - current_token
-
-                    title = ""
-                    body = ""
-                    tag = ""
-                    vibrate = []
-                    
-                    if status == "skipped" and ahead == 0:
-                        # The particular token being evaluated was skipped!
-                        title = "Token Skipped"
-                        body = "Your token was skipped. Please contact the reception."
-                        tag = "primecare-skip"
-                        vibrate = [400, 200, 400]
-                    elif status == "active":
-                        if ahead == 0:
-                            title = "Token Alert"
-                            body = f"It's your turn! Proceed to {doctor_name} immediately."
-                            tag = "primecare-alert"
-                            vibrate = [300, 100, 300, 100, 500]
-                        elif ahead == 1:
-                            title = "Token Alert"
-                            body = f"You're next for {doctor_name}. Please be ready!"
-                            tag = "primecare-alert"
-                            vibrate = [300, 100, 300, 100, 500]
-                        elif ahead == 2:
-                            title = "Token Alert"
-                            body = f"2 patients ahead — {doctor_name}. Get ready soon."
-                            tag = "primecare-alert"
-                            vibrate = [300, 100, 300, 100, 500]
-
-                    if not title:
-                        continue # Not in alert range
-                    
-                    # Target subscriber
-                    # Note: We push to ALL devices logged in as this user_id
-                    subs = PushSubscription.query.filter_by(user_id=b.user_id).all()
-                    
-                    for sub in subs:
-                        push_info = {
-                            "endpoint": sub.endpoint,
-                            "keys": {
-                                "p256dh": sub.p256dh,
-                                "auth": sub.auth
-                            }
-                        }
-                        
-                        payload = json.dumps({
-                            "title": title,
-                            "body": body,
-                            "tag": tag,
-                            "vibrate": vibrate,
-                            "silent": False,
-                            "url": "/patient_dashboard"
-                        })
-                        
-                        try:
-                            webpush(
-                                subscription_info=push_info,
-                                data=payload,
-                                vapid_private_key=VAPID_PRIVATE_KEY,
-                                vapid_claims=VAPID_CLAIMS
-                            )
-                        except WebPushException as ex:
-                            if ex.response and ex.response.status_code in [404, 410]:
-                                # Subscription expired or unsubscribed
-                                print(f"[Push Service] Unsubscribed endpoint {sub.endpoint}. Deleting...")
-                                db.session.delete(sub)
-                                db.session.commit()
-                            else:
-                                print(f"[Push Service] WebPush Error: {repr(ex)}")
 
-            except Exception as e:
-                print(f"[Push Service] Worker Error: {e}")
-
-    thread = threading.Thread(target=run_push)
-    thread.start()
+def trigger_push(doctor_name, date_str, current_token, status, app, db, PatientBooking, PushSubscription):
+    """
+    Queue push notifications for patients who are exactly next or
+    2 tokens away, or skipped.
+    """
+    def plan():
+        # 1. Find all active bookings for this doctor today
+        bookings = PatientBooking.query.filter(
+            PatientBooking.doctor_key == doctor_name.strip().lower(),
+            PatientBooking.booking_date == _as_date(date_str),
+            PatientBooking.status != 'cancelled'
+        ).all()
+
+        messages = []
+        for b in bookings:
+            token = b.token
+            if token < current_token and status != 'skipped':
+                continue # past token
+
+            ahead = token - current_token
+
+            if status == "skipped" and ahead == 0:
+                # The particular token being evaluated was skipped!
+                messages.append(_message(b.user_id, "Token Skipped",
+                                         "Your token was skipped. Please contact the reception.",
+                                         "primecare-skip", [400, 200, 400], "/patient_dashboard"))
+            elif status == "active":
+                if ahead == 0:
+                    body = f"It's your turn! Proceed to {doctor_name} immediately."
+                elif ahead == 1:
+                    body = f"You're next for {doctor_name}. Please be ready!"
+                elif ahead == 2:
+                    body = f"2 patients ahead — {doctor_name}. Get ready soon."
+                else:
+                    continue # Not in alert range
+                messages.append(_message(b.user_id, "Token Alert", body,
+                                         "primecare-alert", [300, 100, 300, 100, 500], "/patient_dashboard"))
+        return messages
+
+    _dispatch(plan, "Token Alert")
 
 def send_leave_notification(doctor_name, date_str, reason, app, db, PatientBooking, PushSubscription):
     """
     Finds bookings for `doctor_name` on `date_str` and sends a web push notification
     alerting the patients that the doctor is on temporary leave.
     """
-    if not VAPID_PRIVATE_KEY:
-        print("[Push Service] No VAPID keys installed. Aborting push.")
-        return
-
-    def run_push():
-        with app.app_context():
-            try:
-                # Find all active bookings for this doctor on this date (handling both YYYY-MM-DD and DD-MM-YYYY formats)
-                try:
-                    if len(date_str.split('-')[0]) == 4:
-                        alt_date_str = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%m-%Y")
-                    else:
-                        alt_date_str = datetime.strptime(date_str, "%d-%m-%Y").strftime("%Y-%m-%d")
-                except Exception:
-                    alt_date_str = date_str
-
-                bookings = PatientBooking.query.filter(
-                    db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doctor_name.strip().lower(),
-                    (PatientBooking.date == date_str) | (PatientBooking.date == alt_date_str),
-                    PatientBooking.status != 'cancelled'
-                ).all()
-
-                for b in bookings:
-                    title = "Doctor on Leave"
-                    doc_disp = doctor_name.strip()
-                    if not doc_disp.lower().startswith("dr."):
-                        doc_disp = f"Dr. {doc_disp}"
-                    body = f"{doc_disp} is on temporary leave on {date_str}. Please reschedule/book another day."
-                    tag = f"leave-{doctor_name}-{date_str}"
-                    
-                    subs = PushSubscription.query.filter_by(user_id=b.user_id).all() if b.user_id else []
-                    for sub in subs:
-                        push_info = {
-                            "endpoint": sub.endpoint,
-                            "keys": {
-                                "p256dh": sub.p256dh,
-                                "auth": sub.auth
-                            }
-                        }
-                        payload = json.dumps({
-                            "title": title,
-                            "body": body,
-                            "tag": tag,
-                            "vibrate": [300, 100, 300],
-                            "silent": False,
-                            "url": "/booking"
-                        })
-                        try:
-                            webpush(
-                                subscription_info=push_info,
-                                data=payload,
-                                vapid_private_key=VAPID_PRIVATE_KEY,
-                                vapid_claims=VAPID_CLAIMS
-                            )
-                        except WebPushException as ex:
-                            if ex.response and ex.response.status_code in [404, 410]:
-                                print(f"[Push Service] Unsubscribed endpoint {sub.endpoint}. Deleting...")
-                                db.session.delete(sub)
-                                db.session.commit()
-                            else:
-                                print(f"[Push Service] WebPush Error: {repr(ex)}")
-            except Exception as e:
-                print(f"[Push Service] Leave Notification Error: {e}")
-
-    thread = threading.Thread(target=run_push)
-    thread.start()
+    def plan():
+        bookings = PatientBooking.query.filter(
+            PatientBooking.doctor_key == doctor_name.strip().lower(),
+            PatientBooking.booking_date == _as_date(date_str),
+            PatientBooking.status != 'cancelled'
+        ).all()
+        body = f"{_doctor_display(doctor_name)} is on temporary leave on {date_str}. Please reschedule/book another day."
+        return [_message(b.user_id, "Doctor on Leave", body, f"leave-{doctor_name}-{date_str}",
+                         [300, 100, 300], "/booking") for b in bookings]
+
+    _dispatch(plan, "Leave Notification")
 
 def send_holiday_notification(date_str, reason, app, db, PatientBooking, PushSubscription):
     """
     Finds bookings on `date_str` and sends a web push notification
     alerting the patients that the clinic is closed due to a holiday.
     """
-    if not VAPID_PRIVATE_KEY:
-        print("[Push Service] No VAPID keys installed. Aborting push.")
-        return
+    def plan():
+        bookings = PatientBooking.query.filter(
+            PatientBooking.booking_date == _as_date(date_str),
+            PatientBooking.status != 'cancelled'
+        ).all()
+        body = f"The clinic is closed on {date_str} due to a holiday ({reason or 'General Holiday'}). Please reschedule/book another day."
+        return [_message(b.user_id, "Clinic Closed (Holiday)", body, f"holiday-{date_str}",
+                         [300, 100, 300], "/booking") for b in bookings]
 
-    def run_push():
-        with app.app_context():
-            try:
-                # Find all active bookings on this date (handling both YYYY-MM-DD and DD-MM-YYYY formats)
-                try:
-                    if len(date_str.split('-')[0]) == 4:
-                        alt_date_str = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%m-%Y")
-                    else:
-                        alt_date_str = datetime.strptime(date_str, "%d-%m-%Y").strftime("%Y-%m-%d")
-                except Exception:
-                    alt_date_str = date_str
-
-                bookings = PatientBooking.query.filter(
-                    (PatientBooking.date == date_str) | (PatientBooking.date == alt_date_str),
-                    PatientBooking.status != 'cancelled'
-                ).all()
-
-                for b in bookings:
-                    title = "Clinic Closed (Holiday)"
-                    body = f"The clinic is closed on {date_str} due to a holiday ({reason or 'General Holiday'}). Please reschedule/book another day."
-                    tag = f"holiday-{date_str}"
-                    
-                    subs = PushSubscription.query.filter_by(user_id=b.user_id).all() if b.user_id else []
-                    for sub in subs:
-                        push_info = {
-                            "endpoint": sub.endpoint,
-                            "keys": {
-                                "p256dh": sub.p256dh,
-                                "auth": sub.auth
-                            }
-                        }
-                        payload = json.dumps({
-                            "title": title,
-                            "body": body,
-                            "tag": tag,
-                            "vibrate": [300, 100, 300],
-                            "silent": False,
-                            "url": "/booking"
-                        })
-                        try:
-                            webpush(
-                                subscription_info=push_info,
-                                data=payload,
-                                vapid_private_key=VAPID_PRIVATE_KEY,
-                                vapid_claims=VAPID_CLAIMS
-                            )
-                        except WebPushException as ex:
-                            if ex.response and ex.response.status_code in [404, 410]:
-                                print(f"[Push Service] Unsubscribed endpoint {sub.endpoint}. Deleting...")
-                                db.session.delete(sub)
-                                db.session.commit()
-                            else:
-                                print(f"[Push Service] WebPush Error: {repr(ex)}")
-            except Exception as e:
-                print(f"[Push Service] Holiday Notification Error: {e}")
-
-    thread = threading.Thread(target=run_push)
-    thread.start()
+    _dispatch(plan, "Holiday Notification")
 
 def send_leave_removal_notification(doctor_name, date_str, app, db, PatientBooking, PushSubscription):
     """
     Finds bookings for `doctor_name` on `date_str` and sends a web push notification
     alerting the patients that the doctor's leave was removed/cancelled.
     """
-    if not VAPID_PRIVATE_KEY:
-        print("[Push Service] No VAPID keys installed. Aborting push.")
-        return
-
-    def run_push():
-        with app.app_context():
-            try:
-                # Find bookings today (handling both YYYY-MM-DD and DD-MM-YYYY formats)
-                try:
-                    if len(date_str.split('-')[0]) == 4:
-                        alt_date_str = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%m-%Y")
-                    else:
-                        alt_date_str = datetime.strptime(date_str, "%d-%m-%Y").strftime("%Y-%m-%d")
-                except Exception:
-                    alt_date_str = date_str
-
-                bookings = PatientBooking.query.filter(
-                    db.func.lower(db.func.trim(PatientBooking.doctor_name)) == doctor_name.strip().lower(),
-                    (PatientBooking.date == date_str) | (PatientBooking.date == alt_date_str),
-                    PatientBooking.status != 'cancelled'
-                ).all()
-
-                for b in bookings:
-                    title = "Doctor Leave Cancelled"
-                    doc_disp = doctor_name.strip()
-                    if not doc_disp.lower().startswith("dr."):
-                        doc_disp = f"Dr. {doc_disp}"
-                    body = f"{doc_disp}'s temporary leave on {date_str} has been cancelled. Your appointment is now active."
-                    tag = f"leave-removal-{doctor_name}-{date_str}"
-                    
-                    subs = PushSubscription.query.filter_by(user_id=b.user_id).all() if b.user_id else []
-                    for sub in subs:
-                        push_info = {
-                            "endpoint": sub.endpoint,
-                            "keys": {
-                                "p256dh": sub.p256dh,
-                                "auth": sub.auth
-                            }
-                        }
-                        payload = json.dumps({
-                            "title": title,
-                            "body": body,
-                            "tag": tag,
-                            "vibrate": [300, 100, 300],
-                            "silent": False,
-                            "url": "/patient_dashboard"
-                        })
-                        try:
-                            webpush(
-                                subscription_info=push_info,
-                                data=payload,
-                                vapid_private_key=VAPID_PRIVATE_KEY,
-                                vapid_claims=VAPID_CLAIMS
-                            )
-                        except WebPushException as ex:
-                            if ex.response and ex.response.status_code in [404, 410]:
-                                print(f"[Push Service] Unsubscribed endpoint {sub.endpoint}. Deleting...")
-                                db.session.delete(sub)
-                                db.session.commit()
-                            else:
-                                print(f"[Push Service] WebPush Error: {repr(ex)}")
-            except Exception as e:
-                print(f"[Push Service] Leave Removal Notification Error: {e}")
-
-    thread = threading.Thread(target=run_push)
-    thread.start()
+    def plan():
+        bookings = PatientBooking.query.filter(
+            PatientBooking.doctor_key == doctor_name.strip().lower(),
+            PatientBooking.booking_date == _as_date(date_str),
+            PatientBooking.status != 'cancelled'
+        ).all()
+        body = f"{_doctor_display(doctor_name)}'s temporary leave on {date_str} has been cancelled. Your appointment is now active."
+        return [_message(b.user_id, "Doctor Leave Cancelled", body, f"leave-removal-{doctor_name}-{date_str}",
+                         [300, 100, 300], "/patient_dashboard") for b in bookings]
+
+    _dispatch(plan, "Leave Removal Notification")
 
 def send_holiday_removal_notification(date_str, app, db, PatientBooking, PushSubscription):
     """
     Finds bookings on `date_str` and sends a web push notification
     alerting the patients that the clinic holiday was removed/cancelled.
     """
-    if not VAPID_PRIVATE_KEY:
-        print("[Push Service] No VAPID keys installed. Aborting push.")
-        return
-
-    def run_push():
-        with app.app_context():
-            try:
-                # Find bookings today (handling both YYYY-MM-DD and DD-MM-YYYY formats)
-                try:
-                    if len(date_str.split('-')[0]) == 4:
-                        alt_date_str = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%m-%Y")
-                    else:
-                        alt_date_str = datetime.strptime(date_str, "%d-%m-%Y").strftime("%Y-%m-%d")
-                except Exception:
-                    alt_date_str = date_str
-
-                bookings = PatientBooking.query.filter(
-                    (PatientBooking.date == date_str) | (PatientBooking.date == alt_date_str),
-                    PatientBooking.status != 'cancelled'
-                ).all()
-
-                for b in bookings:
-                    title = "Clinic Holiday Cancelled"
-                    body = f"The clinic holiday on {date_str} has been cancelled. The clinic will remain open, and your appointment is active."
-                    tag = f"holiday-removal-{date_str}"
-                    
-                    subs = PushSubscription.query.filter_by(user_id=b.user_id).all() if b.user_id else []
-                    for sub in subs:
-                        push_info = {
-                            "endpoint": sub.endpoint,
-                            "keys": {
-                                "p256dh": sub.p256dh,
-                                "auth": sub.auth
-                            }
-                        }
-                        payload = json.dumps({
-                            "title": title,
-                            "body": body,
-                            "tag": tag,
-                            "vibrate": [300, 100, 300],
-                            "silent": False,
-                            "url": "/patient_dashboard"
-                        })
-                        try:
-                            webpush(
-                                subscription_info=push_info,
-                                data=payload,
-                                vapid_private_key=VAPID_PRIVATE_KEY,
-                                vapid_claims=VAPID_CLAIMS
-                            )
-                        except WebPushException as ex:
-                            if ex.response and ex.response.status_code in [404, 410]:
-                                print(f"[Push Service] Unsubscribed endpoint {sub.endpoint}. Deleting...")
-                                db.session.delete(sub)
-                                db.session.commit()
-                            else:
-                                print(f"[Push Service] WebPush Error: {repr(ex)}")
-            except Exception as e:
-                print(f"[Push Service] Holiday Removal Notification Error: {e}")
+    def plan():
+        bookings = PatientBooking.query.filter(
+            PatientBooking.booking_date == _as_date(date_str),
+            PatientBooking.status != 'cancelled'
+        ).all()
+        body = f"The clinic holiday on {date_str} has been cancelled. The clinic will remain open, and your appointment is active."
+        return [_message(b.user_id, "Clinic Holiday Cancelled", body, f"holiday-removal-{date_str}",
+                         [300, 100, 300], "/patient_dashboard") for b in bookings]
 
-    thread = threading.Thread(target=run_push)
-    thread.start()
+    _dispatch(plan, "Holiday Removal Notification")
 
 
 def send_confirmation_notification(booking, app, db, PushSubscription):
@@ -413,56 +443,10 @@ def send_confirmation_notification(booking, app, db, PushSubscription):
     Finds subscriptions for the patient and sends a web push notification
     alerting them that their booking is confirmed.
     """
-    if not VAPID_PRIVATE_KEY:
-        print("[Push Service] No VAPID keys installed. Aborting push.")
-        return
-
-    def run_push():
-        with app.app_context():
-            try:
-                title = "Appointment Confirmed"
-                doc_disp = booking.doctor_name.strip()
-                if not doc_disp.lower().startswith("dr."):
-                    doc_disp = f"Dr. {doc_disp}"
-                body = f"Your appointment with {doc_disp} on {booking.date} is confirmed. Token #{booking.token}."
-                tag = f"confirm-{booking.id}"
-                
-                subs = PushSubscription.query.filter_by(user_id=booking.user_id).all() if booking.user_id else []
-                for sub in subs:
-                    push_info = {
-                        "endpoint": sub.endpoint,
-                        "keys": {
-                            "p256dh": sub.p256dh,
-                            "auth": sub.auth
-                        }
-                    }
-                    payload = json.dumps({
-                        "title": title,
-                        "body": body,
-                        "tag": tag,
-                        "vibrate": [100, 50, 100],
-                        "silent": False,
-                        "url": "/patient_dashboard"
-                    })
-                    try:
-                        webpush(
-                            subscription_info=push_info,
-                            data=payload,
-                            vapid_private_key=VAPID_PRIVATE_KEY,
-                            vapid_claims=VAPID_CLAIMS
-                        )
-                    except WebPushException as ex:
-                        if ex.response and ex.response.status_code in [404, 410]:
-                            print(f"[Push Service] Unsubscribed endpoint {sub.endpoint}. Deleting...")
-                            db.session.delete(sub)
-                            db.session.commit()
-                        else:
-                            print(f"[Push Service] WebPush Error: {repr(ex)}")
-            except Exception as e:
-                print(f"[Push Service] Confirmation Notification Error: {e}")
-
-    thread = threading.Thread(target=run_push)
-    thread.start()
+    body = f"Your appointment with {_doctor_display(booking.doctor_name)} on {booking.date} is confirmed. Token #{booking.token}."
+    message = _message(booking.user_id, "Appointment Confirmed", body, f"confirm-{booking.id}",
+                       [100, 50, 100], "/patient_dashboard")
+    _dispatch(lambda: [message], "Confirmation Notification")
 
 
 def send_cancellation_notification(booking, app, db, PushSubscription):
@@ -470,56 +454,10 @@ def send_cancellation_notification(booking, app, db, PushSubscription):
     Finds subscriptions for the patient and sends a web push notification
     alerting them that their booking was cancelled by the admin.
     """
-    if not VAPID_PRIVATE_KEY:
-        print("[Push Service] No VAPID keys installed. Aborting push.")
-        return
-
-    def run_push():
-        with app.app_context():
-            try:
-                title = "Appointment Cancelled"
-                doc_disp = booking.doctor_name.strip()
-                if not doc_disp.lower().startswith("dr."):
-                    doc_disp = f"Dr. {doc_disp}"
-                body = f"Your appointment with {doc_disp} on {booking.date} (Token #{booking.token}) has been cancelled by the admin."
-                tag = f"cancel-{booking.id}"
-                
-                subs = PushSubscription.query.filter_by(user_id=booking.user_id).all() if booking.user_id else []
-                for sub in subs:
-                    push_info = {
-                        "endpoint": sub.endpoint,
-                        "keys": {
-                            "p256dh": sub.p256dh,
-                            "auth": sub.auth
-                        }
-                    }
-                    payload = json.dumps({
-                        "title": title,
-                        "body": body,
-                        "tag": tag,
-                        "vibrate": [300, 100, 300],
-                        "silent": False,
-                        "url": "/booking"
-                    })
-                    try:
-                        webpush(
-                            subscription_info=push_info,
-                            data=payload,
-                            vapid_private_key=VAPID_PRIVATE_KEY,
-                            vapid_claims=VAPID_CLAIMS
-                        )
-                    except WebPushException as ex:
-                        if ex.response and ex.response.status_code in [404, 410]:
-                            print(f"[Push Service] Unsubscribed endpoint {sub.endpoint}. Deleting...")
-                            db.session.delete(sub)
-                            db.session.commit()
-                        else:
-                            print(f"[Push Service] WebPush Error: {repr(ex)}")
-            except Exception as e:
-                print(f"[Push Service] Cancellation Notification Error: {e}")
-
-    thread = threading.Thread(target=run_push)
-    thread.start()
+    body = f"Your appointment with {_doctor_display(booking.doctor_name)} on {booking.date} (Token #{booking.token}) has been cancelled by the admin."
+    message = _message(booking.user_id, "Appointment Cancelled", body, f"cancel-{booking.id}",
+                       [300, 100, 300], "/booking")
+    _dispatch(lambda: [message], "Cancellation Notification")
 
 
 def send_referral_notification(referral, app, db, PushSubscription):
@@ -527,53 +465,7 @@ def send_referral_notification(referral, app, db, PushSubscription):
     Finds subscriptions for the patient and sends a web push notification
     alerting them that they have a new referral from their doctor.
     """
-    if not VAPID_PRIVATE_KEY:
-        print("[Push Service] No VAPID keys installed. Aborting push.")
-        return
-
-    def run_push():
-        with app.app_context():
-            try:
-                title = "New Medical Referral"
-                doc_disp = referral.from_doctor.strip()
-                if not doc_disp.lower().startswith("dr."):
-                    doc_disp = f"Dr. {doc_disp}"
-                body = f"You have been referred to {referral.to_specialization} by {doc_disp}."
-                tag = f"referral-{referral.id}"
-                
-                subs = PushSubscription.query.filter_by(user_id=referral.user_id).all() if referral.user_id else []
-                for sub in subs:
-                    push_info = {
-                        "endpoint": sub.endpoint,
-                        "keys": {
-                            "p256dh": sub.p256dh,
-                            "auth": sub.auth
-                        }
-                    }
-                    payload = json.dumps({
-                        "title": title,
-                        "body": body,
-                        "tag": tag,
-                        "vibrate": [100, 50, 100, 50, 200],
-                        "silent": False,
-                        "url": "/patient_dashboard"
-                    })
-                    try:
-                        webpush(
-                            subscription_info=push_info,
-                            data=payload,
-                            vapid_private_key=VAPID_PRIVATE_KEY,
-                            vapid_claims=VAPID_CLAIMS
-                        )
-                    except WebPushException as ex:
-                        if ex.response and ex.response.status_code in [404, 410]:
-                            print(f"[Push Service] Unsubscribed endpoint {sub.endpoint}. Deleting...")
-                            db.session.delete(sub)
-                            db.session.commit()
-                        else:
-                            print(f"[Push Service] WebPush Error: {repr(ex)}")
-            except Exception as e:
-                print(f"[Push Service] Referral Notification Error: {e}")
-
-    thread = threading.Thread(target=run_push)
-    thread.start()
+    body = f"You have been referred to {referral.to_specialization} by {_doctor_display(referral.from_doctor)}."
+    message = _message(referral.user_id, "New Medical Referral", body, f"referral-{referral.id}",
+                       [100, 50, 100, 50, 200], "/patient_dashboard")
+    _dispatch(lambda: [message], "Referral Notification")
@@ -0,0 +1,29 @@
+import os
+import sys
+
+# Ensure we can import app
+sys.path.append(os.path.abspath(os.curdir))
+
+from app import app, db, PatientBooking, BookingDailyRollup
+import analytics_rollup
+
+def backfill_rollups():
+    """
+    Rebuilds the BookingDailyRollup table from every PatientBooking row.
+    Safe to re-run: existing rollup rows are replaced in one transaction.
+    """
+    with app.app_context():
+        print("--- Rebuilding analytics rollups ---")
+        try:
+            count = analytics_rollup.rebuild(db, PatientBooking, BookingDailyRollup)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error rebuilding rollups: {e}")
+            return False
+        rows = BookingDailyRollup.query.count()
+        print(f"Processed {count} bookings into {rows} doctor-day rows.")
+        return True
+
+if __name__ == "__main__":
+    ok = backfill_rollups()
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import tempfile
+import time
+from types import SimpleNamespace
+
+# Ensure we can import app; it runs against a throwaway database and a fake API key
+sys.path.append(os.path.abspath(os.curdir))
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "check_ai_streaming.db")
+os.environ["GOOGLE_API_KEY"] = "check"
+
+# Flask 2.3's test client reads werkzeug.__version__, which Werkzeug 3.1 no longer exports
+import werkzeug
+from importlib.metadata import version
+if not hasattr(werkzeug, "__version__"):
+    werkzeug.__version__ = version("werkzeug")
+
+import app as primecare
+from ai_assistant import GeminiAssistant, RequestGovernor
+from google.genai.errors import APIError, ClientError
+
+CHUNK_DELAY = 0.05
+RATE_LIMITED = APIError(429, {"error": {"code": 429, "message": "quota", "status": "RESOURCE_EXHAUSTED"}})
+NO_ACCESS = ClientError(403, {"error": {"code": 403, "message": "denied", "status": "PERMISSION_DENIED"}})
+
+class StreamingStub:
+    """
+    Stands in for genai.Client. Each model call takes the next step of
+    `plan`: an exception raised before any text, or a list of text pieces
+    (an exception in the list is raised mid-stream).
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.models = SimpleNamespace(generate_content_stream=self._stream)
+        self.chats = SimpleNamespace(create=lambda **kwargs: SimpleNamespace(
+            send_message_stream=lambda message: self._stream()))
+
+    def _stream(self, **kwargs):
+        step = self.plan.pop(0)
+        if isinstance(step, Exception):
+            raise step
+        for piece in step:
+            if isinstance(piece, Exception):
+                raise piece
+            time.sleep(CHUNK_DELAY)
+            yield SimpleNamespace(text=piece)
+
+def parse_events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        events.append((fields.get("event"), json.loads(fields.get("data", "null"))))
+    return events
+
+def stream(client, path, plan, payload, backoff=5.0):
+    """(events, seconds to each event) for one streamed request against a stub client."""
+    primecare.gemini_assistant = GeminiAssistant(
+        "check", primecare.GEMINI_SYSTEM_PROMPT,
+        client_factory=lambda: StreamingStub(plan), context_cache=False
+    )
+    primecare.gemini_governor = RequestGovernor(backoff=backoff)
+    primecare.ai_reply_cache.clear()
+
+    started = time.time()
+    response = client.post(path, json=payload, buffered=False)
+    assert response.mimetype == "text/event-stream", response.mimetype
+    body, arrivals = "", []
+    for part in response.response:
+        body += part.decode() if isinstance(part, bytes) else part
+        arrivals.append(round(time.time() - started, 2))
+    return parse_events(body), arrivals
+
+def check_ai_streaming():
+    """Drives /ai_triage/stream and /admin_ai_chat/stream with a stub Gemini client."""
+    primecare.app.config["WTF_CSRF_ENABLED"] = False
+    primecare._store_directory([{
+        "Name": "Dr Check", "Specialization": "ENT", "Days": ["Monday"], "DayTimes": {"Monday": "09:00-12:00"},
+        "Time": "", "SheetURL": "", "Image": "", "Email": "check@example.com"
+    }], time.time())
+    primecare.get_calendar = lambda *args, **kwargs: {"holidays": {}, "leaves": {}, "holiday_rows": [], "leave_rows": []}
+    client = primecare.app.test_client()
+    triage = {"history": [{"role": "user", "text": "which doctor for ear pain"}]}
+    admin = {"message": "how many bookings today?", "history": []}
+    failures = []
+
+    def expect(name, condition):
+        print(f"  [{'ok' if condition else 'FAIL'}] {name}")
+        if not condition:
+            failures.append(name)
+
+    print("--- /ai_triage/stream ---")
+    events, arrivals = stream(client, "/ai_triage/stream", [["Hello", " from", " ENT"]], triage)
+    expect("chunks arrive one by one",
+           [e for e, _ in events] == ["chunk", "chunk", "chunk", "done"] and arrivals[0] < arrivals[-1] - CHUNK_DELAY)
+    expect("done carries the full reply", events[-1][1]["reply"] == "Hello from ENT")
+
+    events, _ = stream(client, "/ai_triage/stream", [RATE_LIMITED, ["Retried"]], triage, backoff=0)
+    expect("429 before the first chunk is retried", events[-1][1]["reply"] == "Retried")
+
+    events, _ = stream(client, "/ai_triage/stream", [RATE_LIMITED, ["Retried"]], triage)
+    expect("429 with no capacity left answers busy", events[-1][1]["reply"] == primecare.AI_BUSY_REPLY)
+
+    events, _ = stream(client, "/ai_triage/stream", [["Partial", RATE_LIMITED], ["Repeated"]], triage, backoff=0)
+    expect("429 after a chunk is not retried",
+           [e for e, _ in events] == ["chunk", "done"] and events[-1][1]["reply"] == primecare.AI_UNREACHABLE_REPLY)
+
+    print("--- /admin_ai_chat/stream ---")
+    with client.session_transaction() as sess:
+        sess["admin_logged_in"] = True
+        sess["admin_email"] = primecare.ADMIN_EMAIL
+
+    events, _ = stream(client, "/admin_ai_chat/stream", [["Ten", " bookings"]], admin)
+    expect("chunks then done", [e for e, _ in events] == ["chunk", "chunk", "done"]
+           and events[-1][1]["reply"] == "Ten bookings")
+
+    events, _ = stream(client, "/admin_ai_chat/stream", [["Ten", RuntimeError("dropped")]], admin)
+    expect("mid-stream failure ends with the fallback error",
+           events[-1] == ("error", {"success": False, "error": primecare.ADMIN_AI_FALLBACK_REPLY}))
+
+    events, _ = stream(client, "/admin_ai_chat/stream", [NO_ACCESS], admin)
+    expect("403 reports missing project access",
+           events == [("error", {"success": False, "error": primecare.ADMIN_AI_NO_ACCESS})])
+
+    if failures:
+        print(f"{len(failures)} check(s) failed.")
+        return False
+    print("All streaming checks passed.")
+    return True
+
+if __name__ == "__main__":
+    ok = check_ai_streaming()
+    sys.exit(0 if ok else 1)
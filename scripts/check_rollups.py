@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+# Ensure we can import app; the update sequences run against a throwaway database
+sys.path.append(os.path.abspath(os.curdir))
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "check_rollups.db")
+
+from app import app, db, User, PatientBooking, BookingDailyRollup
+import analytics_rollup
+
+def check_rollups():
+    """
+    Updates bookings the ways the routes can, including assignments on an
+    instance expired by the previous commit, and checks after each step
+    that BookingDailyRollup matches a rebuild from PatientBooking.
+    """
+    failures = []
+
+    def expect(name):
+        mismatches = analytics_rollup.verify(db, PatientBooking, BookingDailyRollup)
+        print(f"  [{'ok' if not mismatches else 'FAIL'}] {name}")
+        for key, (live, expected) in mismatches.items():
+            print(f"      {key}: live {live} != rebuild {expected}")
+        if mismatches:
+            failures.append(name)
+
+    with app.app_context():
+        print("--- Rollup consistency ---")
+        user = User(name="Rollup Check", email="rollup-check@example.com", password_hash="-")
+        db.session.add(user)
+        db.session.commit()
+
+        booking = PatientBooking(user_id=user.id, doctor_name="Dr Check", specialization="ENT",
+                                 date=datetime.utcnow().strftime("%Y-%m-%d"), token=1, patient_name="P", age="30")
+        db.session.add(booking)
+        db.session.commit()
+        expect("new booking")
+
+        # The commit expired `booking`; these assignments have no loaded original
+        start = datetime.utcnow().replace(microsecond=0)
+        booking.consultation_start_time = start
+        booking.consultation_end_time = start + timedelta(seconds=600)
+        db.session.commit()
+        expect("consultation times set on an expired instance")
+
+        booking.consultation_start_time = start - timedelta(seconds=300)
+        db.session.commit()
+        expect("consultation start moved on an expired instance")
+
+        booking.status = "cancelled"
+        db.session.commit()
+        expect("cancelled on an expired instance")
+
+        booking.doctor_name = "Dr Other"
+        booking.status = "confirmed"
+        db.session.commit()
+        expect("doctor and status changed on an expired instance")
+
+        loaded = db.session.get(PatientBooking, booking.id)
+        loaded.consultation_end_time = None
+        db.session.commit()
+        expect("consultation end cleared on a loaded instance")
+
+        db.session.delete(db.session.get(PatientBooking, booking.id))
+        db.session.commit()
+        expect("booking deleted")
+
+    if failures:
+        print(f"{len(failures)} check(s) failed.")
+        return False
+    print("Live rollups match a rebuild after every step.")
+    return True
+
+if __name__ == "__main__":
+    ok = check_rollups()
+    sys.exit(0 if ok else 1)
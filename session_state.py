@@ -0,0 +1,180 @@
+"""
+Doctor session state machine.
+
+A DoctorSession row moves through
+
+- idle -> active when the doctor starts the session;
+- active <-> waiting_bookings as the current token overtakes the bookings
+  and new bookings arrive;
+- any state -> completed on complete_session or at shift end;
+- back to idle for a new day.
+
+sync_doctor_session_status() used to work these transitions out on every
+read: /live_tokens, the doctor stats poll and the dashboard each reset the
+day, counted the remaining bookings and committed. Every poll by every
+viewer could turn into a write on doctor_session.
+
+Now every transition is applied by an explicit event:
+
+- the doctor's own actions (start_session, next_token/skip_token via
+  advance(), complete_session);
+- a booking for today (bookings_changed());
+- SessionScheduler, which catches up once when it starts and then wakes at
+  each doctor's shift end and at midnight (shift_ended(), rollover()).
+
+Read paths only read. The functions here change the ORM object and return
+whether anything changed. Committing, pushes and live updates stay with the
+caller in app.py.
+"""
+import threading
+from datetime import datetime, timedelta
+
+import pytz
+
+IST = pytz.timezone('Asia/Kolkata')
+
+IDLE = 'idle'
+ACTIVE = 'active'
+WAITING = 'waiting_bookings'
+COMPLETED = 'completed'
+
+
+def queue_status(doc_session):
+    """active while the current token has a booking to call, otherwise waiting_bookings."""
+    total = doc_session.total_tokens or 0
+    return ACTIVE if total > 0 and total >= (doc_session.current_token or 0) else WAITING
+
+
+def rollover(doc_session, today_str, total_tokens):
+    """
+    Reset a session left over from an earlier day. total_tokens is the
+    highest live token booked for today, the same meaning the booking paths
+    keep. Returns True if it was reset.
+    """
+    if doc_session.session_date == today_str:
+        return False
+    doc_session.status = IDLE
+    doc_session.current_token = 0
+    doc_session.session_date = today_str
+    doc_session.total_tokens = total_tokens
+    doc_session.start_time = None
+    doc_session.end_time = None
+    doc_session.skipped_tokens = ""
+    doc_session.broadcast_message = None
+    return True
+
+
+def complete(doc_session, now_ist):
+    doc_session.status = COMPLETED
+    doc_session.end_time = now_ist.strftime("%H:%M %p")
+    if (doc_session.current_token or 0) > (doc_session.total_tokens or 0):
+        doc_session.current_token = doc_session.total_tokens if (doc_session.total_tokens or 0) > 0 else 0
+    return True
+
+
+def bookings_changed(doc_session):
+    """A booking for today arrived: a waiting queue becomes active again."""
+    if doc_session.status not in (ACTIVE, WAITING):
+        return False
+    status = queue_status(doc_session)
+    changed = status != doc_session.status
+    doc_session.status = status
+    return changed
+
+
+def advance(doc_session, shift_over, has_remaining, now_ist):
+    """
+    The doctor called the next token (next_token/skip_token). After the
+    shift has ended the session completes once nobody is left in the queue.
+    """
+    if doc_session.status == COMPLETED:
+        return False
+    if shift_over and not has_remaining:
+        return complete(doc_session, now_ist)
+    status = queue_status(doc_session)
+    changed = status != doc_session.status
+    doc_session.status = status
+    return changed
+
+
+def shift_ended(doc_session, has_remaining, now_ist):
+    """
+    Shift end timer. Idle and waiting sessions complete immediately; an
+    active one keeps going until its queue is empty (see advance()).
+    """
+    if doc_session.status in (IDLE, WAITING) or (doc_session.status == ACTIVE and not has_remaining):
+        return complete(doc_session, now_ist)
+    return False
+
+
+def next_midnight(now_ist):
+    return (now_ist + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class SessionScheduler:
+    """
+    Daemon thread that fires shift-end and midnight transitions on time.
+
+    - next_deadline(now) -> aware datetime of the next shift end, or None;
+      midnight is always a deadline.
+    - run_due(now) applies whatever is due and must be safe to repeat;
+      it runs inside an app context.
+
+    start() applies whatever is already due. The thread then sleeps until
+    the next deadline, but never longer than `max_sleep`, so roster changes
+    and missed wakeups are picked up.
+    """
+
+    def __init__(self, app, next_deadline, run_due, max_sleep=300):
+        self.app = app
+        self.next_deadline = next_deadline
+        self.run_due = run_due
+        self.max_sleep = max_sleep
+
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_run = None
+
+    def start(self):
+        """
+        Run one pass right away, so a process started after midnight or a
+        shift end catches up before it serves requests, then start the thread.
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        try:
+            self.tick()
+        except Exception as e:
+            print(f"[Session Scheduler] Catch-up run failed: {e}")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="session-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def seconds_until_due(self, now_ist):
+        deadlines = [next_midnight(now_ist)]
+        try:
+            with self.app.app_context():
+                upcoming = self.next_deadline(now_ist)
+            if upcoming:
+                deadlines.append(upcoming)
+        except Exception as e:
+            print(f"[Session Scheduler] Could not compute next deadline: {e}")
+        wait = (min(deadlines) - now_ist).total_seconds()
+        # +1s so "HH:MM" comparisons see the minute as passed
+        return max(1.0, min(self.max_sleep, wait + 1))
+
+    def tick(self):
+        now_ist = datetime.now(IST)
+        with self.app.app_context():
+            self.run_due(now_ist)
+        self.last_run = now_ist
+
+    def _run(self):
+        while not self._stop.wait(self.seconds_until_due(datetime.now(IST))):
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"[Session Scheduler] Run failed: {e}")
@@ -0,0 +1,71 @@
+"""
+Collects cell/row changes for one worksheet and writes them in a single
+values.batchUpdate request.
+
+Routes that rewrote a tab with `ws.clear()` followed by one `append_row`
+per row issued N+2 Sheets calls and left a window in which concurrent
+readers (get_doctor_directory, the calendar cache) saw an empty or
+half-written table. With SheetBatch the new contents replace the old ones
+in one request, so a reader sees either the old table or the new one.
+
+    batch = SheetBatch(ws)
+    batch.replace_table([headers] + rows, previous_rows=len(all_rows))
+    batch.commit()
+"""
+from gspread.utils import rowcol_to_a1
+
+
+class SheetBatch:
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self._ranges = []  # [{"range": "A1:C3", "values": [[...], ...]}]
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def set_cell(self, row, col, value):
+        self._ranges.append({"range": rowcol_to_a1(row, col), "values": [[value]]})
+        return self
+
+    def set_row(self, row, values, col=1):
+        """Write `values` starting at (row, col)."""
+        return self.set_rows(row, [values], col=col)
+
+    def set_rows(self, first_row, rows, col=1):
+        """Write a block of rows starting at (first_row, col)."""
+        if not rows:
+            return self
+        width = max(len(r) for r in rows) or 1
+        block = [list(r) + [""] * (width - len(r)) for r in rows]
+        end = rowcol_to_a1(first_row + len(block) - 1, col + width - 1)
+        self._ranges.append({"range": f"{rowcol_to_a1(first_row, col)}:{end}", "values": block})
+        return self
+
+    def replace_table(self, rows, previous_rows=0, previous_width=0):
+        """
+        Overwrite the tab from A1 with `rows`. Rows beyond the new length,
+        up to `previous_rows`, are blanked in the same request instead of
+        clearing the sheet first.
+        """
+        width = max([previous_width] + [len(r) for r in rows]) or 1
+        block = [list(r) + [""] * (width - len(r)) for r in rows]
+        block += [[""] * width for _ in range(max(0, previous_rows - len(block)))]
+        return self.set_rows(1, block)
+
+    def commit(self):
+        """Send every queued range in one batch_update. Returns the number of ranges written."""
+        if not self._ranges:
+            return 0
+        ranges, self._ranges = self._ranges, []
+        last_row = max(_last_row(r["range"]) for r in ranges)
+        row_count = getattr(self.worksheet, "row_count", last_row)
+        if last_row > row_count:
+            self.worksheet.add_rows(last_row - row_count)
+        self.worksheet.batch_update(ranges)
+        return len(ranges)
+
+
+def _last_row(a1_range):
+    end = a1_range.split(":")[-1]
+    digits = "".join(ch for ch in end if ch.isdigit())
+    return int(digits) if digits else 1
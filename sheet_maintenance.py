@@ -0,0 +1,115 @@
+"""
+Scheduled housekeeping for the per-doctor booking spreadsheets.
+
+Doctor spreadsheets get one DD-MM-YYYY tab per booking day, which used to be
+pruned from the booking path: after each sheet write the app bumped a shared
+BookingStats!A2 counter (a racy read-modify-write) and every tenth write
+listed the tabs and deleted old ones.
+
+SheetMaintenance runs from its own daemon thread instead. For every doctor
+it lists the spreadsheet's tabs once. Each date tab that is past and
+outside the newest `keep_last_n` tabs is first archived: the replicator
+reconciles it in read-only mode, which adopts sheet-only rows (walk-ins
+typed into the sheet) as bookings and backfills missing gender/phone. Only
+then is the tab deleted. The database keeps the full history for analytics.
+A tab whose archive step fails is left in place for the next run.
+"""
+import threading
+from datetime import datetime
+
+import pytz
+
+IST = pytz.timezone('Asia/Kolkata')
+
+
+def tab_date(title):
+    """date for a DD-MM-YYYY tab title, or None for other tabs."""
+    try:
+        return datetime.strptime(title, "%d-%m-%Y").date()
+    except ValueError:
+        return None
+
+
+class SheetMaintenance:
+    def __init__(self, app, replicator, list_doctors, keep_last_n=4,
+                 interval=6 * 3600, initial_delay=300):
+        self.app = app
+        self.replicator = replicator
+        self.list_doctors = list_doctors
+        self.keep_last_n = keep_last_n
+        self.interval = interval
+        self.initial_delay = initial_delay
+
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_run = None
+        self.last_summary = None
+
+    # ─── Worker lifecycle ───
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sheet-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        if self._stop.wait(self.initial_delay):
+            return
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"[Sheet Maintenance] Run failed: {e}")
+            self._stop.wait(self.interval)
+
+    # ─── Archive + prune ───
+
+    def expired_tabs(self, worksheets, today):
+        """Date tabs to archive: older than today and not among the newest keep_last_n."""
+        dated = sorted(((tab_date(ws.title), ws) for ws in worksheets if tab_date(ws.title)),
+                       key=lambda pair: pair[0])
+        keep = dated[-self.keep_last_n:] if self.keep_last_n else []
+        kept_titles = {ws.title for _, ws in keep}
+        return [(day, ws) for day, ws in dated if day < today and ws.title not in kept_titles]
+
+    def run_once(self):
+        """Archive and delete expired date tabs for every doctor. Returns a summary dict."""
+        summary = {"archived": 0, "adopted": 0, "failed": 0}
+        today = datetime.now(IST).date()
+        with self._lock:
+            for doc in self.list_doctors() or []:
+                sheet_url = doc.get("SheetURL")
+                if not sheet_url:
+                    continue
+                try:
+                    spreadsheet = self.replicator.open_spreadsheet(sheet_url)
+                    expired = self.expired_tabs(spreadsheet.worksheets(), today)
+                except Exception as e:
+                    summary["failed"] += 1
+                    print(f"[Sheet Maintenance] Could not list tabs for {doc.get('Name')}: {e}")
+                    continue
+
+                for day, ws in expired:
+                    try:
+                        result = self.replicator.reconcile(
+                            sheet_url, day.strftime("%Y-%m-%d"), doctor=doc, repair=False)
+                        spreadsheet.del_worksheet(ws)
+                        summary["archived"] += 1
+                        summary["adopted"] += result.get("adopted", 0)
+                    except Exception as e:
+                        with self.app.app_context():
+                            self.replicator.db.session.rollback()
+                        summary["failed"] += 1
+                        print(f"[Sheet Maintenance] Kept tab {ws.title} for {doc.get('Name')}: {e}")
+
+        self.last_run = datetime.utcnow()
+        self.last_summary = summary
+        if any(summary.values()):
+            print(f"[Sheet Maintenance] {summary}")
+        return summary
@@ -0,0 +1,346 @@
+"""
+Background replication of bookings to the per-doctor Google Sheets.
+
+The local database is the source of truth for bookings. Booking and
+cancellation routes only write PatientBooking rows (with sync_state set to
+'pending') and call notify(); the replicator thread pushes those rows to
+the doctor's DD-MM-YYYY date tab outside the request.
+
+Writes are positional and idempotent: token N always lives on sheet row
+N + 1 as [Token, Name, Age, Gender, Phone_Number, Date], and a cancelled
+booking keeps its token in column A with B:F blanked until the app hands
+that token to a new booking, which then takes over the row. Retrying a
+write, or two workers pushing the same row, converges to the same sheet
+contents.
+
+The Sheets API is only reached through the `open_spreadsheet(url)` callable
+passed in by the app, so the replicator can be exercised against a fake
+gspread client.
+"""
+import threading
+from datetime import datetime, timedelta
+
+import gspread
+import pytz
+
+SHEET_HEADERS = ["Token", "Name", "Age", "Gender", "Phone_Number", "Date"]
+
+
+def sheet_title_for(date_str):
+    """DD-MM-YYYY worksheet title for a YYYY-MM-DD (or legacy DD-MM-YYYY) date."""
+    try:
+        return datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%m-%Y")
+    except ValueError:
+        datetime.strptime(date_str, "%d-%m-%Y")
+        return date_str
+
+
+def booking_row(booking):
+    """The six sheet cells a booking should occupy."""
+    if booking.status == 'cancelled':
+        return [booking.token, "", "", "", "", ""]
+    return [
+        booking.token,
+        booking.patient_name or "",
+        booking.age or "",
+        booking.gender or "",
+        booking.phone_number or "",
+        booking.date or "",
+    ]
+
+
+def _cells_differ(sheet_row, wanted):
+    padded = list(sheet_row) + [""] * (len(wanted) - len(sheet_row))
+    return any(str(a).strip() != str(b).strip() for a, b in zip(padded, wanted))
+
+
+class SheetReplicator:
+    """
+    Pushes pending PatientBooking rows to Google Sheets from a daemon thread
+    and periodically reconciles upcoming date tabs against the database.
+    """
+
+    def __init__(self, app, db, PatientBooking, open_spreadsheet,
+                 forget_spreadsheet=None, list_doctors=None, guest_user_id=None,
+                 interval=30, reconcile_interval=3600,
+                 batch_size=50, max_attempts=8):
+        self.app = app
+        self.db = db
+        self.PatientBooking = PatientBooking
+        self.open_spreadsheet = open_spreadsheet
+        # Optional: forget_spreadsheet(url) drops any cached handle for a
+        # sheet whose write failed, so the retry reopens it.
+        self.forget_spreadsheet = forget_spreadsheet
+        # Optional: returns doctor dicts (Name, Specialization, SheetURL, DayTimes)
+        # so reconcile can adopt rows that only exist in a sheet.
+        self.list_doctors = list_doctors
+        # Optional: returns the user id that adopted sheet-only rows belong to.
+        self.guest_user_id = guest_user_id
+        self.interval = interval
+        self.reconcile_interval = reconcile_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    # ─── Worker lifecycle ───
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sheet-replicator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def notify(self):
+        """Wake the worker after a booking row was written locally."""
+        self._wake.set()
+
+    def _run(self):
+        next_reconcile = datetime.utcnow()
+        while not self._stop.is_set():
+            try:
+                while self.flush() >= self.batch_size:
+                    pass
+            except Exception as e:
+                print(f"[Sheet Sync] Flush failed: {e}")
+
+            if self.reconcile_interval and datetime.utcnow() >= next_reconcile:
+                try:
+                    self.reconcile_recent()
+                except Exception as e:
+                    print(f"[Sheet Sync] Reconcile failed: {e}")
+                next_reconcile = datetime.utcnow() + timedelta(seconds=self.reconcile_interval)
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    # ─── Push pending rows ───
+
+    def flush(self):
+        """
+        Push one batch of pending bookings to their sheets.
+        Returns the number of bookings that were written.
+        """
+        PB = self.PatientBooking
+        with self._flush_lock, self.app.app_context():
+            pending = PB.query.filter(PB.sync_state == 'pending') \
+                .order_by(PB.sync_attempts.asc(), PB.id.asc()) \
+                .limit(self.batch_size).all()
+
+            groups = {}
+            for b in pending:
+                groups.setdefault((b.sheet_url, b.date), []).append(b)
+
+            pushed = 0
+            for (sheet_url, date_str), bookings in groups.items():
+                try:
+                    pushed += self._push_group(sheet_url, date_str, bookings)
+                except Exception as e:
+                    self.db.session.rollback()
+                    if self.forget_spreadsheet:
+                        self.forget_spreadsheet(sheet_url)
+                    self._record_failure(bookings, e)
+            return pushed
+
+    def _push_group(self, sheet_url, date_str, bookings):
+        PB = self.PatientBooking
+        if not sheet_url or not date_str:
+            raise ValueError("booking has no sheet URL or date")
+
+        # Snapshot what we are about to write; a row that changes while the
+        # write is in flight stays pending and is pushed again.
+        snapshot = [(b.id, b.status) for b in bookings]
+        # A cancelled token may have been handed to a new booking; the live
+        # booking owns that row, so the cancellation must not blank it.
+        live_tokens = {t for (t,) in PB.query.with_entities(PB.token).filter(
+            PB.sheet_url == sheet_url, PB.date == date_str, PB.status != 'cancelled')}
+        wanted = {}
+        for b in bookings:
+            if not b.token:
+                continue
+            if b.status == 'cancelled' and b.token in live_tokens:
+                continue
+            wanted[b.token] = booking_row(b)
+
+        spreadsheet = self.open_spreadsheet(sheet_url)
+        if wanted:
+            ws = self._date_worksheet(spreadsheet, sheet_title_for(date_str))
+            self._write_rows(ws, wanted)
+
+        now = datetime.utcnow()
+        for booking_id, status in snapshot:
+            PB.query.filter(PB.id == booking_id, PB.status == status).update(
+                {"sync_state": "synced", "sync_attempts": 0, "synced_at": now}, synchronize_session=False)
+        self.db.session.commit()
+        return len(snapshot)
+
+    def _record_failure(self, bookings, error):
+        PB = self.PatientBooking
+        ids = [b.id for b in bookings]
+        try:
+            PB.query.filter(PB.id.in_(ids)).update(
+                {"sync_attempts": PB.sync_attempts + 1}, synchronize_session=False)
+            PB.query.filter(PB.id.in_(ids), PB.sync_attempts >= self.max_attempts).update(
+                {"sync_state": "failed"}, synchronize_session=False)
+            self.db.session.commit()
+        except Exception:
+            self.db.session.rollback()
+        print(f"[Sheet Sync] Could not push {len(ids)} booking(s) to sheet: {error}")
+
+    def _date_worksheet(self, spreadsheet, title, create=True):
+        try:
+            return spreadsheet.worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            if not create:
+                return None
+            ws = spreadsheet.add_worksheet(title=title, rows="100", cols="10")
+            ws.update("A1:F1", [SHEET_HEADERS])
+            return ws
+
+    def _write_rows(self, ws, rows_by_token):
+        last_row = max(rows_by_token) + 1
+        row_count = getattr(ws, "row_count", last_row)
+        if last_row > row_count:
+            ws.add_rows(last_row - row_count)
+        ws.batch_update([
+            {"range": f"A{token + 1}:F{token + 1}", "values": [row]}
+            for token, row in sorted(rows_by_token.items())
+        ])
+
+    # ─── Drift repair ───
+
+    def reconcile(self, sheet_url, date_str, doctor=None, repair=True):
+        """
+        Compare one date tab with the database and repair drift.
+
+        - rows the database knows about are rewritten if the sheet differs
+          (skipped with repair=False, e.g. when the tab is about to be archived);
+        - legacy bookings missing gender/phone locally are filled from the sheet;
+        - named rows that exist only in the sheet are adopted as guest bookings
+          (when `doctor` is given) so token allocation accounts for them.
+
+        Returns a summary dict of what was changed.
+        """
+        PB = self.PatientBooking
+        summary = {"rewritten": 0, "backfilled": 0, "adopted": 0}
+        with self.app.app_context():
+            bookings = PB.query.filter(PB.sheet_url == sheet_url, PB.date == date_str) \
+                .order_by(PB.id.asc()).all()
+
+            spreadsheet = self.open_spreadsheet(sheet_url)
+            ws = self._date_worksheet(spreadsheet, sheet_title_for(date_str), create=repair and bool(bookings))
+            if ws is None:
+                return summary
+            sheet_rows = ws.get_all_values()
+            guest_user_id = self.guest_user_id() if (doctor and self.guest_user_id) else None
+
+            # A live booking wins over a cancelled one that shares its token.
+            by_token = {}
+            for b in bookings:
+                if not b.token:
+                    continue
+                current = by_token.get(b.token)
+                if current is None or current.status == 'cancelled':
+                    by_token[b.token] = b
+
+            for idx, row in enumerate(sheet_rows[1:], start=1):
+                if not row or not str(row[0]).strip():
+                    continue
+                try:
+                    token = int(str(row[0]).strip())
+                except ValueError:
+                    continue
+                name = row[1].strip() if len(row) > 1 else ""
+                b = by_token.get(token)
+                if b is None:
+                    if name and doctor and guest_user_id:
+                        by_token[token] = self._adopt_row(doctor, guest_user_id, sheet_url, date_str, token, row)
+                        summary["adopted"] += 1
+                    continue
+                if (b.status != 'cancelled' and name
+                        and name.lower() == (b.patient_name or "").strip().lower()
+                        and b.gender is None and b.phone_number is None):
+                    b.gender = row[3].strip() if len(row) > 3 else ""
+                    b.phone_number = row[4].strip() if len(row) > 4 else ""
+                    summary["backfilled"] += 1
+
+            sheet_by_token = {}
+            for row in sheet_rows[1:]:
+                if row and str(row[0]).strip().isdigit():
+                    sheet_by_token[int(str(row[0]).strip())] = row
+
+            drift = {}
+            for token, b in (by_token.items() if repair else ()):
+                if b.sync_state == 'pending':
+                    continue  # flush() owns rows that have not been pushed yet
+                wanted = booking_row(b)
+                if _cells_differ(sheet_by_token.get(token, []), wanted):
+                    drift[token] = wanted
+            if drift:
+                self._write_rows(ws, drift)
+                summary["rewritten"] = len(drift)
+
+            self.db.session.commit()
+        return summary
+
+    def _adopt_row(self, doctor, guest_user_id, sheet_url, date_str, token, row):
+        PB = self.PatientBooking
+        cells = list(row) + [""] * (6 - len(row))
+        try:
+            weekday = datetime.strptime(date_str, "%Y-%m-%d").strftime("%A")
+        except ValueError:
+            weekday = datetime.strptime(date_str, "%d-%m-%Y").strftime("%A")
+        booking = PB(
+            user_id=guest_user_id,
+            doctor_name=doctor["Name"],
+            specialization=doctor["Specialization"],
+            date=date_str,
+            time=doctor.get("DayTimes", {}).get(weekday, ""),
+            token=token,
+            sheet_url=sheet_url,
+            patient_name=cells[1].strip(),
+            age=cells[2].strip() or "-",
+            gender=cells[3].strip(),
+            phone_number=cells[4].strip(),
+            sync_state="synced",
+            synced_at=datetime.utcnow(),
+        )
+        self.db.session.add(booking)
+        return booking
+
+    def reconcile_recent(self, days_ahead=15):
+        """Reconcile today's and upcoming date tabs for every doctor."""
+        today = datetime.now(pytz.timezone('Asia/Kolkata')).date()
+        dates = [(today + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days_ahead + 1)]
+        titles = {sheet_title_for(d): d for d in dates}
+
+        doctors = self.list_doctors() if self.list_doctors else []
+        totals = {"rewritten": 0, "backfilled": 0, "adopted": 0}
+        for doc in doctors:
+            sheet_url = doc.get("SheetURL")
+            if not sheet_url:
+                continue
+            try:
+                # One metadata call tells us which upcoming tabs exist.
+                spreadsheet = self.open_spreadsheet(sheet_url)
+                existing = [ws.title for ws in spreadsheet.worksheets() if ws.title in titles]
+                for title in existing:
+                    result = self.reconcile(sheet_url, titles[title], doctor=doc)
+                    for k, v in result.items():
+                        totals[k] += v
+            except Exception as e:
+                with self.app.app_context():
+                    self.db.session.rollback()
+                print(f"[Sheet Sync] Reconcile skipped for {doc.get('Name')}: {e}")
+
+        if any(totals.values()):
+            print(f"[Sheet Sync] Reconciled sheets: {totals}")
+        return totals
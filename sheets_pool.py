@@ -0,0 +1,173 @@
+"""
+Shared Google Sheets handles for request threads and background workers.
+
+With gspread every `client.open_by_url(url)` fetches the spreadsheet's
+metadata before anything is read, and every `spreadsheet.worksheet(title)`
+fetches it again to find the tab. A booking, cancellation or stats request
+therefore paid two metadata round trips before touching any cells.
+
+SheetsPool keeps, per worker process:
+
+- one authorized gspread client, created on first use;
+- an LRU of open spreadsheets keyed by spreadsheet ID, so a URL and a key
+  for the same file share one handle;
+- for each spreadsheet, a title -> Worksheet map filled from a single
+  worksheets() call.
+
+Repeated access to the same doctor's date tab is then served from memory.
+A title missing from the map triggers one refresh, so tabs created by
+another worker or by hand are picked up; add_worksheet/del_worksheet
+keep the map current, and the map expires after `tab_ttl` seconds in case
+tabs are renamed or deleted in the Sheets UI.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import gspread
+from gspread.utils import extract_id_from_url
+
+
+def spreadsheet_key(url_or_key):
+    """Spreadsheet ID for a docs.google.com URL, or the value itself if it already is one."""
+    if "/" in (url_or_key or ""):
+        return extract_id_from_url(url_or_key)
+    return url_or_key
+
+
+class PooledSpreadsheet:
+    """
+    Wraps a gspread Spreadsheet and resolves worksheet titles from a cached
+    map. Everything else (id, title, url, sheet1, share, ...) is passed through.
+    """
+
+    def __init__(self, spreadsheet, tab_ttl=600):
+        self._spreadsheet = spreadsheet
+        self._tab_ttl = tab_ttl
+        self._tabs = None      # {title: Worksheet}
+        self._tabs_ts = 0.0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._spreadsheet, name)
+
+    @property
+    def spreadsheet(self):
+        return self._spreadsheet
+
+    def _load_tabs(self):
+        tabs = self._spreadsheet.worksheets()
+        with self._lock:
+            self._tabs = {ws.title: ws for ws in tabs}
+            self._tabs_ts = time.time()
+        return tabs
+
+    def worksheets(self, *args, **kwargs):
+        """Always fetched fresh (callers use it to list tabs); refreshes the title map."""
+        if args or kwargs:
+            return self._spreadsheet.worksheets(*args, **kwargs)
+        return self._load_tabs()
+
+    def worksheet(self, title):
+        with self._lock:
+            fresh = self._tabs is not None and (time.time() - self._tabs_ts) < self._tab_ttl
+            ws = self._tabs.get(title) if fresh else None
+        if ws is not None:
+            return ws
+
+        self._load_tabs()
+        with self._lock:
+            ws = self._tabs.get(title)
+        if ws is None:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return ws
+
+    def add_worksheet(self, title, rows, cols, **kwargs):
+        ws = self._spreadsheet.add_worksheet(title=title, rows=rows, cols=cols, **kwargs)
+        with self._lock:
+            if self._tabs is not None:
+                self._tabs[ws.title] = ws
+        return ws
+
+    def del_worksheet(self, worksheet):
+        result = self._spreadsheet.del_worksheet(worksheet)
+        with self._lock:
+            if self._tabs is not None:
+                self._tabs.pop(worksheet.title, None)
+        return result
+
+    def forget_tabs(self):
+        with self._lock:
+            self._tabs = None
+
+
+class SheetsPool:
+    """Process-wide gspread client plus an LRU of PooledSpreadsheet handles."""
+
+    def __init__(self, authorize, max_spreadsheets=128, tab_ttl=600):
+        # authorize() -> gspread.Client; called once, lazily
+        self._authorize = authorize
+        self.max_spreadsheets = max_spreadsheets
+        self.tab_ttl = tab_ttl
+        self._client = None
+        self._handles = OrderedDict()  # spreadsheet id -> PooledSpreadsheet
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._authorize()
+        return self._client
+
+    def _cached(self, key):
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None:
+                self._handles.move_to_end(key)
+                self.hits += 1
+            return handle
+
+    def _store(self, key, spreadsheet):
+        handle = PooledSpreadsheet(spreadsheet, tab_ttl=self.tab_ttl)
+        with self._lock:
+            # Another thread may have opened it meanwhile; keep the first handle
+            handle = self._handles.setdefault(key, handle)
+            self._handles.move_to_end(key)
+            self.misses += 1
+            while len(self._handles) > self.max_spreadsheets:
+                self._handles.popitem(last=False)
+        return handle
+
+    def open_by_key(self, key):
+        handle = self._cached(key)
+        if handle is None:
+            handle = self._store(key, self.client.open_by_key(key))
+        return handle
+
+    def open_by_url(self, url):
+        return self.open_by_key(spreadsheet_key(url))
+
+    def open(self, title):
+        """Open a spreadsheet by name and keep its handle in the pool."""
+        spreadsheet = self.client.open(title)
+        return self._store(spreadsheet.id, spreadsheet)
+
+    def adopt(self, spreadsheet):
+        """Register a spreadsheet object created elsewhere (e.g. client.create)."""
+        return self._store(spreadsheet.id, spreadsheet)
+
+    def invalidate(self, url_or_key=None):
+        """Drop one cached spreadsheet (or all of them) so the next access reopens it."""
+        with self._lock:
+            if url_or_key is None:
+                self._handles.clear()
+            else:
+                self._handles.pop(spreadsheet_key(url_or_key), None)
+
+    def stats(self):
+        with self._lock:
+            return {"open_spreadsheets": len(self._handles), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,80 @@
+/* ── LIVE TOKEN STREAM (Server-Sent Events) ──
+ * One EventSource per page on /live_tokens/stream. livePoll(fn, intervalMs)
+ * runs fn whenever a doctor's session changes and keeps a slow fallback
+ * timer while the stream is connected; if the stream is unavailable it
+ * polls every intervalMs exactly like the old setInterval did.
+ *
+ * readEventStream(res, onEvent) reads a streamed fetch() response
+ * (text/event-stream, e.g. the AI chat streams) and calls onEvent(event, data)
+ * for each message as it arrives.
+ */
+(function() {
+  const IDLE_REFRESH_MS = 60000;   // safety refresh while the stream is healthy
+  const DEBOUNCE_MS = 150;         // coalesce bursts (e.g. skip + next)
+
+  let source = null;
+  let connected = false;
+  const pollers = [];
+
+  function notify() {
+    pollers.forEach(p => p.trigger());
+  }
+
+  function openStream() {
+    if (source || !window.EventSource) return;
+    source = new EventSource('/live_tokens/stream');
+    source.onopen = () => { connected = true; };
+    // EventSource reconnects by itself and resends Last-Event-ID
+    source.onerror = () => { connected = false; };
+    source.addEventListener('session', notify);
+    source.addEventListener('booking', notify);
+    source.addEventListener('resync', notify);
+  }
+
+  window.livePoll = function(fn, intervalMs) {
+    openStream();
+    let lastRun = Date.now();
+    let pending = null;
+
+    const run = () => {
+      pending = null;
+      lastRun = Date.now();
+      fn();
+    };
+
+    pollers.push({
+      trigger() {
+        if (!pending) pending = setTimeout(run, DEBOUNCE_MS);
+      }
+    });
+
+    setInterval(() => {
+      const wait = connected ? IDLE_REFRESH_MS : intervalMs;
+      // small tolerance so timer jitter does not skip a fallback tick
+      if (Date.now() - lastRun >= wait - 100) run();
+    }, intervalMs);
+  };
+
+  window.readEventStream = async function(res, onEvent) {
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let sep;
+      while ((sep = buffer.indexOf('\n\n')) !== -1) {
+        const block = buffer.slice(0, sep);
+        buffer = buffer.slice(sep + 2);
+        let event = 'message';
+        const dataLines = [];
+        block.split('\n').forEach(line => {
+          if (line.startsWith('event: ')) event = line.slice(7);
+          else if (line.startsWith('data: ')) dataLines.push(line.slice(6));
+        });
+        if (dataLines.length) onEvent(event, JSON.parse(dataLines.join('\n')));
+      }
+    }
+  };
+})();
@@ -495,7 +495,8 @@ window.fetch = async function(...args) {
   
   // Exclude background polls to prevent unwanted loading state triggers
   const url = args[0] ? String(args[0]).toLowerCase() : '';
-  const isBackgroundPoll = url.includes('/live_tokens') || url.includes('/my_token_status') || url.includes('/api/doctor_stats') || url.includes('/doctor/my_stats');
+  // Streams are excluded too: cloning the response to peek at its JSON would wait for the whole stream
+  const isBackgroundPoll = url.includes('/live_tokens') || url.includes('/my_token_status') || url.includes('/api/doctor_stats') || url.includes('/doctor/my_stats') || url.includes('/stream');
   
   if (btn && (!btn.disabled || btn.dataset.loading === 'true') && !isBackgroundPoll) {
     btn.dataset.fetchActive = 'true';
@@ -0,0 +1,120 @@
+"""
+Parsed view of a doctor's token queue for one day.
+
+DoctorSession keeps the queue in three columns: status, current_token and
+skipped_tokens, a comma-separated string that the doctor dashboard and
+live boards read as is. skip_token, consult_skipped, the patient status
+poll, /booking, /patient_dashboard and the doctor stats poll each used to
+re-split that string and compare tokens as strings.
+
+TokenQueue parses it once into a set (O(1) membership) plus the skip order.
+DoctorSession.queue memoizes it on the instance until one of the three
+columns changes, and LiveSessionMap keeps one per live session, so every
+viewer of a session shares the same parsed queue.
+
+- Skipped tokens are always behind current_token (a skip moves the queue
+  on), and they stay "skipped" until the doctor recalls them.
+- recall() (consult_skipped) drops a token from the skipped list. From then
+  on its position behind current_token makes it consulted.
+"""
+
+
+def _token(value):
+    """int token from an int or a string like ' 7 ', or None."""
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenQueue:
+    __slots__ = ("current_token", "status", "skipped", "skipped_order")
+
+    def __init__(self, current_token=0, status="idle", skipped_order=()):
+        self.current_token = current_token or 0
+        self.status = status or "idle"
+        order = []
+        for t in skipped_order:
+            t = _token(t)
+            if t is not None and t not in order:
+                order.append(t)
+        self.skipped_order = tuple(order)
+        self.skipped = frozenset(order)
+
+    @classmethod
+    def parse(cls, skipped_tokens, current_token=0, status="idle"):
+        return cls(current_token, status, (skipped_tokens or "").split(","))
+
+    @classmethod
+    def of(cls, doc_session):
+        """Queue for a DoctorSession-like object, reused until its queue columns change."""
+        key = (doc_session.status, doc_session.current_token, doc_session.skipped_tokens)
+        cached = getattr(doc_session, "_token_queue", None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        queue = cls.parse(doc_session.skipped_tokens, doc_session.current_token, doc_session.status)
+        try:
+            doc_session._token_queue = (key, queue)
+        except AttributeError:
+            pass
+        return queue
+
+    def __eq__(self, other):
+        return (isinstance(other, TokenQueue) and self.current_token == other.current_token
+                and self.status == other.status and self.skipped_order == other.skipped_order)
+
+    def __repr__(self):
+        return f"TokenQueue(current={self.current_token}, status={self.status!r}, skipped={list(self.skipped_order)})"
+
+    # ─── Queries ───
+
+    def encode(self):
+        """skipped_tokens column value."""
+        return ",".join(str(t) for t in self.skipped_order)
+
+    def is_skipped(self, token):
+        return _token(token) in self.skipped
+
+    def state_of(self, token):
+        """
+        Doctor-side status of a booked token: skipped, calling, consulted or
+        waiting. Once the session is waiting for bookings or completed,
+        every token that is not skipped counts as consulted.
+        """
+        token = _token(token)
+        if token in self.skipped:
+            return "skipped"
+        if token is None:
+            return "waiting"
+        if self.status == "active":
+            if token == self.current_token:
+                return "calling"
+            if token < self.current_token:
+                return "consulted"
+            return "waiting"
+        if self.status in ("completed", "waiting_bookings"):
+            return "consulted"
+        return "waiting"
+
+    def patients_ahead(self, token):
+        """
+        Tokens still to be called before `token`, negative once it has
+        been passed. This is deliberately the plain token - current_token.
+        Skipped tokens never lie ahead: skip_current() leaves them behind
+        current_token, and a recalled one is seen out of turn. So they
+        never shorten the wait.
+        """
+        return (_token(token) or 0) - self.current_token
+
+    # ─── Transitions (return a new queue) ───
+
+    def skip_current(self):
+        """The current token is skipped and the queue moves on to the next one."""
+        return TokenQueue(self.current_token + 1, self.status, self.skipped_order + (self.current_token,))
+
+    def recall(self, token):
+        """Take a skipped token back for consultation. Returns None if it was not skipped."""
+        token = _token(token)
+        if token not in self.skipped:
+            return None
+        return TokenQueue(self.current_token, self.status, [t for t in self.skipped_order if t != token])